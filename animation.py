@@ -0,0 +1,123 @@
+"""
+Animation scheduling.
+Only running animations are kept in the Animator, in a queue ordered by when their next frame
+is due, so idle doors and idle tiles cost nothing and a frame only touches the animations whose
+frame actually changes.
+"""
+import heapq
+import itertools
+
+
+# frames due within this many milliseconds of the clock count as due, so float rounding in the
+# accumulated clock never delays a frame by a whole update
+EPSILON = 1e-6
+
+class Animator:
+    def __init__(self):
+        """
+            Schedules animations. An animation is any object with a scheduled attribute and an
+            advance(rects) method, which shows its next frame, appends the world pixel rects it
+            changed to rects and returns the milliseconds until its following frame, or None once
+            it is done.
+        """
+        self.now = 0.0
+        # (due time, insertion order, animation)
+        self.queue = []
+        self.counter = itertools.count()
+
+    def start(self, animation, delay):
+        """Schedules animation's next frame delay milliseconds from now, unless it is already running."""
+        if animation.scheduled:
+            return
+        animation.scheduled = True
+        heapq.heappush(self.queue, (self.now + delay, next(self.counter), animation))
+
+    def start_at(self, animation, due):
+        """Schedules animation's next frame at clock time due, unless it is already running. Used to restore saves."""
+        self.start(animation, due - self.now)
+
+    def due_times(self):
+        """Returns {animation: clock time its next frame is due} for the running animations."""
+        return {animation: due for due, _, animation in self.queue}
+
+    def clear(self):
+        """Stops every animation."""
+        for _, _, animation in self.queue:
+            animation.scheduled = False
+        self.queue.clear()
+
+    def update(self, dt):
+        """
+            Advances the clock by dt milliseconds and every animation that became due.
+            Returns the list of world pixel rects that changed.
+        """
+        self.now += dt
+        rects = []
+        queue = self.queue
+        while queue and queue[0][0] <= self.now + EPSILON:
+            due, _, animation = heapq.heappop(queue)
+            animation.scheduled = False
+            delay = animation.advance(rects)
+            if delay is not None:
+                # scheduled from when the frame was due rather than from now, so animations don't drift
+                animation.scheduled = True
+                heapq.heappush(queue, (due + delay, next(self.counter), animation))
+        return rects
+
+    def __len__(self):
+        return len(self.queue)
+
+class TileAnimation:
+    def __init__(self, world, gid, frames):
+        """
+            A Tiled tile animation. Every tile of the map showing gid animates in step, like in Tiled.
+            The tiles are grouped by render chunk, and only those in chunks that are currently cached
+            are redrawn and reported, the others pick up the current frame when they are baked.
+            world: the world object
+            gid: the animated tile
+            frames: list of (gid, duration in milliseconds), the 'frames' tile property of pytmx
+        """
+        self.world = world
+        self.gid = gid
+        self.frames = [(int(frame_gid), int(duration)) for frame_gid, duration in frames]
+        self.index = 0
+        self.scheduled = False
+        # (layer name, chunk x, chunk y) -> set of (x, y) tiles showing gid
+        self.chunks = {}
+        world.tile_frames[gid] = self.frames[0][0]
+
+    def add(self, layer_name, x, y):
+        cs = self.world.chunk_size
+        self.chunks.setdefault((layer_name, x // cs, y // cs), set()).add((x, y))
+
+    def remove(self, layer_name, x, y):
+        cs = self.world.chunk_size
+        key = (layer_name, x // cs, y // cs)
+        tiles = self.chunks.get(key)
+        if tiles is not None:
+            tiles.discard((x, y))
+            if not tiles:
+                del self.chunks[key]
+
+    def start(self):
+        """Starts animating if any tile shows gid."""
+        if self.chunks:
+            self.world.animator.start(self, self.frames[self.index][1])
+
+    def advance(self, rects):
+        if not self.chunks:
+            # the last tile showing gid was replaced, start is called again when one is placed
+            return None
+        self.index = (self.index + 1) % len(self.frames)
+        self.world.tile_frames[self.gid] = self.frames[self.index][0]
+        # images larger than a tile may spill into chunks other than their own
+        spills = self.world.overflow != (0, 0)
+        for (layer_name, cx, cy), tiles in self.chunks.items():
+            caches = [caches[layer_name] for caches in self.world.layer_caches.values() if spills or (cx, cy) in caches[layer_name].chunks]
+            if not caches:
+                continue
+            for x, y in tiles:
+                for cache in caches:
+                    cache.invalidate_tile(x, y)
+                rects.append(self.world.tile_rect(x, y))
+        return self.frames[self.index][1]
@@ -0,0 +1,224 @@
+"""
+Reproducible performance benchmarks.
+Runs headless with SDL's dummy video driver and writes the results as JSON, for example:
+    python bench.py --sizes 70x40,256x256,1000x1000 --out bench.json
+Large maps are generated on the fly from the town tileset, so results don't depend on what
+maps happen to be in tiled/.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pygame
+import pytmx
+
+import game
+import mapcache
+import utils
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+TILESET = os.path.join(REPO, 'tiled', 'town.tsx')
+# gids of town.tsx used to fill the synthetic maps
+GROUND_GIDS = [967, 892, 715, 717]
+OBJECT_GIDS = [196, 307, 416, 417, 453, 454]
+FOREGROUND_GIDS = [68]
+
+def measure(fn, repeat, setup=None):
+    """
+        Calls fn repeat times and returns timing statistics in milliseconds.
+        setup: optional function called before every run, not timed
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter_ns()
+        fn()
+        times.append((time.perf_counter_ns() - start) / 1e6)
+    return {
+        'runs': repeat,
+        'min_ms': min(times),
+        'median_ms': statistics.median(times),
+        'mean_ms': statistics.fmean(times),
+        'max_ms': max(times),
+    }
+
+def write_synthetic_map(directory, width, height, seed=0, object_density=0.08, foreground_density=0.03, door_every=500,
+                        tileset=None, gids=None):
+    """
+        Writes a random width x height TMX map using the town tileset and returns its path.
+        The map has the Ground, Objects, Foreground and Doors layers the game expects.
+        tileset: the .tsx file the map uses instead of TILESET, with firstgid 1
+        gids: the gids the Ground, Objects and Foreground layers are filled from, instead of the town ones
+    """
+    rng = np.random.default_rng(seed)
+    ground_gids, object_gids, foreground_gids = gids or (GROUND_GIDS, OBJECT_GIDS, FOREGROUND_GIDS)
+    ground = rng.choice(ground_gids, (height, width))
+    objects = np.where(rng.random((height, width)) < object_density, rng.choice(object_gids, (height, width)), 0)
+    # keep the player's starting tile free
+    objects[0, 0] = 0
+    foreground = np.where(rng.random((height, width)) < foreground_density, rng.choice(foreground_gids, (height, width)), 0)
+
+    def layer(id, name, data):
+        rows = ',\n'.join(','.join(map(str, row)) for row in data.tolist())
+        return f' <layer id="{id}" name="{name}" width="{width}" height="{height}">\n  <data encoding="csv">\n{rows}\n</data>\n </layer>\n'
+
+    doors = []
+    for i, index in enumerate(rng.choice(width * height, max(1, width * height // door_every), replace=False)):
+        y, x = divmod(int(index), width)
+        doors.append(f'  <object id="{i + 1}" name="door_{i}" type="door" x="{x * 16}" y="{y * 16}" width="16" height="16"/>\n')
+
+    path = os.path.join(directory, f'synthetic_{width}x{height}.tmx')
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<map version="1.10" orientation="orthogonal" renderorder="right-down" width="{width}" height="{height}" '
+                f'tilewidth="16" tileheight="16" infinite="0" nextlayerid="5" nextobjectid="{len(doors) + 1}">\n')
+        f.write(f' <tileset firstgid="1" source="{tileset or TILESET}"/>\n')
+        f.write(layer(1, 'Ground', ground))
+        f.write(layer(2, 'Objects', objects))
+        f.write(layer(3, 'Foreground', foreground))
+        f.write(' <objectgroup id="4" name="Doors">\n' + ''.join(doors) + ' </objectgroup>\n')
+        f.write('</map>\n')
+    return path
+
+def bench_startup(screen, repeat):
+    def run():
+        utils.assets.clear()
+        g = game.Game(screen)
+        # every game starts its own loader and streaming threads
+        g.close()
+    return measure(run, repeat)
+
+def bench_map_load(path, repeat):
+    """Times parsing the TMX with pytmx, and loading the compiled bundle of the same map."""
+    results = {'map_load': measure(lambda: pytmx.load_pygame(path), repeat)}
+    mapcache.load_map(path)
+    results['map_load_cached'] = measure(lambda: mapcache.load_map(path), repeat)
+    return results
+
+def bench_layers(g, repeat):
+    """Times each World.draw_* call for the camera's view, with the chunk cache warm and cold."""
+    camera, world = g.camera, g.world
+    camera.update()
+    view = (int(camera.x), int(camera.y), camera.vw, camera.vh)
+    buffer = pygame.Surface((camera.vw, camera.vh))
+    results = {}
+    for name, draw in (('ground', world.draw_ground), ('objects', world.draw_objects),
+                       ('entities', world.draw_entities), ('foreground', world.draw_foreground)):
+        draw(buffer, view)
+        results[f'draw_{name}'] = measure(lambda: draw(buffer, view), repeat)
+
+    def clear_chunks():
+        for caches in world.layer_caches.values():
+            for cache in caches.values():
+                cache.clear()
+    results['draw_layers_cold'] = measure(lambda: [world.draw_ground(buffer, view), world.draw_objects(buffer, view),
+                                                   world.draw_foreground(buffer, view)], repeat, setup=clear_chunks)
+    return results
+
+def bench_frame(g, screen, repeat):
+    """Times a full redraw of the screen, and an idle frame where nothing changed."""
+    camera = g.camera
+    def full():
+        camera.full_redraw = True
+        camera.update()
+        camera.draw(screen)
+    results = {'frame_full': measure(full, repeat)}
+    camera.draw(screen)
+    results['frame_idle'] = measure(lambda: g.render(1.0), repeat)
+    results['frame_step_and_render'] = measure(g.play, repeat)
+    return results
+
+def bench_collision(world, queries, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = np.stack([rng.integers(0, world.width, queries), rng.integers(0, world.height, queries)], axis=1)
+    directions = rng.integers(0, len(game.DIRECTIONS), queries)
+    pairs = positions.tolist()
+    def single():
+        for x, y in pairs:
+            world.will_collide(x, y)
+    return {
+        'will_collide': dict(measure(single, 3), queries=queries),
+        'can_move_many': dict(measure(lambda: world.can_move_many(positions, directions), 10), queries=queries),
+    }
+
+def bench_sprite_slicing(repeat):
+    results = {}
+    for name, path, rows, cols in (('door_anims', 'tiled/door_anims.png', 7, 4), ('player', 'tiled/man.png', 3, 4)):
+        def run():
+            utils.assets.release(path)
+            utils.SpriteSheet(path).grid_split(rows, cols)
+        results[f'slice_{name}'] = measure(run, repeat)
+        sheet = utils.SpriteSheet(path)
+        results[f'slice_{name}_array'] = measure(lambda: sheet.grid_array(rows, cols), repeat)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(sizes, repeat, queries):
+    os.chdir(REPO)
+    screen = game.init_headless()
+    results = []
+
+    def add(name, stats, size=None):
+        results.append(dict(name=name, size=size, **stats))
+        print(f"{name:24} {size or '':>10} median {stats['median_ms']:9.3f} ms   min {stats['min_ms']:9.3f} ms")
+
+    add('startup', bench_startup(screen, max(1, repeat // 10)))
+    for name, stats in bench_sprite_slicing(repeat).items():
+        add(name, stats)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for width, height in sizes:
+            size = f'{width}x{height}'
+            path = write_synthetic_map(directory, width, height)
+            for name, stats in bench_map_load(path, max(1, repeat // 10)).items():
+                add(name, stats, size)
+            g = game.Game(screen, map_path=path)
+            try:
+                for name, stats in bench_layers(g, repeat).items():
+                    add(name, stats, size)
+                for name, stats in bench_frame(g, screen, repeat).items():
+                    add(name, stats, size)
+                for name, stats in bench_collision(g.world, queries).items():
+                    add(name, stats, size)
+            finally:
+                g.close()
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'platform': platform.platform(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+def parse_sizes(text):
+    return [tuple(int(n) for n in size.split('x')) for size in text.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the performance benchmarks headless and write the results as JSON.')
+    parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes('70x40,256x256,1000x1000'),
+                        help='comma separated map sizes in tiles, e.g. 70x40,1000x1000')
+    parser.add_argument('--repeat', type=int, default=30, help='runs per benchmark')
+    parser.add_argument('--queries', type=int, default=100000, help='collision queries per collision benchmark')
+    parser.add_argument('--out', default='bench.json', help='where to write the JSON results')
+    args = parser.parse_args()
+    report = run(args.sizes, args.repeat, args.queries)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(report['results'])} results to {args.out}")
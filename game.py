@@ -1,14 +1,47 @@
+from collections import OrderedDict
+import argparse
+import gc
+import os
+import time
 import pygame
 from pygame.locals import *
 from pygame.math import Vector2
-import pytmx
+import numpy as np
+import animation
+import loader
+import mapcache
+import memory
+import minimap
+import network
+import profiler
+import recording
+import savegame
+import streaming
 import utils 
 
+# sprite sheets the game can't start without, decoded in the background while the loading screen shows
+SPRITE_SHEETS = ('tiled/door_anims.png', 'tiled/man.png')
+
+DIRECTIONS = ('UP', 'DOWN', 'LEFT', 'RIGHT')
+# (dx, dy) for each entry of DIRECTIONS, so directions can be passed around as small integers
+DIRECTION_OFFSETS = np.array([(0, -1), (0, 1), (-1, 0), (1, 0)], dtype=np.intp)
+
 class Door(pygame.sprite.Sprite):
-    def __init__(self, x, y, world):
+    # milliseconds each frame of the door animation is shown
+    frame_ms = 1000 / 30
+    # saves and multiplayer snapshots store a door's state as an index into this, only ever append to it
+    STATES = ('CLOSED', 'OPENING', 'OPEN', 'CLOSING')
+
+    def __init__(self, x, y, world, properties=None):
+        """
+            A door on the Doors layer. 
+            properties: the Tiled object's properties. A door with a 'warp' property leads to that map 
+                (relative to this one), the player arrives on tile ('warp_x', 'warp_y').
+        """
         super().__init__()
         self.state = 'CLOSED'
         self.anim_frame = 0
+        self.scheduled = False
         self.world = world
         self.sprites = utils.load_door_sprites()
         self.image = self.sprites[0]
@@ -17,6 +50,10 @@ class Door(pygame.sprite.Sprite):
         self.rect.y = y
         self.rect.width = self.image.get_width()
         self.rect.height = self.image.get_height()
+        self.tile = (int(x // world.tilesize), int(y // world.tilesize))
+        properties = properties or {}
+        self.warp = properties.get('warp')
+        self.warp_tile = (int(properties.get('warp_x', 0)), int(properties.get('warp_y', 0)))
         print(f"Door created at {x}, {y} with size {self.rect.width}, {self.rect.height}")
 
     def toggle(self): 
@@ -36,8 +73,9 @@ class Door(pygame.sprite.Sprite):
             - If the door is closed, it will start opening.
         """
         if self.state == 'CLOSED':
-            self.state = 'OPENING'
+            self.set_state('OPENING')
             self.anim_frame = 0
+            self.world.animator.start(self, self.frame_ms)
         else:
             print(f"Door cannot be opened from {self.state} state")
     
@@ -46,31 +84,186 @@ class Door(pygame.sprite.Sprite):
             - If the door is open, it will start closing.
         """
         if self.state == 'OPEN':
-            self.state = 'CLOSING'
+            self.set_state('CLOSING')
+            self.world.animator.start(self, self.frame_ms)
         else: 
             print(f"Door cannot be closed from {self.state} state")
 
     def is_open(self):
         return self.state == 'OPEN'
+
+    def set_state(self, state):
+        """Changes the door state and lets the world know, since it may change what is passable."""
+        self.state = state
+        self.world.door_changed(self)
     
     def view(self):
         return self.sprites[self.anim_frame]
         
-    def update(self):
+    def advance(self, rects):
+        """Advances the door animation by one frame, called by the world's animator while the door moves.
+            rects: the door's rect is appended to it
+            Returns the milliseconds until the next frame, or None once the door is fully open or closed.
+        """
         if self.state == 'OPENING':
             self.anim_frame += 1
+            rects.append(self.rect.copy())
             if self.anim_frame == len(self.sprites) - 1:
-                self.state = 'OPEN'
+                self.set_state('OPEN')
+                return None
+            return self.frame_ms
         elif self.state == 'CLOSING':
             self.anim_frame -= 1
+            rects.append(self.rect.copy())
             if self.anim_frame == 0:
-                self.state = 'CLOSED'
+                self.set_state('CLOSED')
+                return None
+            return self.frame_ms
+        return None
+
+class ChunkCache:
+    def __init__(self, world, layer, chunk_size=16, max_bytes=16 * 1024 * 1024, scale=1):
+        """
+            Caches a static tile layer as fixed-size chunks of pre-rendered tiles. 
+            Chunks are baked lazily the first time they are drawn and the least recently used 
+            ones are evicted once they take more than max_bytes, so memory is bounded by the 
+            cache rather than by the size of the world or the scale.
+            world: the world object
+            layer: pytmx.TiledTileLayer to render
+            chunk_size: width and height of a chunk in tiles
+            max_bytes: bytes of chunk surfaces kept alive, the chunk drawn last is always kept
+            scale: the chunks are baked from tiles pre-scaled by this factor, so they can be 
+                blitted straight to the screen
+        """
+        self.world = world
+        self.layer = layer
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.scale = scale
+        self.tile_pixels = int(world.tilesize * scale)
+        self.chunk_pixels = chunk_size * self.tile_pixels
+        self.chunks = OrderedDict()
+        # bytes of the surfaces in chunks
+        self.bytes = 0
+
+    def tile_range(self, view):
+        """Returns (x0, y0, x1, y1), the tiles overlapping the pixel rect view, clamped to the world."""
+        ts = self.world.tilesize
+        x, y, w, h = view
+        return (max(int(x // ts), 0), max(int(y // ts), 0),
+                min(int(-(-(x + w) // ts)), self.world.width), min(int(-(-(y + h) // ts)), self.world.height))
+
+    def draw_tiles(self, surface, x0, y0, x1, y1, cx, cy, clip=None):
+        """Blits every tile covering tiles x0 to x1 and y0 to y1 (exclusive) to surface, which holds chunk (cx, cy).
+            Images larger than a tile spill into the tiles right of and below theirs (see World.overflow), 
+            so the tiles that far above and left are drawn too, row by row like the whole layer would be, 
+            and they overlap the same way whichever chunk they end up in.
+            clip: rect of surface outside of which nothing is drawn. The chunks are RLE accelerated, and
+                SDL doesn't reliably keep to a surface's clip rect once it has been RLE encoded.
+        """
+        ts = self.tile_pixels
+        mx, my = self.world.overflow
+        ox, oy = cx * self.chunk_size, cy * self.chunk_size
+        blits = []
+        for y in range(max(y0 - my, 0), y1):
+            row = self.layer.data[y]
+            for x in range(max(x0 - mx, 0), x1):
+                tile = self.world.tile_image(row[x], self.scale)
+                if not tile:
+                    continue
+                position = ((x - ox) * ts, (y - oy) * ts)
+                if clip is None:
+                    blits.append((tile, position))
+                else:
+                    area = clip.clip(tile.get_rect(topleft=position))
+                    if area:
+                        blits.append((tile, area.topleft, area.move(-position[0], -position[1])))
+        surface.blits(blits, doreturn=False)
+
+    def bake_chunk(self, cx, cy):
+        """Renders the tiles of chunk (cx, cy) into a surface colorkeyed on black."""
+        ts = self.tile_pixels
+        x0, y0 = cx * self.chunk_size, cy * self.chunk_size
+        x1 = min(x0 + self.chunk_size, self.world.width)
+        y1 = min(y0 + self.chunk_size, self.world.height)
+        surface = pygame.Surface(((x1 - x0) * ts, (y1 - y0) * ts))
+        surface.fill((0, 0, 0))
+        self.draw_tiles(surface, x0, y0, x1, y1, cx, cy)
+        surface.set_colorkey((0, 0, 0), pygame.RLEACCEL)
+        return surface
+
+    def chunk(self, cx, cy):
+        """Returns the surface for chunk (cx, cy), baking it and evicting old chunks if needed."""
+        key = (cx, cy)
+        surface = self.chunks.get(key)
+        if surface is None:
+            surface = self.chunks[key] = self.bake_chunk(cx, cy)
+            self.bytes += utils.surface_bytes(surface)
+            if self.bytes > self.max_bytes:
+                self.evict(self.bytes - self.max_bytes, keep=1)
+        else:
+            self.chunks.move_to_end(key)
+        return surface
+
+    def evict(self, nbytes, keep=0, view=None):
+        """Drops the least recently used chunks until nbytes are freed or only keep chunks are left.
+            view: pixel rect in unscaled world pixels whose chunks are kept, they would be baked again 
+                on the next frame
+            Returns the bytes freed.
+        """
+        protected = set(self.chunks_in(view)) if view is not None else ()
+        freed = 0
+        for key in list(self.chunks):
+            if freed >= nbytes or len(self.chunks) <= keep:
+                break
+            if key not in protected:
+                freed += utils.surface_bytes(self.chunks.pop(key))
+        self.bytes -= freed
+        return freed
+
+    def chunks_in(self, view):
+        """Returns the list of (cx, cy) chunks overlapping the pixel rect view."""
+        return self.world.chunks_in(view)
+
+    def clear(self):
+        """Drops every chunk. Returns the bytes freed."""
+        return self.evict(self.bytes)
+
+    def invalidate_tile(self, x, y):
+        """Redraws the pixels tile (x, y) covers in the cached chunks, the others pick it up when they are baked."""
+        mx, my = self.world.overflow
+        x1, y1 = min(x + mx + 1, self.world.width), min(y + my + 1, self.world.height)
+        ts, cs = self.tile_pixels, self.chunk_size
+        for cy in range(y // cs, (y1 - 1) // cs + 1):
+            for cx in range(x // cs, (x1 - 1) // cs + 1):
+                surface = self.chunks.get((cx, cy))
+                if surface is None:
+                    continue
+                rect = pygame.Rect((x - cx * cs) * ts, (y - cy * cs) * ts, (x1 - x) * ts, (y1 - y) * ts)
+                surface.fill((0, 0, 0), rect)
+                self.draw_tiles(surface, x, y, x1, y1, cx, cy, rect)
+
+    def draw(self, surface, view):
+        """Blits the chunks overlapping the pixel rect view, offset so that view's origin lands on (0, 0).
+            view is in unscaled world pixels.
+        """
+        vx, vy = round(view[0] * self.scale), round(view[1] * self.scale)
+        x0, y0, x1, y1 = self.tile_range(view)
+        if x0 >= x1 or y0 >= y1:
+            return
+        cs = self.chunk_size
+        for cy in range(y0 // cs, (y1 - 1) // cs + 1):
+            for cx in range(x0 // cs, (x1 - 1) // cs + 1):
+                surface.blit(self.chunk(cx, cy), (cx * self.chunk_pixels - vx, cy * self.chunk_pixels - vy))
 
 class World: 
-    def __init__(self, tiled_map):
+    def __init__(self, tiled_map, chunk_size=16, max_chunk_bytes=48 * 1024 * 1024, max_scales=2):
         """
         Represents the game world. 
         tiled_map: pytmx.TiledMap, the Tiled map data 
+        chunk_size: width and height in tiles of the cached render chunks
+        max_chunk_bytes: bytes of cached chunks kept for the three static layers at one scale
+        max_scales: number of zoom levels chunks are kept cached for
         """
         self.tiled_map = tiled_map
         self.tilesize = tiled_map.tilewidth
@@ -79,11 +272,102 @@ class World:
         self.ground = self.tiled_map.get_layer_by_name('Ground')
         self.foreground = self.tiled_map.get_layer_by_name('Foreground')
         self.objects = self.tiled_map.get_layer_by_name('Objects')
-        self.doors = {(d.x // self.tilesize, d.y // self.tilesize): Door(d.x, d.y, self) for d in self.tiled_map.get_layer_by_name('Doors')}
+        # doors and animated tiles register with the animator only while they are moving
+        self.animator = animation.Animator()
+        doors = [Door(d.x, d.y, self, d.properties) for d in self.tiled_map.get_layer_by_name('Doors')]
+        self.doors = {door.tile: door for door in doors}
+        # every tile used by the map is colorkeyed and deduplicated once up front, see convert
+        self.tiles = utils.PreparedTiles(tiled_map)
+        for layer in (self.ground, self.objects, self.foreground):
+            self.tiles.prepare(np.unique(np.asarray(layer.data, dtype=np.uint32)))
+        # gid -> the gid of the frame it currently shows, for animated tiles
+        self.tile_frames = {}
+        self.tile_animations = {}
+        self.chunk_size = chunk_size
+        self.load_tile_animations()
+        # chunk (cx, cy) -> the doors overlapping it, so drawing only looks at the doors near the view
+        self.door_chunks = {}
+        for door in self.doors.values():
+            for key in self.chunks_in(door.rect):
+                self.door_chunks.setdefault(key, []).append(door)
+        # the static layers never change between frames, so they are baked into chunk surfaces 
+        # on demand and only the tiles touched by set_tile are redrawn
+        # pixel rects that changed since the camera last drew, see pop_dirty_rects
+        self.dirty_rects = []
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_scales = max_scales
+        # scale -> {layer name: ChunkCache}, see chunk_caches
+        self.layer_caches = OrderedDict()
+        # (x, y) tiles that the largest image spills past its own tile to the right and below
+        self.overflow = (0, 0)
+        for tile in self.tiles.by_gid.values():
+            self.fit_overflow(tile)
+        # passable[y, x] is True where nothing blocks the tile, kept in sync with the Objects layer 
+        # and the doors. collision_version is bumped whenever a cell changes.
+        self.collision_version = 0
+        self.collision_listeners = []
+        # functions called with (x, y) whenever what tile (x, y) shows changes, through set_tile or a door
+        self.tile_listeners = []
+        self.build_passability()
+        # entities other than the player, indexed by tile. npcs is set by the NPCs system.
+        self.entities = utils.SpatialHash()
+        self.npcs = None
 
-    def update(self):
+    def update(self, dt=Door.frame_ms):
+        """Advances the animations by dt milliseconds."""
+        self.dirty_rects.extend(self.animator.update(dt))
+
+    def load_tile_animations(self):
+        """Creates a TileAnimation for every tile with Tiled animation frames and starts those the map uses."""
+        for gid, properties in self.tiled_map.tile_properties.items():
+            frames = properties.get('frames')
+            if frames and len(frames) > 1:
+                self.tile_animations[gid] = animation.TileAnimation(self, gid, frames)
+                self.tiles.prepare(frame_gid for frame_gid, _ in frames)
+        if not self.tile_animations:
+            return
+        gids = np.array(list(self.tile_animations), dtype=np.uint32)
+        for layer in (self.ground, self.objects, self.foreground):
+            data = np.asarray(layer.data, dtype=np.uint32)
+            for y, x in np.argwhere(np.isin(data, gids)).tolist():
+                self.tile_animations[int(data[y, x])].add(layer.name, x, y)
+        for tile_animation in self.tile_animations.values():
+            tile_animation.start()
+
+    def pop_dirty_rects(self):
+        """Returns the pixel rects of the world that changed since the last call, and forgets them."""
+        if not self.dirty_rects:
+            return ()
+        rects = self.dirty_rects
+        self.dirty_rects = []
+        return rects
+        
+    def build_passability(self):
+        """Builds the passability grid from the Objects layer and the current door states."""
+        self.passable = np.array(self.objects.data, dtype=np.uint32).reshape(self.height, self.width) == 0
         for door in self.doors.values():
-            door.update()
+            x, y = door.tile
+            self.passable[y, x] &= door.is_open()
+        self.collision_version += 1
+
+    def set_passable(self, x, y, passable):
+        """Updates a single cell of the passability grid, bumping collision_version if it changed.
+            Every function in collision_listeners is then called with (x, y, passable).
+        """
+        # the Objects layer check gives a numpy.bool_, listeners expect a plain bool
+        passable = bool(passable)
+        if self.passable[y, x] != passable:
+            self.passable[y, x] = passable
+            self.collision_version += 1
+            for listener in self.collision_listeners:
+                listener(x, y, passable)
+
+    def door_changed(self, door):
+        """Called by a door whenever its state changes."""
+        x, y = door.tile
+        self.set_passable(x, y, door.is_open() and self.objects.data[y][x] == 0)
+        for listener in self.tile_listeners:
+            listener(x, y)
         
     def will_collide(self, x,y): 
         """
@@ -91,53 +375,235 @@ class World:
         """
         if x < 0 or x >= self.width or y < 0 or y >= self.height:
             return True
-        if self.objects.data[y][x] != 0:
-            return True
-        if (x,y) in self.doors and not self.doors[(x,y)].is_open():
-            return True
-        return False
+        return not self.passable[y, x]
+
+    def entities_at(self, x, y):
+        """Returns the set of ids of the entities standing on (or walking into) tile (x, y)."""
+        return self.entities.at((x, y))
+
+    def entities_near(self, x, y, radius=1):
+        """Returns the ids of the entities at most radius tiles away from (x, y)."""
+        return self.entities.near((x, y), radius)
+
+    def passable_many(self, xs, ys):
+        """
+            Vectorized version of will_collide, negated. 
+            xs, ys: integer arrays of tile coordinates with the same shape
+            Returns a bool array, True where the tile is inside the world and can be walked on.
+        """
+        xs = np.asarray(xs, dtype=np.intp)
+        ys = np.asarray(ys, dtype=np.intp)
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        result = np.zeros(xs.shape, dtype=bool)
+        result[inside] = self.passable[ys[inside], xs[inside]]
+        return result
+
+    def can_move_many(self, positions, directions):
+        """
+            Answers many one-tile move queries in one call. 
+            positions: (N, 2) integer array of (x, y) tile coordinates
+            directions: N directions, either indices into DIRECTIONS or direction names like 'UP'
+            Returns a bool array of length N, True where the move is possible.
+        """
+        positions = np.asarray(positions, dtype=np.intp).reshape(-1, 2)
+        if not len(positions):
+            return np.zeros(0, dtype=bool)
+        directions = np.asarray(directions)
+        if directions.dtype.kind in 'US':
+            directions = np.array([DIRECTIONS.index(d) for d in directions], dtype=np.intp)
+        else:
+            directions = directions.astype(np.intp, copy=False)
+        targets = positions + DIRECTION_OFFSETS[directions]
+        return self.passable_many(targets[:, 0], targets[:, 1])
+
+    def fit_overflow(self, tile):
+        """Grows overflow to fit tile, dropping the cached chunks if it grew. Returns True if it did."""
+        if tile is None:
+            return False
+        ts = self.tilesize
+        mx, my = self.overflow
+        overflow = (max(mx, (tile.get_width() - 1) // ts), max(my, (tile.get_height() - 1) // ts))
+        if overflow == self.overflow:
+            return False
+        self.overflow = overflow
+        self.layer_caches.clear()
+        return True
+
+    def tile_rect(self, x, y):
+        """Returns the pixel rect a change of tile (x, y) may redraw, including what its image spills over."""
+        mx, my = self.overflow
+        ts = self.tilesize
+        return pygame.Rect(x * ts, y * ts, (mx + 1) * ts, (my + 1) * ts)
+
+    def chunks_in(self, view):
+        """Returns the list of (cx, cy) render chunks overlapping the pixel rect view, in unscaled world pixels."""
+        ts, cs = self.tilesize, self.chunk_size
+        x, y, w, h = view
+        x0, y0 = max(int(x // ts), 0), max(int(y // ts), 0)
+        x1, y1 = min(int(-(-(x + w) // ts)), self.width), min(int(-(-(y + h) // ts)), self.height)
+        if x0 >= x1 or y0 >= y1:
+            return []
+        return [(cx, cy) for cy in range(y0 // cs, (y1 - 1) // cs + 1) for cx in range(x0 // cs, (x1 - 1) // cs + 1)]
+
+    def tile_image(self, gid, scale=1):
+        """Returns the prepared image for the given gid scaled by scale, or None for empty tiles."""
+        tile = self.tiles.get(self.tile_frames.get(gid, gid))
+        if tile and scale != 1:
+            tile = utils.scaled_surfaces.get(tile, scale)
+        return tile
+
+    def chunk_caches(self, scale):
+        """Returns the {layer name: ChunkCache} of the static layers at the given scale. 
+            Only the max_scales most recently used scales are kept.
+        """
+        caches = self.layer_caches.get(scale)
+        if caches is None:
+            caches = self.layer_caches[scale] = {layer.name: ChunkCache(self, layer, self.chunk_size, self.max_chunk_bytes // 3, scale) 
+                                                 for layer in (self.ground, self.objects, self.foreground)}
+            if len(self.layer_caches) > self.max_scales:
+                self.layer_caches.popitem(last=False)
+        else:
+            self.layer_caches.move_to_end(scale)
+        return caches
+
+    def set_tile(self, layer_name, x, y, gid):
+        """Replaces a single tile and redraws only that tile in the cached chunks.
+            layer_name: 'Ground', 'Objects' or 'Foreground'
+            gid: the new tile gid, 0 clears the tile
+        """
+        layer = self.tiled_map.get_layer_by_name(layer_name)
+        old = self.tile_animations.get(layer.data[y][x])
+        if old is not None:
+            old.remove(layer_name, x, y)
+        layer.data[y][x] = gid
+        new = self.tile_animations.get(gid)
+        if new is not None:
+            new.add(layer_name, x, y)
+            new.start()
+        if self.fit_overflow(self.tiles.get(gid)):
+            self.dirty_rects.append(pygame.Rect(self.full_view()))
+        for caches in self.layer_caches.values():
+            caches[layer_name].invalidate_tile(x, y)
+        if layer is self.objects:
+            door = self.doors.get((x, y))
+            self.set_passable(x, y, gid == 0 and (door is None or door.is_open()))
+        self.dirty_rects.append(self.tile_rect(x, y))
+        for listener in self.tile_listeners:
+            listener(x, y)
+
+    def release(self):
+        """
+            Breaks the references the doors, NPCs, animated tiles and chunk caches hold back to the world, 
+            called once it has been evicted. Game.mainloop freezes the garbage collector, so a world kept alive 
+            by reference cycles would never be freed.
+        """
+        for door in self.doors.values():
+            door.world = None
+        for tile_animation in self.tile_animations.values():
+            tile_animation.world = None
+        if self.npcs is not None:
+            self.npcs.world = None
+            self.npcs = None
+        self.layer_caches.clear()
+        self.collision_listeners.clear()
+        self.tile_listeners.clear()
+
+    def convert(self):
+        """Converts the world's tiles to the display format, called on the main thread once the world is loaded."""
+        self.tiles.convert()
+
+    def memory_bytes(self):
+        """Returns a rough estimate of the bytes held by the world's grids, prepared tiles and cached chunks."""
+        return self.passable.nbytes + 3 * self.width * self.height * 4 + self.tiles.prepared_bytes + self.chunk_bytes()
+
+    def chunk_bytes(self):
+        """Returns the bytes of the cached chunk surfaces, at every scale."""
+        return sum(cache.bytes for caches in self.layer_caches.values() for cache in caches.values())
+
+    def trim_chunks(self, nbytes, view=None):
+        """Frees at least nbytes of cached chunks if there are that many, the chunks of scales other 
+            than the last one drawn go first, then the least recently used chunks of each layer. 
+            view: pixel rect whose chunks at the last scale drawn are never dropped, see Camera.view_rect
+            Returns the bytes freed.
+        """
+        freed = 0
+        while freed < nbytes and len(self.layer_caches) > 1:
+            _, caches = self.layer_caches.popitem(last=False)
+            freed += sum(cache.bytes for cache in caches.values())
+        if self.layer_caches:
+            caches = sorted(next(reversed(self.layer_caches.values())).values(), key=lambda cache: -cache.bytes)
+            for i, cache in enumerate(caches):
+                if freed >= nbytes:
+                    break
+                # spread what is left over the layers still to trim
+                freed += cache.evict(-(-(nbytes - freed) // (len(caches) - i)), view=view)
+        return freed
+
+    def release_chunks(self):
+        """Drops every cached chunk, they are baked again when drawn. Returns the bytes freed."""
+        freed = self.chunk_bytes()
+        self.layer_caches.clear()
+        return freed
+
+    def full_view(self):
+        """Returns the pixel rect covering the whole world."""
+        return (0, 0, self.width * self.tilesize, self.height * self.tilesize)
     
-    def draw_ground(self, surface, debug=False):
+    def draw_ground(self, surface, view=None, debug=False, scale=1):
         """Blits the ground layer to the surface.
-            surface: pygame.Surface, must be (self.width * self.tilesize, self.height * self.tilesize)
+            view: (x, y, w, h) pixel rect of the world that maps onto the surface's origin, 
+                defaults to the whole world
+            scale: how many surface pixels a world pixel takes up
         """
-        for x, y, gid, in self.ground:
-            tile = self.tiled_map.get_tile_image_by_gid(gid)
-            if tile: 
-                tile.set_colorkey((0, 0, 0))
-                surface.blit(tile, (x * self.tilesize, y * self.tilesize))
+        self.chunk_caches(scale)['Ground'].draw(surface, view or self.full_view())
         return surface 
     
-    def draw_objects(self, surface: pygame.Surface, debug=False):
-        """Blits the objects layer to the surface.
-            surface: pygame.Surface, must be (self.width * self.tilesize, self.height * self.tilesize)
-        """
-        for x, y, gid, in self.objects:
-            tile = self.tiled_map.get_tile_image_by_gid(gid)
-            if tile: 
-                tile.set_colorkey((0, 0, 0))
-                surface.blit(tile, (x * self.tilesize, y*self.tilesize))
-                if debug: 
-                    # create a red rectangle around the object
-                    rect = pygame.Rect(x * self.tilesize, y * self.tilesize, self.tilesize, self.tilesize)
-                    # draw the outline of the rect in red on the surface 
-                    pygame.draw.rect(surface, (255, 0, 0), rect, 1)
+    def draw_objects(self, surface: pygame.Surface, view=None, debug=False, scale=1):
+        """Blits the objects layer and the doors to the surface.
+            view: (x, y, w, h) pixel rect of the world that maps onto the surface's origin, 
+                defaults to the whole world
+            scale: how many surface pixels a world pixel takes up
+        """
+        view = pygame.Rect(view or self.full_view())
+        cache = self.chunk_caches(scale)['Objects']
+        cache.draw(surface, view)
+        ts = cache.tile_pixels
+        vx, vy = round(view.x * scale), round(view.y * scale)
+        if debug: 
+            x0, y0, x1, y1 = cache.tile_range(view)
+            for y in range(y0, y1):
+                for x in range(x0, x1):
+                    if self.objects.data[y][x]:
+                        # create a red rectangle around the object
+                        rect = pygame.Rect(x * ts - vx, y * ts - vy, ts, ts)
+                        # draw the outline of the rect in red on the surface, one world pixel wide
+                        pygame.draw.rect(surface, (255, 0, 0), rect, max(1, int(scale)))
         
-        for door in self.doors.values():
-            surface.blit(door.view(), door.rect)
+        # a door overlapping several chunks is listed in each of them
+        doors = dict.fromkeys(door for key in self.chunks_in(view) for door in self.door_chunks.get(key, ()))
+        for door in doors:
+            if view.colliderect(door.rect):
+                surface.blit(utils.scaled_surfaces.get(door.view(), scale), (round(door.rect.x * scale) - vx, round(door.rect.y * scale) - vy))
         
         return surface
     
-    def draw_foreground(self, surface: pygame.Surface, debug=False): 
+    def draw_entities(self, surface: pygame.Surface, view=None, debug=False, scale=1):
+        """Blits the NPCs inside the view to the surface.
+            view: (x, y, w, h) pixel rect of the world that maps onto the surface's origin, 
+                defaults to the whole world
+            scale: how many surface pixels a world pixel takes up
+        """
+        if self.npcs is not None:
+            self.npcs.draw(surface, view or self.full_view(), scale)
+        return surface
+
+    def draw_foreground(self, surface: pygame.Surface, view=None, debug=False, scale=1): 
         """Blits the foreground layer to the surface.
-            surface: pygame.Surface, must be (self.width * self.tilesize, self.height * self.tilesize)
-        """
-        for x, y, gid, in self.foreground:
-            tile = self.tiled_map.get_tile_image_by_gid(gid)
-            if tile: 
-                tile.set_colorkey((0, 0, 0))
-                surface.blit(tile, (x * self.tilesize, y*self.tilesize))
-                rect = pygame.Rect(x * self.tilesize, y * self.tilesize, self.tilesize, self.tilesize)
+            view: (x, y, w, h) pixel rect of the world that maps onto the surface's origin, 
+                defaults to the whole world
+            scale: how many surface pixels a world pixel takes up
+        """
+        self.chunk_caches(scale)['Foreground'].draw(surface, view or self.full_view())
         return surface
 
 class Player(pygame.sprite.Sprite): 
@@ -161,36 +627,37 @@ class Player(pygame.sprite.Sprite):
         self.direction = 'DOWN'
         self.anim_frame = 0
         self.speed = 1 # 1 tile per move 
+        self.moves = {
+                'UP': (0, -self.speed),
+                'DOWN': (0, self.speed),
+                'LEFT': (-self.speed, 0),
+                'RIGHT': (self.speed, 0),
+            }
         self.image = self.sprites[self.direction][self.anim_frame]
         self.rect = self.image.get_rect()
+        # where rect was before the last update, used to interpolate between simulation steps
+        self.prev_pos = self.rect.topleft
         self.tick = 0
         
     def movemap(self, direction):
         """
             Returns the x and y offset for the given direction.
         """
-        mmap = {
-                'UP': (0, -self.speed),
-                'DOWN': (0, self.speed),
-                'LEFT': (-self.speed, 0),
-                'RIGHT': (self.speed, 0),
-            }
-        return mmap[direction]
+        return self.moves[direction]
 
     def update(self, actions): 
         """
             The update function is called every frame. 
             actions: a dictionary of actions that the player has taken.
-             Example: {'direction': 'UP'}
+             Example: {'direction': 'UP', 'action': 'SPACE'}
         """
         self.tick += 1
+        self.prev_pos = self.rect.topleft
 
         ax,ay = self.movemap(self.direction)
         if (self.x+ax, self.y+ay) in self.world.doors:
-            print(self.world.doors[(self.x+ax, self.y+ay)])
-            # if key 'SPACE' is pressed, open the door
-            # use pygame key constants for this
-            if pygame.key.get_pressed()[pygame.K_SPACE]:
+            # if 'SPACE' is pressed, open the door
+            if actions['action'] == 'SPACE':
                 self.world.doors[(self.x+ax, self.y+ay)].toggle()
                 return
             
@@ -198,7 +665,7 @@ class Player(pygame.sprite.Sprite):
         if self.state == 'IDLE': 
             if actions['direction'] == self.direction:
                 dx,dy = self.movemap(actions['direction'])
-                if self.world.will_collide(self.x+dx, self.y+dy):
+                if self.world.will_collide(self.x+dx, self.y+dy) or self.world.entities_at(self.x+dx, self.y+dy):
                     return
             
                 # enter the walk state
@@ -225,19 +692,249 @@ class Player(pygame.sprite.Sprite):
         
         self.image = self.sprites[self.direction][self.anim_frame] 
     
+    def place(self, world, x, y):
+        """Puts the player, standing still, on tile (x, y) of world."""
+        self.world = world
+        self.x = x
+        self.y = y
+        self.state = 'IDLE'
+        self.anim_frame = 0
+        self.image = self.sprites[self.direction][self.anim_frame]
+        self.rect.topleft = (x * world.tilesize, y * world.tilesize)
+        self.prev_pos = self.rect.topleft
+
+    def render_pos(self, alpha):
+        """
+            Returns the pixel position to draw the player at, alpha of the way between the position 
+            before the last update and the current one.
+        """
+        (x0, y0), (x1, y1) = self.prev_pos, self.rect.topleft
+        return round(x0 + (x1 - x0) * alpha), round(y0 + (y1 - y0) * alpha)
+
     def view(self):
         # print(f"Player view: {self.direction}, {self.anim_frame}")
         return self.sprites[self.direction][self.anim_frame]
         
 
+class NPCs: 
+    IDLE = 0
+    WALK = 1
+
+    def __init__(self, world: World, sprites, capacity=64, wander_chance=0.05, seed=0):
+        """
+            All the non player characters of a world. 
+            They walk tile by tile exactly like the Player does, but their state is kept in numpy 
+            arrays indexed by NPC id so thousands of them can be updated with a few array operations.
+            Every NPC is also indexed by tile in world.entities.
+            world: the world object, its npcs attribute is set to this object
+            sprites: a dictionary of sprites like the one the Player takes, shared by every NPC
+            capacity: initial size of the arrays, they grow as NPCs are spawned
+            wander_chance: chance per tick that an idle NPC tries to walk in a random direction
+            seed: seed for the random number generator, so NPCs wander the same way every run
+        """
+        self.world = world
+        self.frames = [sprites[direction] for direction in DIRECTIONS]
+        self.sprite_w, self.sprite_h = self.frames[0][0].get_size()
+        self.wander_chance = wander_chance
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.tick = 0
+        # tile position, updated once the NPC has finished walking onto the next tile
+        self.x = np.zeros(capacity, dtype=np.int32)
+        self.y = np.zeros(capacity, dtype=np.int32)
+        # pixel position of the top left of the tile the NPC is drawn on, like Player.rect
+        self.px = np.zeros(capacity, dtype=np.int32)
+        self.py = np.zeros(capacity, dtype=np.int32)
+        # index into DIRECTIONS
+        self.direction = np.ones(capacity, dtype=np.int8)
+        self.anim_frame = np.zeros(capacity, dtype=np.int8)
+        self.state = np.zeros(capacity, dtype=np.int8)
+        # pixel positions whose sprites have to be redrawn, see pop_dirty_rects
+        self.dirty = []
+        world.npcs = self
+
+    def grow(self):
+        for name in ('x', 'y', 'px', 'py', 'direction', 'anim_frame', 'state'):
+            array = getattr(self, name)
+            grown = np.zeros(len(array) * 2, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def spawn(self, x, y, direction='DOWN'):
+        """
+            Adds an NPC standing on tile (x, y). 
+            Returns the id of the new NPC, or None if the tile is blocked or taken.
+        """
+        if self.world.will_collide(x, y) or self.world.entities_at(x, y):
+            return None
+        if self.count == len(self.x):
+            self.grow()
+        i = self.count
+        self.count += 1
+        ts = self.world.tilesize
+        self.x[i], self.y[i] = x, y
+        self.px[i], self.py[i] = x * ts, y * ts
+        self.direction[i] = DIRECTIONS.index(direction)
+        self.anim_frame[i] = 0
+        self.state[i] = self.IDLE
+        self.world.entities.add(i, (x, y))
+        self.mark_dirty(np.array([i]))
+        return i
+
+    def spawn_random(self, n):
+        """Spawns up to n NPCs on random free tiles. Returns the number spawned."""
+        free = np.flatnonzero(self.world.passable.ravel())
+        spawned = 0
+        for index in self.rng.permutation(free):
+            if spawned == n:
+                break
+            y, x = divmod(int(index), self.world.width)
+            if self.spawn(x, y) is not None:
+                spawned += 1
+        return spawned
+
+    def occupied_tile(self, i):
+        """Returns the tile NPC i is indexed on in world.entities, the one it is walking into if it is walking."""
+        x, y = int(self.x[i]), int(self.y[i])
+        if self.state[i] == self.WALK:
+            dx, dy = DIRECTION_OFFSETS[self.direction[i]]
+            return x + int(dx), y + int(dy)
+        return x, y
+
+    def put(self, i, x, y, px, py, direction, anim_frame, walking):
+        """
+            Sets NPC i to the given state without any collision checks, adding it if i is count.
+            Used by network clients, whose NPCs are the other players and move wherever the server says.
+        """
+        if i == self.count:
+            if self.count == len(self.x):
+                self.grow()
+            self.count += 1
+        else:
+            self.mark_dirty(np.array([i]))
+            self.world.entities.remove(i, self.occupied_tile(i))
+        self.x[i], self.y[i] = x, y
+        self.px[i], self.py[i] = px, py
+        self.direction[i] = DIRECTIONS.index(direction)
+        self.anim_frame[i] = anim_frame
+        self.state[i] = self.WALK if walking else self.IDLE
+        self.world.entities.add(i, self.occupied_tile(i))
+        self.mark_dirty(np.array([i]))
+
+    def remove(self, i):
+        """
+            Removes NPC i. The last NPC takes over id i so the ids stay contiguous.
+            Returns the id the moved NPC had, or None if i was the last one.
+        """
+        self.mark_dirty(np.array([i]))
+        self.world.entities.remove(i, self.occupied_tile(i))
+        last = self.count - 1
+        self.count = last
+        if i == last:
+            return None
+        tile = self.occupied_tile(last)
+        for name in ('x', 'y', 'px', 'py', 'direction', 'anim_frame', 'state'):
+            array = getattr(self, name)
+            array[i] = array[last]
+        self.world.entities.remove(last, tile)
+        self.world.entities.add(i, tile)
+        return last
+
+    def mark_dirty(self, ids):
+        if len(ids):
+            self.dirty.append((self.px[ids].copy(), self.py[ids].copy()))
+
+    def update(self, blocked=()):
+        """
+            Advances every NPC by one tick. Called every frame, like Player.update.
+            blocked: tiles NPCs must not walk into, such as the tile the player is on
+        """
+        self.tick += 1
+        n = self.count
+        state = self.state[:n]
+
+        # some of the idle NPCs face a random direction and try to walk that way
+        idle = np.flatnonzero(state == self.IDLE)
+        movers = idle[self.rng.random(idle.size) < self.wander_chance]
+        if movers.size:
+            directions = self.rng.integers(0, len(DIRECTIONS), movers.size).astype(np.int8)
+            self.mark_dirty(movers[self.direction[movers] != directions])
+            self.direction[movers] = directions
+            can_move = self.world.can_move_many(np.stack([self.x[movers], self.y[movers]], axis=1), directions)
+            entities = self.world.entities
+            for i in movers[can_move]:
+                dx, dy = DIRECTION_OFFSETS[self.direction[i]]
+                old = (int(self.x[i]), int(self.y[i]))
+                target = (old[0] + dx, old[1] + dy)
+                if target in blocked or entities.at(target):
+                    continue
+                # the target tile is taken as soon as the NPC starts walking, so no one else walks into it
+                entities.move(i, old, target)
+                state[i] = self.WALK
+            self.mark_dirty(movers)
+
+        # walking NPCs advance half a tile every other tick, like the player
+        if self.tick % 2 == 0:
+            walking = np.flatnonzero(state == self.WALK)
+            if walking.size:
+                self.mark_dirty(walking)
+                offsets = DIRECTION_OFFSETS[self.direction[walking]]
+                frames = (self.anim_frame[walking] + 1) % len(self.frames[0])
+                self.anim_frame[walking] = frames
+                half = self.world.tilesize // 2
+                self.px[walking] += offsets[:, 0] * half
+                self.py[walking] += offsets[:, 1] * half
+                # every other animation frame is standing still, meaning the NPC has entered the new tile
+                arrived = frames % 2 == 0
+                self.x[walking[arrived]] += offsets[arrived, 0]
+                self.y[walking[arrived]] += offsets[arrived, 1]
+                state[walking[arrived]] = self.IDLE
+                self.mark_dirty(walking)
+
+    def ids_in_view(self, px, py, view):
+        """Returns a mask of the sprites at pixel positions (px, py) that overlap the view rect."""
+        vx, vy, vw, vh = view
+        top = py - self.sprite_h // 2
+        return (px + self.sprite_w > vx) & (px < vx + vw) & (top + self.sprite_h > vy) & (top < vy + vh)
+
+    def pop_dirty_rects(self, view):
+        """Returns the rects, relative to the view, of NPC sprites that changed since the last call, and forgets them."""
+        if not self.dirty:
+            return ()
+        px = np.concatenate([d[0] for d in self.dirty])
+        py = np.concatenate([d[1] for d in self.dirty])
+        self.dirty.clear()
+        inside = self.ids_in_view(px, py, view)
+        vx, vy = int(view[0]), int(view[1])
+        top = self.sprite_h // 2
+        return [pygame.Rect(x - vx, y - top - vy, self.sprite_w, self.sprite_h) for x, y in zip(px[inside].tolist(), py[inside].tolist())]
+
+    def draw(self, surface, view, scale=1):
+        """Blits the NPCs that overlap the view rect to the surface, scaled by scale."""
+        n = self.count
+        ids = np.flatnonzero(self.ids_in_view(self.px[:n], self.py[:n], view))
+        if not ids.size:
+            return
+        vx, vy = int(view[0]), int(view[1])
+        top = self.sprite_h // 2
+        frames = self.frames
+        scaled = utils.scaled_surfaces.get
+        surface.blits([(scaled(frames[d][f], scale), (round((x - vx) * scale), round((y - top - vy) * scale))) for d, f, x, y in zip(
+            self.direction[ids].tolist(), self.anim_frame[ids].tolist(), self.px[ids].tolist(), self.py[ids].tolist())], doreturn=False)
+
 class Camera: 
-    def __init__(self, viewport_size, world: World, player: Player, scale=3, debug=False):
+    def __init__(self, viewport_size, world: World, player: Player, scale=3, debug=False, dirty_rendering=False, frame_profiler=None,
+                 memory_monitor=None):
         """
             Creates a camera that follows the player around the world. 
             viewport_size: the size of the viewport in tiles (W, H)
             world: the world object
             player: the player object
             scale: scale factor for tiles, for example 3 means world.tilesize*3 pixels per tile
+            dirty_rendering: if True, only the parts of the viewport that changed since the last 
+                draw are redrawn, otherwise the whole viewport is redrawn every frame
+            frame_profiler: profiler.FrameProfiler timing the draw phases, shown in the debug overlay
+            memory_monitor: memory.MemoryMonitor whose numbers are shown in the debug overlay
         """
         self.scale = scale
         self.world = world
@@ -246,10 +943,45 @@ class Camera:
         # these are pixel coordinates, whereas every other class's coordinates are tile coordinates
         self.x = 0
         self.y = 0
+        # interpolated pixel position of the player, see update
+        self.player_pos = player.rect.topleft
         self.debug = debug
+        self.dirty_rendering = dirty_rendering
+        self.profiler = frame_profiler or profiler.FrameProfiler()
+        self.memory = memory_monitor
+        # the HUD font and the text rendered with it are kept between frames
+        self.text = None
+        # the viewport in world pixels and on the output surface, updated when the camera zooms
+        self.full = pygame.Rect(0, 0, self.vw, self.vh)
+        self.output = pygame.Rect(0, 0, self.vw * scale, self.vh * scale)
+        # state of the previous draw, used to work out what changed
+        self.max_dirty_rects = 32
+        self.full_redraw = True
+        self.last_view = None
+        self.last_player_state = None
 
     def set_debug(self, debug):
         self.debug = debug
+        self.full_redraw = True
+
+    def set_world(self, world):
+        """Follows the player into another world."""
+        self.world = world
+        self.player_pos = self.player.rect.topleft
+        self.full_redraw = True
+        self.last_view = None
+
+    def set_scale(self, scale):
+        """
+            Zooms the camera. The viewport shrinks or grows so it keeps covering the same 
+            number of screen pixels. Tiles for the new scale are scaled and cached on first use.
+        """
+        self.vw = self.vw * self.scale / scale
+        self.vh = self.vh * self.scale / scale
+        self.scale = scale
+        self.full = pygame.Rect(0, 0, self.vw, self.vh)
+        self.output = pygame.Rect(0, 0, self.vw * scale, self.vh * scale)
+        self.full_redraw = True
     
     def contains(self, x,y):
         """
@@ -258,68 +990,163 @@ class Camera:
         return (x >= self.x and x <= (self.x + self.viewportWidth) and
                 y >= self.y and y <= (self.y + self.viewportHeight))
 
-    def update(self):
+    def update(self, alpha=1.0):
         """
             Updates the camera's position to follow the player.
+            alpha: how far the frame is between the last two simulation steps, from 0 to 1
         """ 
+        self.player_pos = self.player.render_pos(alpha)
         # target position should be (px, py) - (viewportWidth/2, viewportHeight/2)
-        self.x = self.player.rect.x - self.vw * 0.5
-        self.y = self.player.rect.y - self.vh * 0.5 
+        self.x = self.player_pos[0] - self.vw * 0.5
+        self.y = self.player_pos[1] - self.vh * 0.5 
         # self.x = utils.clamp(self.x, 0, self.world.width * self.world.tilesize - self.vw)
         # self.y = utils.clamp(self.y, 0, self.world.height * self.world.tilesize - self.vh)
         
 
+    def player_rect(self, view):
+        """Returns the rect the player's sprite covers in world pixels relative to the view."""
+        # we subtract half the sprite height from the player's y coordinate because the player's y coordinate is the top of the tile
+        # but the sprite is taller than a tile and should stand on it
+        return pygame.Rect(self.player_pos[0] - view[0], self.player_pos[1] - self.player.rect.height/2 - view[1], 
+                           self.player.rect.width, self.player.rect.height)
+
+    def dirty_rects(self, view, hud_rect):
+        """
+            Returns the rects of the view, in world pixels, that changed since the last draw. 
+            If the camera moved, was resized or the debug mode changed the whole viewport is returned.
+        """
+        full = self.full
+        player_state = (self.player.view(), self.player_rect(view))
+        world_dirty = self.world.pop_dirty_rects()
+        if world_dirty:
+            world_dirty = [rect.move(-view[0], -view[1]) for rect in world_dirty]
+        if self.world.npcs is not None:
+            npc_dirty = self.world.npcs.pop_dirty_rects(view)
+            if npc_dirty:
+                world_dirty = list(world_dirty) + npc_dirty
+        if not self.dirty_rendering or self.full_redraw or view != self.last_view:
+            rects = [full]
+        else:
+            rects = []
+            if player_state != self.last_player_state:
+                # the tile outline drawn in debug mode sticks out of the sprite by a pixel
+                rects.append(player_state[1].inflate(2, 2))
+                rects.append(self.last_player_state[1].inflate(2, 2))
+            for rect in world_dirty:
+                if rect.colliderect(full):
+                    rects.append(rect)
+            if self.debug: 
+                rects.append(hud_rect)
+            rects = [rect.clip(full) for rect in rects]
+            if len(rects) > self.max_dirty_rects:
+                # past this point one full redraw is cheaper than redrawing every layer for each rect
+                rects = [full]
+        self.full_redraw = False
+        self.last_view = view
+        self.last_player_state = player_state
+        return rects
+
+    def view_rect(self):
+        """Returns the (x, y, w, h) rect of the world, in unscaled world pixels, that the camera shows."""
+        return (int(self.x), int(self.y), self.vw, self.vh)
+
     def draw(self, surface): 
         """
             Draws the contents of the camera's viewport to the given surface.
+            Returns the list of rects of the surface that were redrawn, which is empty when nothing changed.
         """
 
-        # first we draw the entire world to a buffer 
-        # TODO: only blit the tiles that are visible in the viewport to reduce draw calls
-        worldbuffer = pygame.Surface((self.world.width * self.world.tilesize, self.world.height * self.world.tilesize))
-        
-        # clear the buffer, then draw the world layer by layer
-        worldbuffer.fill((0,0,0))
-        self.world.draw_ground(worldbuffer, debug=self.debug)
-        self.world.draw_objects(worldbuffer, debug=self.debug)
-        worldbuffer.blit(self.player.view(), (self.player.rect.x, self.player.rect.y - self.player.rect.height/2))
-        self.world.draw_foreground(worldbuffer, debug=self.debug)
-
-        cambuffer = pygame.Surface((self.vw, self.vh))
-        cambuffer.blit(worldbuffer, (0,0), (self.x, self.y, self.vw, self.vh))
-        # we subtract the tilesize from the player's y coordinate because the player's y coordinate is the top of the sprite
-        # but we want to draw the player's sprite at the bottom of the tile
-        # cambuffer.blit(self.player.view(), (self.player.rect.x - self.x, self.player.rect.y - self.y - self.world.tilesize))
-        
-        if self.debug: 
-            # draw text
-            pygame.draw.rect(cambuffer, (255,0,255), (self.player.rect.x - self.x, self.player.rect.y - self.y - self.player.rect.height/2, self.player.rect.width, self.player.rect.height), 1)
-            pygame.draw.rect(cambuffer, (255,0,0), (self.player.x * self.world.tilesize - self.x, self.player.y * self.world.tilesize - self.y, self.world.tilesize, self.world.tilesize), 1)
-        
-        # scale the camera buffer by the scale factor
-        scene = pygame.transform.scale(cambuffer, (self.vw * self.scale, self.vh * self.scale))
-        if self.debug: 
-            font = pygame.font.SysFont('Arial', 16)
-            text = font.render(f"Player: {self.player.x}, {self.player.y}", True, (255,255,255))
-            scene.blit(text, (0,0))
-
-       
+        # only the part of the world inside the viewport is drawn
+        view = self.view_rect()
         if self.debug: 
+            if self.text is None:
+                self.text = utils.TextCache(utils.load_font('Arial', 16))
+            render = self.text.render
             # show which tile the mouse is on
             mx, my = pygame.mouse.get_pos()
             mx = int((mx / self.scale + self.x) / self.world.tilesize)
             my = int((my / self.scale + self.y) / self.world.tilesize)
-            text = font.render(f"Mouse: {mx}, {my}", True, (255,255,255))
-            scene.blit(text, (0,16))
+            hud = [render(f"Player: {self.player.x}, {self.player.y}"), render(f"Mouse: {mx}, {my}")]
+            if self.memory is not None:
+                hud += [render(line) for line in self.memory.overlay]
+            if self.profiler.enabled: 
+                hud += [render(line) for line in self.profiler.overlay]
+            hud_width = max(text.get_width() for text in hud)
+            # the world under the text has to be redrawn too, in world pixels
+            hud_rect = pygame.Rect(0, 0, -(-hud_width // self.scale), -(-16 * len(hud) // self.scale))
+        else: 
+            hud = []
+            hud_rect = None
+
+        rects = self.dirty_rects(view, hud_rect)
+        if not rects: 
+            return rects
         
-        # blit the final scene to the surface 
-        surface.blit(scene, (0,0))
+        # the world is drawn straight to the surface at the output resolution, from tiles and sprites 
+        # that were scaled once and cached, so no full-screen scaling is needed
+        scale = self.scale
+        output = self.output
+        scaled = utils.scaled_surfaces.get
+        phase = self.profiler.phase
+        screen_rects = []
+        for rect in rects: 
+            screen_rect = pygame.Rect(rect.x * scale, rect.y * scale, rect.width * scale, rect.height * scale).clip(output)
+            screen_rects.append(screen_rect)
+            surface.set_clip(screen_rect)
+            surface.fill((0,0,0))
+            with phase('draw_ground'):
+                self.world.draw_ground(surface, view, debug=self.debug, scale=scale)
+            with phase('draw_objects'):
+                self.world.draw_objects(surface, view, debug=self.debug, scale=scale)
+            with phase('draw_entities'):
+                self.world.draw_entities(surface, view, debug=self.debug, scale=scale)
+                player_rect = self.player_rect(view)
+                player_rect = pygame.Rect(player_rect.x * scale, player_rect.y * scale, player_rect.width * scale, player_rect.height * scale)
+                surface.blit(scaled(self.player.view(), scale), player_rect)
+            with phase('draw_foreground'):
+                self.world.draw_foreground(surface, view, debug=self.debug, scale=scale)
+            if self.debug: 
+                ts = self.world.tilesize
+                pygame.draw.rect(surface, (255,0,255), player_rect, scale)
+                pygame.draw.rect(surface, (255,0,0), ((self.player.x * ts - view[0]) * scale, (self.player.y * ts - view[1]) * scale, ts * scale, ts * scale), scale)
+        surface.set_clip(None)
+        
+        for i, text in enumerate(hud): 
+            surface.blit(text, (0, 16 * i))
+        return screen_rects
         
 class Game: 
-    def __init__(self, screen):
+    def __init__(self, screen, map_path='tiled/boolground.tmx', dirty_rendering=True, npcs=0, fps=60, tick_rate=30, max_steps=5, 
+                 frame_profiler=None, preload_distance=8, memory_budget=64 * 1024 * 1024, loading_screen=False, preload=(),
+                 record_path=None, replay_log=None, server_address=None, save_path=None, autosave_ticks=150,
+                 surface_budget=128 * 1024 * 1024):
         """
             Creates a new game instance.
             screen: the pygame display surface
+            loading_screen: if True, the game starts in the MENU state showing a progress bar while the 
+                sprite sheets and the first map load in the background. Otherwise it waits for them here.
+            preload: paths of optional images to decode in the background, they keep loading after the 
+                game started
+            record_path: if set, every tick's actions and every frame's timing are recorded to this file
+            replay_log: recording.InputLog whose ticks replace the player's input
+            save_path: if set, the game continues from the save at this path if there is one, and 
+                saves to it every autosave_ticks ticks and on exit, see savegame.py
+            server_address: if set, the game is a client of the multiplayer server at this address 
+                (see network.parse_address). The server picks the map and tick rate, and the world, 
+                the player and the other players, shown as NPCs, only change when it says so.
+            map_path: the Tiled map to start on, linked maps are streamed in as the player gets close
+            preload_distance: tiles from a map edge or warp door at which the linked map starts loading
+            memory_budget: bytes the cached worlds may take before the least recently used are evicted
+            surface_budget: bytes every surface of the game may take before caches are evicted, checked 
+                once a second, see memory.py. The numbers show up in the debug overlay.
+            fps: the highest rate frames are rendered at
+            tick_rate: simulation steps per second, independent of the rendering rate
+            max_steps: the most simulation steps run for one rendered frame, so a long stall 
+                slows the game down instead of freezing it while it catches up
+            frame_profiler: profiler.FrameProfiler timing each phase of the frame, toggled with 'P' 
+            dirty_rendering: if True, only the changed parts of the screen are redrawn and presented,
+                and nothing is presented on frames where nothing changed
+            npcs: number of wandering NPCs to spawn on random free tiles
             
         """
         self.__setup_window()
@@ -327,14 +1154,58 @@ class Game:
         self.screen_dims = screen.get_size()
         print(f"Starting new game with resolution: {self.screen_dims}")
         self.states = ['MENU', 'PLAY', 'EXIT']
-        self.game_map = pytmx.load_pygame('tiled/boolground.tmx')
-        self.world: World = World(self.game_map)
-        self.player: Player = Player(0, 0, self.world, sprites=utils.load_player_sprites())
-        camera_dims = self.screen_dims[0] / (self.world.tilesize * 2), self.screen_dims[1] / (self.world.tilesize * 2)
         self.debug = False
-        self.camera: Camera = Camera(camera_dims, self.world, self.player, scale=2)
-        self.state = 'PLAY'
+        self.dirty_rendering = dirty_rendering
+        self.profiler = frame_profiler or profiler.FrameProfiler()
+        self.client = network.Client(server_address) if server_address else None
+        if self.client is not None:
+            map_path, tick_rate, npcs = self.client.map_path, self.client.tick_rate, 0
+        self.npc_count = npcs
+        self.tick = 0
+        self.saver = savegame.Autosaver(save_path) if save_path and self.client is None else None
+        self.autosave_ticks = autosave_ticks
+        # read before anything loads, so the map the save was made on is the one loaded first
+        self.saved = savegame.load(save_path) if self.saver is not None and os.path.exists(save_path) else None
+        if self.saved is not None:
+            map_path = self.saved.map_path
+        self.recorder = recording.InputRecorder(record_path, map_path, tick_rate, npcs) if record_path else None
+        self.replay = recording.InputReplay(replay_log) if replay_log else None
+        self.streamer = streaming.WorldStreamer(self.load_world, preload_distance, memory_budget, finish_world=self.finish_world)
+        self.memory = memory.MemoryMonitor(surface_budget)
+        self.memory_check_ticks = max(1, round(tick_rate))
+        self.streamer.evict_listeners.append(self.memory.world_evicted)
+        self.streamer.evict_listeners.append(self.world_evicted)
+        self.map_path = os.path.abspath(map_path)
+        # the world, player and camera are created by start() once the required assets are loaded
+        self.world: World = None
+        self.player: Player = None
+        self.npcs: NPCs = None
+        self.camera: Camera = None
+        # created the first time it is shown, toggled with 'M'
+        self.minimap = None
+        self.show_minimap = False
+        self.menu_font = None
+        self.loader = loader.AssetLoader()
+        for path in SPRITE_SHEETS:
+            self.loader.add_image(path)
+        # only decoded when the map's bundle is missing or stale, the world reads them from the registry
+        for path in mapcache.tileset_images(self.map_path):
+            self.loader.add_image(path, alpha=True, category='tilesets')
+        for path in preload:
+            self.loader.add_image(path, alpha=True, required=False, category='tilesets')
+        # the world is built once its doors' sprite sheet and its tileset images are in the registry, 
+        # so the streaming thread doesn't decode them again
+        self.loader.then(lambda: self.loader.track(self.map_path, self.streamer.request(self.map_path)))
+        self.state = 'MENU'
+        if not loading_screen:
+            self.loader.wait()
+            self.start()
         self.clock = pygame.time.Clock()
+        self.fps = fps
+        self.step_ms = 1000 / tick_rate
+        self.max_steps = max_steps
+        # milliseconds of real time that haven't been simulated yet
+        self.accumulator = 0.0
         self.direction_keys = {
             'UP': [pygame.K_UP, pygame.K_w],
             'DOWN': [pygame.K_DOWN, pygame.K_s],
@@ -362,20 +1233,68 @@ class Game:
         """
         Main game loop.
         """
+        self.screen.fill((88,88,88))
+        frozen = False
         while self.state != 'EXIT':
+            if self.state == 'PLAY' and not frozen:
+                # everything loaded so far lives for the whole session, move it out of the garbage 
+                # collector's reach so collections during play only look at what frames allocate. 
+                # A world evicted later is still freed, World.release breaks its reference cycles 
+                # so reference counting is enough.
+                gc.collect()
+                gc.freeze()
+                frozen = True
             # print(pygame.mouse.get_pos(), pygame.mouse.get_rel())
-            self.clock.tick(30)
-            self.screen.fill((88,88,88))
-            self.__handle_events()
+            dt = self.clock.tick(self.fps)
+            start = time.perf_counter()
+            self.profiler.begin_frame()
+            if not self.dirty_rendering: 
+                self.screen.fill((88,88,88))
+            with self.profiler.phase('events'):
+                self.__handle_events()
+            rects = None
+            played = False
+            if self.loader.busy() and self.state == 'PLAY':
+                # optional assets keep loading in the background
+                self.loader.update(budget_ms=2)
             if self.state == 'PLAY': 
-                self.play()
+                rects = self.play(dt)
+                played = True
             elif self.state == 'MENU': 
                 self.menu()
             
-            pygame.display.flip()
+            with self.profiler.phase('present'):
+                if not self.dirty_rendering or rects is None: 
+                    pygame.display.flip()
+                elif rects: 
+                    pygame.display.update(rects)
+            self.profiler.end_frame()
+            if played:
+                self.record_frame(dt, start)
+        gc.unfreeze()
+        self.close()
         pygame.display.quit()
         pygame.quit()
 
+    def record_frame(self, dt, start):
+        """Records a played frame's dt and how long it took since start, a time.perf_counter() value."""
+        if self.recorder is not None:
+            self.recorder.frame(dt, (time.perf_counter() - start) * 1000)
+
+    def close(self):
+        """Stops the background threads and closes the profiler log and input recording."""
+        self.profiler.close()
+        self.streamer.close()
+        self.loader.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.client is not None:
+            self.client.close()
+        if self.saver is not None:
+            if self.player is not None:
+                self.saver.save(self)
+            self.saver.close()
+
     def __handle_events(self):
         """
             Processes events, such as key presses and mouse clicks.
@@ -384,14 +1303,28 @@ class Game:
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.state = 'EXIT'
-            elif event.type == pygame.KEYDOWN:
+            elif event.type == pygame.KEYDOWN and self.state == 'PLAY':
                 # check if 'I' was pressed 
                 if event.key == pygame.K_i:
                     self.camera.set_debug(not self.camera.debug)
+                # 'P' toggles the frame profiler, its statistics show up in the debug overlay
+                if event.key == pygame.K_p:
+                    self.profiler.set_enabled(not self.profiler.enabled)
+                # 'M' shows and hides the minimap
+                if event.key == pygame.K_m:
+                    self.toggle_minimap()
+                # '=' and '-' zoom the camera in and out
+                if event.key in (pygame.K_EQUALS, pygame.K_PLUS) and self.camera.scale < 4:
+                    self.camera.set_scale(self.camera.scale + 1)
+                if event.key == pygame.K_MINUS and self.camera.scale > 1:
+                    self.camera.set_scale(self.camera.scale - 1)
+                    self.screen.fill((88,88,88))
 
                 for direction in self.direction_keys:
                     if event.key in self.direction_keys[direction]:
                         self.actions['direction'] = direction
+                if event.key in self.action_keys['SPACE']:
+                    self.actions['action'] = 'SPACE'
             elif event.type == pygame.KEYUP: 
                 # this is a hack to make sure the player stops moving when the key is released
                 # it prob doesn't work if the player is holding down two keys at once
@@ -403,26 +1336,341 @@ class Game:
     def menu(self):
         """
             Updates the menu state and draws to the screen. Should be called every frame.
+            Shows the loading progress and starts the game once the required assets are loaded.
         """
-        pass
+        if self.loader.update():
+            self.start()
+            self.screen.fill((88,88,88))
+            return
+        if self.menu_font is None:
+            self.menu_font = utils.load_font('Arial', 16)
+        w, h = self.screen_dims
+        bar = pygame.Rect(w // 4, h // 2 - 8, w // 2, 16)
+        self.screen.fill((88,88,88))
+        pygame.draw.rect(self.screen, (40, 40, 40), bar)
+        pygame.draw.rect(self.screen, (230, 230, 230), (bar.x, bar.y, round(bar.width * self.loader.progress()), bar.height))
+        pygame.draw.rect(self.screen, (255, 255, 255), bar, 1)
+        text = self.menu_font.render(f"Loading {self.loader.required_done}/{self.loader.required_total}", True, (255, 255, 255))
+        self.screen.blit(text, (bar.x, bar.y - 24))
     
-    def play(self):
+    def play(self, dt=None):
         """
             Updates the game state and draws the game to the screen. Should be called every frame.
+            dt: milliseconds since the last frame, the game runs as many fixed simulation steps as fit 
+                in the time that has built up. If None, exactly one step is run.
+            Returns the list of screen rects that were redrawn.
+        """
+        if dt is None: 
+            self.step()
+            return self.render(1.0)
+        
+        self.accumulator += dt
+        steps = 0
+        while self.accumulator >= self.step_ms and steps < self.max_steps: 
+            self.step()
+            self.accumulator -= self.step_ms
+            steps += 1
+        if steps == self.max_steps: 
+            # we fell too far behind, drop the backlog rather than trying to catch up
+            self.accumulator = min(self.accumulator, self.step_ms)
+        return self.render(self.accumulator / self.step_ms)
+
+    def start(self):
+        """Creates the player, NPCs and camera in the first world and switches to the PLAY state."""
+        self.world = self.streamer.load(self.map_path)
+        self.game_map = self.world.tiled_map
+        self.player = Player(0, 0, self.world, sprites=utils.load_player_sprites())
+        self.npcs = NPCs(self.world, utils.load_player_sprites())
+        # keep the player's starting tile free
+        self.world.entities.add('player', (self.player.x, self.player.y))
+        self.npcs.spawn_random(self.npc_count)
+        self.world.entities.remove('player', (self.player.x, self.player.y))
+        camera_dims = self.screen_dims[0] / (self.world.tilesize * 2), self.screen_dims[1] / (self.world.tilesize * 2)
+        self.camera = Camera(camera_dims, self.world, self.player, scale=2, dirty_rendering=self.dirty_rendering, 
+                             frame_profiler=self.profiler, memory_monitor=self.memory)
+        if self.saved is not None:
+            savegame.restore(self, self.saved)
+            self.saved = None
+        if self.client is not None:
+            # the full state the server sent along with the welcome
+            self.client.update(recording.decode(0), self.world, self.player)
+            self.camera.update()
+        self.state = 'PLAY'
+
+    @staticmethod
+    def load_world(path):
+        """Loads the map at path into a new World, called on the streaming thread."""
+        return World(mapcache.load_map(path))
+
+    def finish_world(self, world):
+        """Called by the streamer on the main thread when a world has loaded, before it is used."""
+        world.convert()
+        if self.profiler.enabled:
+            print(world.tiles.summary())
+
+    def world_evicted(self, path, world):
+        """Called by the streamer when it evicts a world."""
+        world.release()
+
+    def enter_world(self, path, world, x, y):
+        """Moves the player to tile (x, y) of another world, which must already be loaded."""
+        print(f"Entering {path} at {x}, {y}")
+        self.map_path = path
+        self.world = world
+        self.game_map = world.tiled_map
+        if world.npcs is None:
+            NPCs(world, utils.load_player_sprites())
+        self.npcs = world.npcs
+        world.pop_dirty_rects()
+        self.player.place(world, x, y)
+        self.camera.set_world(world)
+        if self.minimap is not None:
+            self.minimap.set_world(world)
+
+    def cross_edge(self):
+        """Moves the player into the linked map when they walk off an edge of the current one.
+            If that map hasn't been streamed in yet the player waits at the edge, the game never blocks on it.
+        """
+        player, world = self.player, self.world
+        direction = self.actions['direction']
+        if player.state != 'IDLE' or direction is None or direction != player.direction:
+            return
+        dx, dy = player.movemap(direction)
+        x, y = player.x + dx, player.y + dy
+        if 0 <= x < world.width and 0 <= y < world.height:
+            return
+        path = self.streamer.neighbour(self.map_path, direction)
+        if path is None:
+            return
+        target = self.streamer.get(path)
+        if target is None:
+            self.streamer.request(path)
+            return
+        # enter on the opposite edge, keeping the other coordinate
+        x = 0 if x >= world.width else target.width - 1 if x < 0 else min(x, target.width - 1)
+        y = 0 if y >= world.height else target.height - 1 if y < 0 else min(y, target.height - 1)
+        if not target.will_collide(x, y) and not target.entities_at(x, y):
+            self.enter_world(path, target, x, y)
+
+    def take_warp(self):
+        """Warps the player if they just walked onto a door leading to another map."""
+        door = self.world.doors.get((self.player.x, self.player.y))
+        if door is None or not door.warp:
+            return
+        path = self.streamer.warp_target(self.map_path, door)
+        target = self.streamer.get(path)
+        if target is None:
+            print(f"{path} wasn't streamed in before the player reached the door, loading it now")
+            try:
+                target = self.streamer.load(path)
+            except Exception as e:
+                print(f"Unable to load {path}: {e}")
+                return
+        self.enter_world(path, target, *door.warp_tile)
+
+    def step(self):
+        """
+            Advances the simulation by one fixed step.
+        """
+        self.tick += 1
+        if self.tick % self.memory_check_ticks == 0:
+            self.memory.update(self)
+        if self.replay is not None:
+            self.actions = self.replay.next_tick()
+        if self.recorder is not None:
+            self.recorder.tick(self.actions)
+        phase = self.profiler.phase
+        if self.client is not None:
+            with phase('network'):
+                self.player.prev_pos = self.player.rect.topleft
+                if not self.client.update(self.actions, self.world, self.player):
+                    print("The server closed the connection")
+                    self.state = 'EXIT'
+            with phase('world'):
+                self.world.update(self.step_ms)
+            return
+        with phase('world'):
+            self.sync_worlds()
+        with phase('player'):
+            self.cross_edge()
+            walking = self.player.state == 'WALK'
+            self.player.update(self.actions)
+            if walking and self.player.state == 'IDLE':
+                self.take_warp()
+        blocked = {(self.player.x, self.player.y)}
+        if self.player.state == 'WALK':
+            dx, dy = self.player.movemap(self.player.direction)
+            blocked.add((self.player.x + dx, self.player.y + dy))
+        with phase('npcs'):
+            self.npcs.update(blocked)
+        with phase('world'):
+            self.world.update(self.step_ms)
+            self.streamer.update(self.map_path, self.world, self.player.x, self.player.y)
+        if self.saver is not None and self.tick % self.autosave_ticks == 0:
+            with phase('save'):
+                self.saver.save(self)
+
+    def sync_worlds(self):
+        """Picks up the maps streamed in since the last tick and evicts worlds over the budget. A replay
+            makes the changes the recording made on this tick instead, whether the worker thread got
+            as far or not, so the player crosses into a linked map on the same tick.
+        """
+        if self.replay is not None:
+            self.streamer.apply(self.map_path, *self.replay.streamed())
+            return
+        loaded, evicted = self.streamer.sync(self.map_path)
+        if self.recorder is not None:
+            self.recorder.streamed(loaded, evicted)
+
+    def render(self, alpha):
         """
-        self.player.update(self.actions)
-        self.world.update()
-        self.camera.update()
-        self.camera.draw(self.screen)
+            Draws the game to the screen.
+            alpha: how far the frame is between the last two simulation steps, from 0 to 1
+            Returns the list of screen rects that were redrawn.
+        """
+        with self.profiler.phase('camera'):
+            self.camera.update(alpha)
+        rects = self.camera.draw(self.screen)
+        if self.show_minimap:
+            with self.profiler.phase('minimap'):
+                position = (self.screen_dims[0] - self.minimap.width - 4, 4)
+                rects = list(rects) + [self.minimap.draw(self.screen, position, self.player)]
+        return rects
+
+    def toggle_minimap(self):
+        if self.minimap is None:
+            self.minimap = minimap.Minimap(self.world)
+        self.show_minimap = not self.show_minimap
+        # the world under the minimap has to be drawn again when it is hidden
+        self.camera.full_redraw = True
 
 SCREEN_WIDTH = 400
 SCREEN_HEIGHT = 300
 dims = (SCREEN_WIDTH, SCREEN_HEIGHT)
 
+def read_script(path):
+    """
+        Reads a scripted input file for run_headless. 
+        Each line is a frame number followed by a direction or NONE, for example '30 RIGHT'. 
+        Blank lines and lines starting with # are ignored.
+    """
+    script = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            frame, direction = line.split()
+            script[int(frame)] = None if direction.upper() == 'NONE' else direction.upper()
+    return script
+
+def init_headless(size=dims):
+    """
+        Initializes pygame with SDL's dummy video driver, so no window or display is needed.
+        Returns the display surface.
+    """
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.init()
+    return pygame.display.set_mode(size)
+
+def run_headless(frames, script=None, **kwargs):
+    """
+        Runs the game without a window for a number of frames, one simulation step per frame.
+        frames: the number of frames to run
+        script: dictionary from frame number to the direction held from that frame on (or None)
+        kwargs: passed on to Game
+        Returns the game, so its state can be inspected.
+    """
+    screen = init_headless()
+    game = Game(screen, **kwargs)
+    script = script or {}
+    for frame in range(frames):
+        start = time.perf_counter()
+        game.profiler.begin_frame()
+        if frame in script:
+            game.actions['direction'] = script[frame]
+        game.play()
+        game.profiler.end_frame()
+        game.record_frame(game.step_ms, start)
+    game.close()
+    return game
+
+def run_replay(path, screen, timed=False, **kwargs):
+    """
+        Replays a recorded session as fast as possible, on the map and with the settings it was 
+        recorded with. The simulation sees exactly the recorded input of every tick.
+        path: the input log written with --record
+        screen: the display surface, from init_headless or a window
+        timed: if True and the log has frame timings, every recorded frame is replayed with its dt, 
+            so the ticks are spread over the frames exactly like in the session and frame numbers 
+            match the recording. Otherwise every tick is its own frame.
+        kwargs: passed on to Game
+        Returns the game, so its state can be inspected.
+    """
+    log = recording.InputLog.read(path)
+    game = Game(screen, map_path=log.map_path, npcs=log.npcs, tick_rate=log.tick_rate, replay_log=log, **kwargs)
+    start = time.perf_counter()
+    frames = log.frames if timed and log.frames else [(None, 0.0, 1)] * len(log.ticks)
+    for dt, _, ticks in frames:
+        pygame.event.pump()
+        game.profiler.begin_frame()
+        position = game.replay.position
+        rects = game.play(dt)
+        with game.profiler.phase('present'):
+            if rects:
+                pygame.display.update(rects)
+        game.profiler.end_frame()
+        if game.replay.position - position != ticks:
+            print(f"Replay out of step: a frame ran {game.replay.position - position} ticks instead of {ticks}")
+    print(f"Replayed {game.replay.position} of {len(log.ticks)} ticks in {len(frames)} frames in {time.perf_counter() - start:.2f} s")
+    for frame, frame_ms in log.slowest_frames():
+        print(f"Recorded frame {frame} took {frame_ms:.1f} ms")
+    game.close()
+    return game
 
     
 if __name__ == '__main__':
-    pygame.init()
-    screen = pygame.display.set_mode(dims,flags=pygame.SCALED, vsync=0)
-    game = Game(screen)
-    game.mainloop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Bool')
+    parser.add_argument('--map', default='tiled/boolground.tmx', help='Tiled map to play on')
+    parser.add_argument('--npcs', type=int, default=0, help='number of wandering NPCs')
+    parser.add_argument('--fps', type=int, default=60, help='highest rendering rate')
+    parser.add_argument('--headless', action='store_true', help='run without a window using the dummy video driver')
+    parser.add_argument('--frames', type=int, default=300, help='frames to run in headless mode')
+    parser.add_argument('--script', help='scripted input file for headless mode, see read_script')
+    parser.add_argument('--preload', nargs='*', default=[], help='optional images to decode in the background, e.g. town/Tiles/*.png')
+    parser.add_argument('--record', help='record every tick\'s input and every frame\'s timing to this file')
+    parser.add_argument('--replay', help='replay an input recording as fast as possible, headless with --headless')
+    parser.add_argument('--replay-timed', action='store_true', help='replay the recorded frame timings too, so frame numbers match')
+    parser.add_argument('--surface-budget', type=float, default=128, help='megabytes the game\'s surfaces may take before caches are evicted')
+    parser.add_argument('--save', help='continue from this save file if it exists, and autosave to it')
+    parser.add_argument('--connect', help='play on the multiplayer server at host:port or unix:path, see server.py')
+    parser.add_argument('--profile', action='store_true', help='start with the frame profiler on')
+    parser.add_argument('--profile-log', help='stream per-frame phase timings to this .csv or .jsonl file')
+    args = parser.parse_args()
+    surface_budget = int(args.surface_budget * 1024 * 1024)
+    frame_profiler = profiler.FrameProfiler(enabled=args.profile or bool(args.profile_log), log_path=args.profile_log)
+    if args.replay:
+        if args.headless:
+            screen = init_headless()
+        else:
+            pygame.init()
+            screen = pygame.display.set_mode(dims, flags=pygame.SCALED, vsync=0)
+        game = run_replay(args.replay, screen, timed=args.replay_timed, frame_profiler=frame_profiler, surface_budget=surface_budget)
+        print(f"Player at {game.player.x}, {game.player.y}")
+        if frame_profiler.enabled:
+            print('\n'.join(frame_profiler.overlay_lines()))
+    elif args.headless:
+        script = read_script(args.script) if args.script else None
+        game = run_headless(args.frames, script, map_path=args.map, npcs=args.npcs, frame_profiler=frame_profiler, 
+                            record_path=args.record, save_path=args.save, surface_budget=surface_budget)
+        print(f"Ran {args.frames} frames, player at {game.player.x}, {game.player.y}")
+        print('\n'.join(game.memory.overlay_lines()))
+        if frame_profiler.enabled:
+            print('\n'.join(frame_profiler.overlay_lines()))
+    else:
+        pygame.init()
+        screen = pygame.display.set_mode(dims,flags=pygame.SCALED, vsync=0)
+        game = Game(screen, map_path=args.map, npcs=args.npcs, fps=args.fps, frame_profiler=frame_profiler, 
+                    loading_screen=True, preload=args.preload, record_path=args.record, server_address=args.connect, save_path=args.save,
+                    surface_budget=surface_budget)
+        game.mainloop()
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""
+Asset loading.
+Image files are decoded on a pool of worker threads (pygame releases the GIL while decoding), and
+only the conversion to the display format runs on the main thread, a few milliseconds' worth per
+frame so the loading screen keeps drawing. Required assets gate the loading screen, optional ones
+keep loading in the background once the game has started. Work that needs the required assets, like
+building the first world out of its tileset images, is started with then once they are in.
+"""
+import concurrent.futures
+import os
+import time
+
+import pygame
+
+import utils
+
+class AssetLoader:
+    def __init__(self, workers=None):
+        """
+            workers: number of decoding threads, defaults to one per core
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix='assets')
+        # [name, future, finish, required], in the order they were added
+        self.jobs = []
+        self.required_total = 0
+        self.required_done = 0
+        self.optional_total = 0
+        self.optional_done = 0
+        # functions to call on the main thread once the required jobs added before them are finished
+        self.callbacks = []
+
+    def track(self, name, future, finish=None, required=True):
+        """
+            Tracks work already running elsewhere, e.g. a world the streamer loads.
+            finish: called on the main thread with the result once it is ready
+            required: whether the loading screen waits for it
+        """
+        self.jobs.append((name, future, finish, required))
+        if required:
+            self.required_total += 1
+        else:
+            self.optional_total += 1
+
+    def add(self, name, work, finish=None, required=True):
+        """Runs work() on a worker thread, then finish(result) on the main thread, see track."""
+        self.track(name, self.executor.submit(work), finish, required)
+
+    def then(self, callback):
+        """
+            Calls callback() on the main thread once every required job added so far is finished. 
+            It may add more jobs, the loader isn't ready until those are finished too.
+        """
+        self.callbacks.append(callback)
+
+    def add_image(self, path, alpha=False, required=True, category='sprites'):
+        """
+            Decodes the image at path in the background and stores it in the asset registry, converted
+            to the display format, under utils.image_key(path, alpha) where utils.SpriteSheet and 
+            mapcache.registry_image_loader find it. Jobs added after it with then see the image.
+            category: the memory category the image counts towards
+        """
+        key = utils.image_key(path, alpha)
+        if utils.assets.find(key) is not None:
+            return
+        def finish(surface):
+            utils.assets.put(key, surface.convert_alpha() if alpha else surface.convert(), category)
+        self.add(path, lambda: pygame.image.load(path), finish, required)
+
+    def update(self, budget_ms=4):
+        """
+            Finishes the jobs whose work is done, on the calling thread, stopping after budget_ms.
+            Returns True once every required job is finished.
+        """
+        deadline = time.perf_counter() + budget_ms / 1000
+        pending = []
+        for job in self.jobs:
+            name, future, finish, required = job
+            if not future.done() or time.perf_counter() > deadline:
+                pending.append(job)
+                continue
+            try:
+                result = future.result()
+                if finish is not None:
+                    finish(result)
+            except Exception as e:
+                print(f"Unable to load {name}: {e}")
+                if required:
+                    raise SystemExit(e)
+            if required:
+                self.required_done += 1
+            else:
+                self.optional_done += 1
+        self.jobs = pending
+        while self.callbacks and self.required_done == self.required_total:
+            self.callbacks.pop(0)()
+        return self.ready()
+
+    def wait(self):
+        """Blocks until every required job is finished."""
+        while not self.update(budget_ms=float('inf')):
+            concurrent.futures.wait([future for _, future, _, required in self.jobs if required],
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def ready(self):
+        return self.required_done == self.required_total and not self.callbacks
+
+    def busy(self):
+        """Returns True while any job, required or optional, is unfinished."""
+        return bool(self.jobs)
+
+    def progress(self):
+        """Returns the fraction of the required jobs that are finished, a pending then counts as one job."""
+        total = self.required_total + len(self.callbacks)
+        return self.required_done / total if total else 1.0
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,133 @@
+"""
+Loopback load test for the multiplayer server.
+Starts a GameServer and connects simulated clients to it over loopback TCP or a Unix socket, all
+in one event loop. Each simulated client wanders in random directions and now and then presses
+SPACE, like a player would. Reports how long the server's ticks took and how many bytes each client
+received, for example:
+    python loadtest.py --clients 200 --seconds 10
+    python loadtest.py --clients 500 --unix --out loadtest.json
+The server's tick times only cover its own work, not the simulated clients sharing the process.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import game
+import network
+import recording
+import server
+
+class SimulatedClient:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.snapshots = 0
+
+    async def run(self, address, stop):
+        kind, target = network.parse_address(address)
+        if kind == 'unix':
+            reader, writer = await asyncio.open_unix_connection(target)
+        else:
+            reader, writer = await asyncio.open_connection(*target)
+        receiving = asyncio.create_task(self.receive(reader))
+        while not stop.is_set():
+            direction = self.rng.choice(recording.DIRECTION_CODES)
+            action = 'SPACE' if self.rng.random() < 0.1 else None
+            writer.write(bytes((recording.encode({'direction': direction, 'action': action}),)))
+            self.bytes_sent += 1
+            try:
+                await asyncio.wait_for(stop.wait(), self.rng.uniform(0.2, 1.0))
+            except asyncio.TimeoutError:
+                pass
+        writer.close()
+        receiving.cancel()
+
+    async def receive(self, reader):
+        buffer = bytearray()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            self.bytes_received += len(data)
+            buffer += data
+            for kind, _ in network.split_messages(buffer):
+                if kind == network.SNAPSHOT:
+                    self.snapshots += 1
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+async def load_test(map_path, clients, seconds, tick_rate, unix):
+    game_server = server.GameServer(map_path, tick_rate)
+    if unix:
+        address = 'unix:' + os.path.join(tempfile.mkdtemp(), 'bool.sock')
+        listener = await game_server.listen(address)
+    else:
+        listener = await game_server.listen('127.0.0.1:0')
+        address = '127.0.0.1:%d' % listener.sockets[0].getsockname()[1]
+    ticking = asyncio.create_task(game_server.run())
+    stop = asyncio.Event()
+    simulated = [SimulatedClient(seed) for seed in range(clients)]
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(client.run(address, stop)) for client in simulated]
+    while len(game_server.clients) < clients:
+        failed = [task for task in tasks if task.done() and task.exception()]
+        if failed:
+            raise failed[0].exception()
+        await asyncio.sleep(0.01)
+    connect_s = time.perf_counter() - start
+    # only the ticks with everyone connected count
+    game_server.tick_times.clear()
+    game_server.overruns = 0
+    first_tick = game_server.tick_count
+    received = [client.bytes_received for client in simulated]
+    await asyncio.sleep(seconds)
+    ticks = game_server.tick_count - first_tick
+    received = [client.bytes_received - before for client, before in zip(simulated, received)]
+    tick_times = list(game_server.tick_times)
+    stop.set()
+    await asyncio.gather(*tasks)
+    game_server.stop()
+    await ticking
+    game_server.close()
+    listener.close()
+    return {
+        'clients': clients,
+        'transport': 'unix' if unix else 'tcp',
+        'tick_rate': tick_rate,
+        'connect_s': connect_s,
+        'ticks': ticks,
+        'tick_ms_mean': statistics.fmean(tick_times) if tick_times else 0.0,
+        'tick_ms_p50': percentile(tick_times, 50),
+        'tick_ms_p95': percentile(tick_times, 95),
+        'tick_ms_max': max(tick_times, default=0.0),
+        'overruns': game_server.overruns,
+        'bytes_per_client_per_tick': statistics.fmean(received) / max(ticks, 1),
+        'bytes_per_client_per_s': statistics.fmean(received) / seconds,
+        'bytes_per_client_max_per_s': max(received) / seconds,
+        'input_bytes_per_client': statistics.fmean(client.bytes_sent for client in simulated),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loopback load test for the multiplayer server')
+    parser.add_argument('--map', default='tiled/boolground.tmx', help='Tiled map the server runs')
+    parser.add_argument('--clients', type=int, default=200, help='number of simulated clients')
+    parser.add_argument('--seconds', type=float, default=10, help='how long to measure once everyone is connected')
+    parser.add_argument('--tick-rate', type=float, default=30, help='server simulation steps per second')
+    parser.add_argument('--unix', action='store_true', help='connect over a Unix socket instead of TCP')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    args = parser.parse_args()
+    game.init_headless((1, 1))
+    results = asyncio.run(load_test(args.map, args.clients, args.seconds, args.tick_rate, args.unix))
+    for name, value in results.items():
+        print(f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,328 @@
+"""
+Compiled map cache.
+Parsing a TMX map with pytmx means parsing XML, resolving every external tileset and decoding
+and slicing every tileset image. compile_map turns all of that into one binary bundle holding the
+layer gid grids, the Doors objects, the Tiled tile animations and an atlas of every tile already composited on black, the
+way World draws them. Images of another size than the map's tiles, like the 16x32 tiles of pkmn.tsx, are stored
+next to the atlas at their own size. load_map reads the bundle back through a memory map, and falls back to
+pytmx (writing a fresh bundle) when the bundle is missing or any source file changed. pytmx then
+takes the tileset images from the asset registry if loader.AssetLoader already decoded them, see
+tileset_images.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import pygame
+import pytmx
+import pytmx.util_pygame
+
+import utils
+
+MAGIC = b'BMAP'
+VERSION = 3
+# magic, version, header length
+PREAMBLE = struct.Struct('<4sII')
+ALIGN = 16
+ATLAS_COLUMNS = 64
+# the tile layers and object group World reads
+TILE_LAYERS = ('Ground', 'Objects', 'Foreground')
+OBJECT_LAYERS = ('Doors',)
+
+class CompiledLayer:
+    def __init__(self, name, data):
+        """
+            A tile layer loaded from a bundle, with the parts of pytmx.TiledTileLayer that World uses.
+            data: (height, width) array of gids, indexed data[y][x] like pytmx's list of lists
+        """
+        self.name = name
+        self.data = data
+        self.height, self.width = data.shape
+
+    def __iter__(self):
+        for y, row in enumerate(self.data.tolist()):
+            for x, gid in enumerate(row):
+                yield x, y, gid
+
+class CompiledObject:
+    def __init__(self, name, type, x, y, width, height, properties):
+        """A map object loaded from a bundle, with the attributes of pytmx.TiledObject that the game uses."""
+        self.name = name
+        self.type = type
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.properties = properties
+
+class CompiledMap:
+    def __init__(self, header, layers, objects, images, path=None):
+        """
+            A map loaded from a bundle. It has the parts of the pytmx.TiledMap interface that World uses,
+            so World doesn't need to know where its map came from.
+        """
+        self.filename = path
+        self.width = header['width']
+        self.height = header['height']
+        self.tilewidth = header['tilewidth']
+        self.tileheight = header['tileheight']
+        self.properties = header.get('properties', {})
+        self.layers = layers
+        self.objects = objects
+        self.images = images
+        # only the animation frames are kept, as (gid, duration) pairs like pytmx's AnimationFrame
+        self.tile_properties = {int(gid): {'frames': [tuple(frame) for frame in frames]} 
+                                for gid, frames in header.get('animations', {}).items()}
+
+    def get_layer_by_name(self, name):
+        if name in self.layers:
+            return self.layers[name]
+        if name in self.objects:
+            return self.objects[name]
+        raise ValueError(f"Layer '{name}' not found")
+
+    def get_tile_image_by_gid(self, gid):
+        return self.images[gid]
+
+def bundle_path(tmx_path):
+    """Returns where the bundle for tmx_path is stored, in a .mapcache directory next to the map."""
+    directory, name = os.path.split(os.path.abspath(tmx_path))
+    return os.path.join(directory, '.mapcache', os.path.splitext(name)[0] + '.bmap')
+
+def source_files(tmx_path):
+    """Returns the map file followed by every tileset and image it depends on, as absolute paths."""
+    tmx_path = os.path.abspath(tmx_path)
+    files = [tmx_path]
+    root = ElementTree.parse(tmx_path).getroot()
+    for tileset in root.iter('tileset'):
+        directory = os.path.dirname(tmx_path)
+        source = tileset.get('source')
+        if source:
+            tsx_path = os.path.normpath(os.path.join(directory, source))
+            files.append(tsx_path)
+            directory = os.path.dirname(tsx_path)
+            tileset = ElementTree.parse(tsx_path).getroot()
+        for image in tileset.iter('image'):
+            files.append(os.path.normpath(os.path.join(directory, image.get('source'))))
+    return files
+
+def tileset_images(tmx_path):
+    """
+        Returns the paths of the tileset images load_map will decode for tmx_path, as absolute paths, 
+        or an empty list if its bundle is up to date and no image needs decoding.
+    """
+    bundle = read_bundle(bundle_path(tmx_path))
+    if bundle is not None:
+        bundle[1].close()
+        if is_fresh(bundle[0]['sources']):
+            return []
+    return [path for path in source_files(tmx_path)[1:] if not path.endswith(('.tmx', '.tsx'))]
+
+def registry_image_loader(filename, colorkey, **kwargs):
+    """
+        pytmx image loader that works like pytmx.util_pygame.pygame_image_loader, but takes the 
+        tileset image from the asset registry when loader.AssetLoader put it there, under 
+        utils.image_key(path, alpha=True). Only images that aren't there are decoded on the 
+        calling thread. The tiles aren't converted to the display format, maps load on the streaming 
+        thread and World.convert does that on the main thread.
+    """
+    if colorkey:
+        colorkey = pygame.Color("#{0}".format(colorkey))
+    image = utils.assets.find(utils.image_key(os.path.normpath(os.path.abspath(filename)), True))
+    if image is None:
+        image = pygame.image.load(filename)
+
+    def load_image(rect=None, flags=None):
+        tile = image.subsurface(rect) if rect else image.copy()
+        if flags:
+            tile = pytmx.util_pygame.handle_transformation(tile, flags)
+        if colorkey:
+            tile.set_colorkey(colorkey)
+        return tile
+
+    return load_image
+
+def parse_map(tmx_path):
+    """Loads a map with pytmx, like pytmx.load_pygame but through registry_image_loader."""
+    return pytmx.TiledMap(tmx_path, image_loader=registry_image_loader)
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def describe_sources(tmx_path):
+    """Returns {path: [mtime_ns, size, sha1]} for every source file of the map."""
+    sources = {}
+    for path in source_files(tmx_path):
+        stat = os.stat(path)
+        sources[path] = [stat.st_mtime_ns, stat.st_size, file_hash(path)]
+    return sources
+
+def is_fresh(sources):
+    """
+        Checks the source files recorded in a bundle. Files whose mtime and size are unchanged are
+        trusted, the others are hashed, so touching a file doesn't invalidate the cache.
+    """
+    for path, (mtime, size, digest) in sources.items():
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_mtime_ns == mtime and stat.st_size == size:
+            continue
+        if stat.st_size != size or file_hash(path) != digest:
+            return False
+    return True
+
+def aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+def compile_map(tiled_map, tmx_path, out_path=None):
+    """
+        Writes the bundle for a map loaded with pytmx.load_pygame. Returns the bundle's path.
+        Every tile image is composited on black into one RGB atlas, which is exactly how World
+        bakes tiles, so drawing from the bundle gives the same pixels. Images that don't have the
+        map's tile size are composited the same way into blobs of their own.
+    """
+    out_path = out_path or bundle_path(tmx_path)
+    tw, th = tiled_map.tilewidth, tiled_map.tileheight
+    gids = [gid for gid, image in enumerate(tiled_map.images) if image is not None and image.get_size() == (tw, th)]
+    rows = max(1, -(-len(gids) // ATLAS_COLUMNS))
+    atlas = pygame.Surface((ATLAS_COLUMNS * tw, rows * th))
+    atlas.fill((0, 0, 0))
+    for slot, gid in enumerate(gids):
+        atlas.blit(tiled_map.images[gid], ((slot % ATLAS_COLUMNS) * tw, (slot // ATLAS_COLUMNS) * th))
+    atlas_bytes = pygame.image.tobytes(atlas, 'RGB')
+    # gid -> RGB bytes of the images that don't fit the atlas grid
+    oversized = {}
+    for gid, image in enumerate(tiled_map.images):
+        if image is not None and image.get_size() != (tw, th):
+            surface = pygame.Surface(image.get_size())
+            surface.fill((0, 0, 0))
+            surface.blit(image, (0, 0))
+            oversized[gid] = surface
+
+    blobs = []
+    offset = 0
+    def add_blob(data):
+        nonlocal offset
+        blobs.append((offset, data))
+        start = offset
+        offset = aligned(offset + len(data))
+        return start
+
+    layers = []
+    for name in TILE_LAYERS:
+        layer = tiled_map.get_layer_by_name(name)
+        data = np.array(layer.data, dtype=np.uint32).reshape(tiled_map.height, tiled_map.width)
+        layers.append({'name': name, 'offset': add_blob(data.tobytes())})
+    objects = {}
+    for name in OBJECT_LAYERS:
+        objects[name] = [{'name': o.name, 'type': o.type, 'x': o.x, 'y': o.y, 'width': o.width, 'height': o.height,
+                          'properties': dict(o.properties)} for o in tiled_map.get_layer_by_name(name)]
+    header = {
+        'sources': describe_sources(tmx_path),
+        'width': tiled_map.width,
+        'height': tiled_map.height,
+        'tilewidth': tw,
+        'tileheight': th,
+        'properties': dict(tiled_map.properties),
+        'layers': layers,
+        'objects': objects,
+        'atlas': {'offset': add_blob(atlas_bytes), 'width': atlas.get_width(), 'height': atlas.get_height()},
+        'gids': gids,
+        'oversized': [{'gid': gid, 'offset': add_blob(pygame.image.tobytes(surface, 'RGB')),
+                       'width': surface.get_width(), 'height': surface.get_height()} for gid, surface in oversized.items()],
+        'animations': {str(gid): [[frame_gid, duration] for frame_gid, duration in properties['frames']]
+                       for gid, properties in tiled_map.tile_properties.items() if properties.get('frames')},
+        'images': len(tiled_map.images),
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = aligned(PREAMBLE.size + len(header_bytes))
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    # write to a temporary file first so a crash never leaves a half written bundle behind
+    temp_path = out_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for start, data in blobs:
+            f.seek(data_start + start)
+            f.write(data)
+    os.replace(temp_path, out_path)
+    return out_path
+
+def read_bundle(path):
+    """
+        Opens a bundle and returns (header, memory map, offset of the data section), or None if the
+        file is missing or was written by another version.
+    """
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    with f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size:
+            return None
+        magic, version, header_length = PREAMBLE.unpack(preamble)
+        if magic != MAGIC or version != VERSION:
+            return None
+        header = json.loads(f.read(header_length).decode('utf-8'))
+        # copy on write, so set_tile can change the layers without touching the file
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return header, mm, aligned(PREAMBLE.size + header_length)
+
+def load_bundle(bundle, path=None):
+    """Builds a CompiledMap from a bundle opened with read_bundle, without checking its sources."""
+    header, mm, data_start = bundle
+    width, height = header['width'], header['height']
+    layers = {}
+    for layer in header['layers']:
+        data = np.frombuffer(mm, dtype=np.uint32, count=width * height, offset=data_start + layer['offset'])
+        layers[layer['name']] = CompiledLayer(layer['name'], data.reshape(height, width))
+    objects = {name: [CompiledObject(**o) for o in group] for name, group in header['objects'].items()}
+
+    atlas_info = header['atlas']
+    size = atlas_info['width'] * atlas_info['height'] * 3
+    start = data_start + atlas_info['offset']
+    # the images are only blitted into World's prepared tiles, which are converted on the main thread
+    atlas = pygame.image.frombuffer(memoryview(mm)[start:start + size], (atlas_info['width'], atlas_info['height']), 'RGB')
+    tw, th = header['tilewidth'], header['tileheight']
+    images = [None] * header['images']
+    for slot, gid in enumerate(header['gids']):
+        images[gid] = atlas.subsurface(((slot % ATLAS_COLUMNS) * tw, (slot // ATLAS_COLUMNS) * th, tw, th))
+    for info in header['oversized']:
+        start = data_start + info['offset']
+        size = info['width'] * info['height'] * 3
+        image = pygame.image.frombuffer(memoryview(mm)[start:start + size], (info['width'], info['height']), 'RGB')
+        images[info['gid']] = image
+    return CompiledMap(header, layers, objects, images, path)
+
+def load_map(tmx_path, use_cache=True):
+    """
+        Loads a map for World, from its bundle if it is up to date. Otherwise the map is loaded with
+        pytmx and the bundle is rewritten for the next start.
+    """
+    if not use_cache:
+        return parse_map(tmx_path)
+    path = bundle_path(tmx_path)
+    bundle = read_bundle(path)
+    if bundle is not None:
+        if is_fresh(bundle[0]['sources']):
+            return load_bundle(bundle, path)
+        bundle[1].close()
+        print(f"Map cache for {tmx_path} is stale, reloading it")
+    tiled_map = parse_map(tmx_path)
+    try:
+        compile_map(tiled_map, tmx_path, path)
+    except OSError as e:
+        print(f"Unable to write map cache {path}: {e}")
+    return tiled_map
@@ -0,0 +1,118 @@
+"""
+Memory accounting.
+Counts the bytes of the game's surfaces in four categories:
+    tilesets: every loaded map's tile images and prepared tiles, and images preloaded as tilesets
+    sprites: the sprite sheets in the asset registry and the mirrored frames made from them
+    caches: scaled copies of tiles and sprites, baked chunks, rendered text and the minimap
+    frame buffers: the display surface
+and keeps the total under a budget. Once over it, the least recently used scaled copies go first,
+then the chunks of maps other than the current one, the current map's chunks at other scales and
+its least recently used chunks outside the camera's view, and then preloaded tilesets, all of which
+are made again on demand. When what is left is still over the budget it is reported once, and
+nothing more is evicted until usage grows past that point.
+The tiles of a map the streamer evicts, and their scaled copies, are released with it.
+"""
+import weakref
+
+import utils
+
+CATEGORIES = ('tilesets', 'sprites', 'caches', 'frame buffers')
+
+def unique_bytes(surfaces):
+    """Returns the bytes of the surfaces, counting shared parent surfaces once."""
+    roots = {}
+    for surface in surfaces:
+        if surface is None:
+            continue
+        while surface.get_parent() is not None:
+            surface = surface.get_parent()
+        roots[id(surface)] = surface
+    return sum(utils.surface_bytes(surface) for surface in roots.values())
+
+class MemoryMonitor:
+    def __init__(self, budget=128 * 1024 * 1024):
+        """
+            budget: bytes the surfaces of every category together may take before caches are evicted
+        """
+        self.budget = budget
+        self.usage = dict.fromkeys(CATEGORIES, 0)
+        self.evicted_bytes = 0
+        # whether the last check was still over budget after evicting, so it is only reported once, 
+        # and the total then. Evicting again before usage grows past it would only drop what the 
+        # next frames draw.
+        self.stuck = False
+        self.stuck_total = 0
+        self.overlay = []
+        # world -> bytes of its map's tile images, they never change once the map is loaded
+        self.source_bytes = weakref.WeakKeyDictionary()
+
+    def world_tileset_bytes(self, world):
+        source = self.source_bytes.get(world)
+        if source is None:
+            source = self.source_bytes[world] = unique_bytes(world.tiled_map.images)
+        return source + world.tiles.prepared_bytes
+
+    def measure(self, game):
+        """Returns {category: bytes} for game, and keeps it in usage."""
+        worlds = list(game.streamer.worlds.values())
+        assets = utils.assets.bytes_by_category()
+        caches = utils.scaled_surfaces.bytes + sum(world.chunk_bytes() for world in worlds)
+        camera = game.camera
+        if camera is not None and camera.text is not None:
+            caches += sum(utils.surface_bytes(text) for text in camera.text.entries.values())
+        if game.minimap is not None:
+            caches += utils.surface_bytes(game.minimap.surface) + utils.surface_bytes(game.minimap.frame)
+        self.usage = {
+            'tilesets': sum(self.world_tileset_bytes(world) for world in worlds) + assets.get('tilesets', 0),
+            'sprites': assets.get('sprites', 0),
+            'caches': caches,
+            'frame buffers': utils.surface_bytes(game.screen),
+        }
+        return self.usage
+
+    def total(self):
+        return sum(self.usage.values())
+
+    def update(self, game):
+        """Measures game and evicts caches if it is over the budget."""
+        self.measure(game)
+        total = self.total()
+        over = total - self.budget
+        if over <= 0:
+            self.stuck = False
+        elif not self.stuck or total > self.stuck_total:
+            freed = self.evict(game, over)
+            self.evicted_bytes += freed
+            self.measure(game)
+            if not self.stuck:
+                left = ", the rest is in use" if self.total() > self.budget else ""
+                print(f"Memory {total / 2 ** 20:.1f} MB is over the {self.budget / 2 ** 20:.1f} MB budget, evicted {freed / 1024:.0f} KB{left}")
+            self.stuck = self.total() > self.budget
+            self.stuck_total = self.total()
+        self.overlay = self.overlay_lines()
+
+    def evict(self, game, nbytes):
+        """Frees at least nbytes from the caches if they hold that much. Returns the bytes freed."""
+        freed = utils.scaled_surfaces.evict(nbytes)
+        # least recently used maps first
+        for world in game.streamer.worlds.values():
+            if freed >= nbytes:
+                break
+            if world is not game.world:
+                freed += world.release_chunks()
+        if freed < nbytes and game.world is not None:
+            view = game.camera.view_rect() if game.camera is not None else None
+            freed += game.world.trim_chunks(nbytes - freed, view)
+        if freed < nbytes:
+            freed += utils.assets.evict('tilesets', nbytes - freed)
+        return freed
+
+    def world_evicted(self, path, world):
+        """Called by the streamer when it evicts a world, drops the scaled copies of its tiles."""
+        utils.scaled_surfaces.discard(world.tiles.by_hash.values())
+
+    def overlay_lines(self):
+        """Returns the lines of text shown in the debug overlay."""
+        lines = [f"Memory {self.total() / 2 ** 20:.1f} / {self.budget / 2 ** 20:.1f} MB"]
+        lines += [f"{category} {self.usage[category] / 2 ** 20:.2f} MB" for category in CATEGORIES]
+        return lines
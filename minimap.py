@@ -0,0 +1,149 @@
+"""
+Minimap.
+Every gid gets one colour, the average of its tile's visible pixels. The minimap image is then a
+NumPy gather: each minimap pixel samples the Foreground, Objects and Ground gids of one tile, keeps
+the top-most one that isn't transparent and looks its colour up, so the gather costs as much as
+the minimap has pixels however big the map is. Changed tiles and doors only repaint their own cells.
+Every frame the image is copied into a frame buffer and the player and NPC dots are scattered into
+its pixels with one NumPy assignment, however many NPCs there are.
+"""
+import numpy as np
+import pygame
+
+def average_color(surface):
+    """Returns the average (r, g, b) of the surface's pixels that aren't its colorkey, or None if there are none."""
+    pixels = pygame.surfarray.array3d(surface).reshape(-1, 3)
+    colorkey = surface.get_colorkey()
+    if colorkey is not None:
+        pixels = pixels[(pixels != colorkey[:3]).any(axis=1)]
+    if not len(pixels):
+        return None
+    return tuple(int(c) for c in pixels.mean(axis=0))
+
+class Minimap:
+    DOOR_COLOR = (120, 72, 32)
+    PLAYER_COLOR = (255, 40, 40)
+    NPC_COLOR = (255, 230, 60)
+
+    def __init__(self, world, max_size=(120, 90)):
+        """
+            A scaled down image of the whole world.
+            world: the world object, the minimap follows its tile and door changes
+            max_size: the most pixels the minimap takes up, it keeps the world's aspect ratio
+        """
+        self.max_size = max_size
+        self.world = None
+        self.set_world(world)
+
+    def set_world(self, world):
+        """Shows another world, rebuilding the palette and the image."""
+        if self.world is not None:
+            self.world.tile_listeners.remove(self.tile_changed)
+        self.world = world
+        world.tile_listeners.append(self.tile_changed)
+        fit = min(self.max_size[0] / world.width, self.max_size[1] / world.height)
+        self.width = max(1, round(world.width * fit))
+        self.height = max(1, round(world.height * fit))
+        # the tile each minimap column and row samples
+        self.xs = np.arange(self.width) * world.width // self.width
+        self.ys = np.arange(self.height) * world.height // self.height
+        self.dot = max(2, round(fit))
+        self.surface = pygame.Surface((self.width, self.height))
+        # the image with the dots on it, redrawn every frame
+        self.frame = pygame.Surface((self.width, self.height))
+        self.build()
+
+    def build_palette(self, layers):
+        """Computes the colour of every gid used in layers, an array of gids."""
+        gids = np.unique(layers)
+        size = int(gids.max()) + 1 if gids.size else 1
+        self.colors = np.zeros((size, 3), dtype=np.uint8)
+        self.opaque = np.zeros(size, dtype=bool)
+        for gid in gids.tolist():
+            tile = self.world.tile_image(gid) if gid else None
+            color = average_color(tile) if tile else None
+            if color is not None:
+                self.colors[gid] = color
+                self.opaque[gid] = True
+
+    def color_of(self, gid):
+        """Returns the colour of gid, or None if it is transparent, extending the palette for gids placed since the build."""
+        if gid >= len(self.opaque):
+            self.colors = np.concatenate([self.colors, np.zeros((gid + 1 - len(self.colors), 3), dtype=np.uint8)])
+            self.opaque = np.concatenate([self.opaque, np.zeros(gid + 1 - len(self.opaque), dtype=bool)])
+        if gid and not self.opaque[gid]:
+            tile = self.world.tile_image(gid)
+            color = average_color(tile) if tile else None
+            if color is not None:
+                self.colors[gid] = color
+                self.opaque[gid] = True
+        return tuple(self.colors[gid]) if self.opaque[gid] else None
+
+    def build(self):
+        """Renders the whole image from the layers, in one gather over the sampled tiles."""
+        world = self.world
+        # (3, height, width) gids of the sampled tiles, top-most layer first
+        layers = np.stack([np.asarray(layer.data, dtype=np.uint32)[self.ys[:, None], self.xs[None, :]]
+                           for layer in (world.foreground, world.objects, world.ground)])
+        self.build_palette(layers)
+        top = self.opaque[layers].argmax(axis=0)
+        gids = np.take_along_axis(layers, top[None], axis=0)[0]
+        pygame.surfarray.blit_array(self.surface, self.colors[gids].swapaxes(0, 1))
+        for door in world.doors.values():
+            if not door.is_open():
+                self.paint(*door.tile, self.DOOR_COLOR)
+
+    def cells(self, x, y):
+        """Returns the minimap rect showing tile (x, y), empty if the tile isn't sampled."""
+        x0, x1 = np.searchsorted(self.xs, (x, x + 1))
+        y0, y1 = np.searchsorted(self.ys, (y, y + 1))
+        return pygame.Rect(int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+
+    def paint(self, x, y, color):
+        rect = self.cells(x, y)
+        if rect.width and rect.height:
+            self.surface.fill(color, rect)
+
+    def tile_changed(self, x, y):
+        """Repaints tile (x, y), called by the world when a tile is replaced or a door changes state."""
+        world = self.world
+        door = world.doors.get((x, y))
+        if door is not None and not door.is_open():
+            self.paint(x, y, self.DOOR_COLOR)
+            return
+        for layer in (world.foreground, world.objects, world.ground):
+            color = self.color_of(int(layer.data[y][x]))
+            if color is not None:
+                self.paint(x, y, color)
+                return
+        self.paint(x, y, (0, 0, 0))
+
+    def draw(self, surface, position, player):
+        """Blits the minimap to surface at position with the player and NPCs on it. Returns the rect it covers."""
+        frame = self.frame
+        frame.blit(self.surface, (0, 0))
+        world = self.world
+        npcs = world.npcs
+        if npcs is not None and npcs.count:
+            pixels = pygame.surfarray.pixels2d(frame)
+            try:
+                self.scatter(pixels, npcs.x[:npcs.count], npcs.y[:npcs.count], frame.map_rgb(self.NPC_COLOR))
+            finally:
+                # the view locks the frame until it is released
+                del pixels
+        dot = self.dot
+        rect = pygame.Rect(player.x * self.width // world.width - dot // 2, player.y * self.height // world.height - dot // 2, dot, dot)
+        frame.fill(self.PLAYER_COLOR, rect.clip(frame.get_rect()))
+        return surface.blit(frame, position)
+
+    def scatter(self, pixels, xs, ys, color):
+        """Paints a dot centred on each tile (xs[i], ys[i]) into pixels, a pixels2d view of the frame, 
+            color being a mapped colour. Dots on the border are cut off.
+        """
+        offsets = np.arange(self.dot) - self.dot // 2
+        # (n, 1, dot) and (n, dot, 1), every pixel of every dot once broadcast
+        px = (xs.astype(np.intp) * self.width // self.world.width)[:, None, None] + offsets[None, None, :]
+        py = (ys.astype(np.intp) * self.height // self.world.height)[:, None, None] + offsets[None, :, None]
+        px, py = np.broadcast_arrays(px, py)
+        inside = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+        pixels[px[inside], py[inside]] = color
@@ -0,0 +1,229 @@
+"""
+Multiplayer protocol and client.
+The server (server.py) owns the world: the door states and where every player is. Clients only send
+their input and show what the server tells them. After every tick the server sends one snapshot
+holding just the doors whose state changed and the players that moved, the same bytes to every
+client, so a tick costs one encoding however many clients are connected. A client that joins gets
+the full state in the same format first, everything after that is a delta on top of it.
+
+Messages, little endian:
+    client to server: one byte whenever the input changes, a tick byte of recording.py
+    server to client: type (uint8) and payload length (uint32), then the payload
+        WELCOME: the client's player id, the tick rate, the map path length, then the map path, UTF-8
+        SNAPSHOT: tick (uint32), door count, entity count (uint16 each), then the doors and the entities
+            door: tile x, tile y, index into Door.STATES of game.py
+            entity: player id, tile x, tile y (uint16 each), the direction code of recording.py plus the
+                flags shifted left by 3, the animation frame (uint8 each). Players walk from tile to tile
+                half a tile per animation frame, so the pixel position follows from these.
+Addresses are 'host:port' for TCP or 'unix:path' for a Unix socket.
+"""
+import socket
+import struct
+
+import recording
+
+MESSAGE = struct.Struct('<BI')
+WELCOME = 1
+SNAPSHOT = 2
+WELCOME_HEADER = struct.Struct('<HfH')
+SNAPSHOT_HEADER = struct.Struct('<IHH')
+DOOR = struct.Struct('<HHB')
+ENTITY = struct.Struct('<HHHBB')
+MOVES = {None: (0, 0), 'UP': (0, -1), 'DOWN': (0, 1), 'LEFT': (-1, 0), 'RIGHT': (1, 0)}
+# entity flags
+WALKING = 1
+GONE = 2
+
+def parse_address(address):
+    """Returns ('unix', path) or ('tcp', (host, port)) for an address string."""
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+def message(kind, payload):
+    return MESSAGE.pack(kind, len(payload)) + payload
+
+def encode_welcome(player_id, tick_rate, map_path):
+    map_bytes = map_path.encode('utf-8')
+    return message(WELCOME, WELCOME_HEADER.pack(player_id, tick_rate, len(map_bytes)) + map_bytes)
+
+def decode_welcome(payload):
+    """Returns (player id, tick rate, map path)."""
+    player_id, tick_rate, length = WELCOME_HEADER.unpack_from(payload)
+    return player_id, tick_rate, bytes(payload[WELCOME_HEADER.size:WELCOME_HEADER.size + length]).decode('utf-8')
+
+def encode_snapshot(tick, doors, entities):
+    """
+        doors: list of (x, y, state index)
+        entities: list of (id, x, y, direction code | flags << 3, animation frame)
+    """
+    parts = [SNAPSHOT_HEADER.pack(tick, len(doors), len(entities))]
+    parts.extend(DOOR.pack(*door) for door in doors)
+    parts.extend(ENTITY.pack(*entity) for entity in entities)
+    return message(SNAPSHOT, b''.join(parts))
+
+def decode_snapshot(payload):
+    """Returns (tick, doors, entities), see encode_snapshot."""
+    tick, door_count, entity_count = SNAPSHOT_HEADER.unpack_from(payload)
+    position = SNAPSHOT_HEADER.size
+    doors = list(DOOR.iter_unpack(payload[position:position + door_count * DOOR.size]))
+    position += door_count * DOOR.size
+    entities = list(ENTITY.iter_unpack(payload[position:position + entity_count * ENTITY.size]))
+    return tick, doors, entities
+
+def split_messages(buffer):
+    """Removes the complete messages from the start of buffer, a bytearray. Returns them as a list of (type, payload)."""
+    messages = []
+    position = 0
+    while len(buffer) - position >= MESSAGE.size:
+        kind, length = MESSAGE.unpack_from(buffer, position)
+        end = position + MESSAGE.size + length
+        if end > len(buffer):
+            break
+        messages.append((kind, bytes(buffer[position + MESSAGE.size:end])))
+        position = end
+    del buffer[:position]
+    return messages
+
+def connect(address):
+    """Returns a blocking socket connected to address."""
+    kind, target = parse_address(address)
+    if kind == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target)
+        return sock
+    sock = socket.create_connection(target)
+    # snapshots and input bytes are tiny, they must not wait to be batched
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+class Client:
+    def __init__(self, address):
+        """
+            A thin game client. Connects to the server at address and waits for the welcome, which
+            says which player is ours and what map and tick rate the server runs.
+        """
+        self.sock = connect(address)
+        self.buffer = bytearray()
+        self.sent = None
+        self.connected = True
+        self.bytes_received = 0
+        self.pending = []
+        while True:
+            messages = self.receive(block=True)
+            if not self.connected:
+                raise ConnectionError(f"{address} closed the connection before welcoming us")
+            if messages and messages[0][0] == WELCOME:
+                break
+        self.player_id, self.tick_rate, self.map_path = decode_welcome(messages[0][1])
+        self.pending = messages[1:]
+        self.sock.setblocking(False)
+        # server player id -> NPC id of the other players
+        self.npc_ids = {}
+        # NPC id -> server player id
+        self.owners = []
+        print(f"Connected to {address} as player {self.player_id}, map {self.map_path}")
+
+    def receive(self, block=False):
+        """Reads what the server sent so far and returns the complete messages."""
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                print(f"Connection lost: {e}")
+                data = b''
+            if not data:
+                self.connected = False
+                break
+            self.bytes_received += len(data)
+            self.buffer += data
+            if block:
+                break
+        return split_messages(self.buffer)
+
+    def send_actions(self, actions):
+        """Sends the input to the server if it changed since it was last sent."""
+        byte = recording.encode(actions)
+        if byte != self.sent and self.connected:
+            try:
+                self.sock.sendall(bytes((byte,)))
+                self.sent = byte
+            except OSError as e:
+                print(f"Connection lost: {e}")
+                self.connected = False
+
+    def update(self, actions, world, player):
+        """
+            Sends the input and applies every snapshot that arrived to the world, the player and the
+            world's NPCs, which stand in for the other players.
+            Returns False once the server has closed the connection.
+        """
+        self.send_actions(actions)
+        messages = self.pending + self.receive()
+        self.pending = []
+        for kind, payload in messages:
+            if kind == SNAPSHOT:
+                self.apply(world, player, *decode_snapshot(payload))
+        return self.connected
+
+    def apply(self, world, player, tick, doors, entities):
+        for x, y, state in doors:
+            door = world.doors.get((x, y))
+            if door is not None:
+                self.apply_door(world, door, door.STATES[state])
+        npcs = world.npcs
+        half = world.tilesize // 2
+        for player_id, x, y, code, anim_frame in entities:
+            direction, flags = recording.DIRECTION_CODES[code & 7], code >> 3
+            # an odd frame is the middle of a step, half a tile past the tile the player is leaving
+            dx, dy = MOVES[direction] if anim_frame % 2 else (0, 0)
+            px, py = x * world.tilesize + dx * half, y * world.tilesize + dy * half
+            if player_id == self.player_id:
+                player.x, player.y = x, y
+                player.rect.topleft = (px, py)
+                player.direction = direction
+                player.anim_frame = anim_frame
+                player.state = 'WALK' if flags & WALKING else 'IDLE'
+                player.image = player.sprites[direction][anim_frame]
+                continue
+            i = self.npc_ids.get(player_id)
+            if flags & GONE:
+                if i is not None:
+                    self.remove(npcs, player_id, i)
+                continue
+            if i is None:
+                i = self.npc_ids[player_id] = npcs.count
+                self.owners.append(player_id)
+            npcs.put(i, x, y, px, py, direction, anim_frame, bool(flags & WALKING))
+
+    def remove(self, npcs, player_id, i):
+        del self.npc_ids[player_id]
+        moved = npcs.remove(i)
+        last = self.owners.pop()
+        if moved is not None:
+            # the last NPC took over id i
+            self.owners[i] = last
+            self.npc_ids[last] = i
+
+    @staticmethod
+    def apply_door(world, door, state):
+        """Moves door to state, animating it locally when it starts opening or closing like on the server."""
+        if door.state == state:
+            return
+        if state == 'OPENING' and door.state == 'CLOSED':
+            door.open()
+        elif state == 'CLOSING' and door.state == 'OPEN':
+            door.close()
+        else:
+            # the local animation is out of step, jump to where the server is
+            door.anim_frame = len(door.sprites) - 1 if state in ('OPEN', 'CLOSING') else 0
+            door.set_state(state)
+            world.dirty_rects.append(door.rect.copy())
+            if state in ('OPENING', 'CLOSING'):
+                world.animator.start(door, door.frame_ms)
+
+    def close(self):
+        self.sock.close()
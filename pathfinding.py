@@ -0,0 +1,291 @@
+import heapq
+import time
+from collections import OrderedDict, deque
+
+# 4-way moves in the same order and with the same offsets as Player.movemap
+MOVES = (('UP', 0, -1), ('DOWN', 0, 1), ('LEFT', -1, 0), ('RIGHT', 1, 0))
+
+class PathRequest:
+    def __init__(self, start, goal, repair=None):
+        """
+            A path search that may take several frames to finish, see Pathfinder.request.
+            start: (x, y) tile the path starts from
+            goal: (x, y) tile the path should reach
+            repair: set by Pathfinder.replan when the search is only a detour around the blocked part 
+                of a path, (the follower's tile, the tiles kept before start, the tiles kept after goal). 
+                path is then the whole repaired path from the follower's tile.
+        """
+        self.start = start
+        self.goal = goal
+        self.repair = repair
+        self.done = False
+        # list of (x, y) tiles from the tile after start up to and including goal, 
+        # or None if the goal can't be reached
+        self.path = None
+        self.search = None
+
+    def finish(self, path):
+        """Sets the path the search found, splicing a detour into the path it repairs."""
+        if path is not None and self.repair is not None:
+            position, before, after = self.repair
+            path = splice(position, before + path + after)
+        self.path = path
+        self.done = True
+
+class Pathfinder:
+    def __init__(self, world, cache_size=1024, expansions_per_step=64):
+        """
+            A* pathfinding on the world's passability grid, with 4-way moves that match Player.movemap.
+            Found paths are cached, and when a door opens or closes only the cached entries 
+            that the change can affect are dropped.
+            It is a standalone service, the NPCs still wander at random and nothing in the game 
+            requests paths yet.
+            world: the world object
+            cache_size: the number of paths kept in the cache
+            expansions_per_step: how many nodes a search expands before it checks the time budget
+        """
+        self.world = world
+        self.cache_size = cache_size
+        self.expansions_per_step = expansions_per_step
+        # (start, goal) -> path, the paths are valid for self.version of the world's collision data
+        self.cache = OrderedDict()
+        # tile index -> set of cache keys whose path goes through that tile
+        self.paths_through = {}
+        self.queue = deque()
+        self.hits = 0
+        self.misses = 0
+        self.rebuild()
+        world.collision_listeners.append(self.collision_changed)
+
+    def rebuild(self):
+        """Copies the passability grid and empties the cache."""
+        self.width, self.height = self.world.width, self.world.height
+        # a flat bytearray is much faster to index from python than the numpy grid
+        self.grid = bytearray(self.world.passable.tobytes())
+        self.version = self.world.collision_version
+        self.cache.clear()
+        self.paths_through.clear()
+
+    def collision_changed(self, x, y, passable):
+        """
+            Called by the world when a tile becomes passable or blocked. 
+            A blocked tile invalidates the cached paths going through it. 
+            An opened tile invalidates the cached failures, since the goal may be reachable now. 
+            Paths that are still valid are kept even though a shorter one may exist.
+        """
+        index = y * self.width + x
+        self.grid[index] = passable
+        if passable:
+            stale = [key for key, path in self.cache.items() if path is None]
+        else:
+            stale = list(self.paths_through.get(index, ()))
+        for key in stale:
+            self.forget(key)
+        self.version = self.world.collision_version
+
+    def forget(self, key):
+        path = self.cache.pop(key)
+        for x, y in path or ():
+            keys = self.paths_through.get(y * self.width + x)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.paths_through[y * self.width + x]
+
+    def remember(self, key, path):
+        self.cache[key] = path
+        for x, y in path or ():
+            self.paths_through.setdefault(y * self.width + x, set()).add(key)
+        if len(self.cache) > self.cache_size:
+            self.forget(next(iter(self.cache)))
+
+    def cached(self, start, goal, count=True):
+        """Returns (True, path) if the path from start to goal is cached, (False, None) otherwise.
+            count: whether the lookup counts towards hits and misses
+        """
+        if self.version != self.world.collision_version or self.width != self.world.width:
+            # the grid changed without telling us, for example it was rebuilt
+            self.rebuild()
+        key = (start, goal)
+        if key in self.cache:
+            self.hits += count
+            self.cache.move_to_end(key)
+            return True, self.cache[key]
+        self.misses += count
+        return False, None
+
+    def find_path(self, start, goal):
+        """
+            Finds a path right away, blocking until the search finishes. 
+            Returns the list of tiles after start up to and including goal, or None if there is no path.
+        """
+        found, path = self.cached(start, goal)
+        if found:
+            return path
+        search = self.search(start, goal)
+        while True:
+            try:
+                next(search)
+            except StopIteration as result:
+                self.remember((start, goal), result.value)
+                return result.value
+
+    def request(self, start, goal, repair=None):
+        """
+            Queues a path search that is advanced by update() within its time budget. 
+            Cached paths are returned already done.
+            repair: see PathRequest
+            Returns a PathRequest, check its done attribute before using its path.
+        """
+        request = PathRequest(start, goal, repair)
+        found, path = self.cached(start, goal)
+        if found:
+            request.finish(path)
+        else:
+            self.queue.append(request)
+        return request
+
+    def update(self, budget_ms=2.0):
+        """
+            Advances the queued searches until they are all done or budget_ms has been spent. 
+            Should be called once per frame. Returns the number of requests finished.
+        """
+        deadline = time.perf_counter_ns() + int(budget_ms * 1_000_000)
+        finished = 0
+        while self.queue and time.perf_counter_ns() < deadline:
+            request = self.queue[0]
+            found = False
+            if request.search is None:
+                # checked when a search starts, not every time it resumes. request already counted 
+                # this lookup's miss.
+                found, path = self.cached(request.start, request.goal, count=False)
+            if found:
+                # an earlier request already found this path
+                request.finish(path)
+            else:
+                if request.search is None:
+                    request.search = self.search(request.start, request.goal)
+                try:
+                    next(request.search)
+                    continue
+                except StopIteration as result:
+                    path = result.value
+                if not self.is_clear(path):
+                    # a door closed on the path while we were searching, start over
+                    request.search = None
+                    continue
+                self.remember((request.start, request.goal), path)
+                request.finish(path)
+            self.queue.popleft()
+            finished += 1
+        return finished
+
+    def is_clear(self, path):
+        """Returns True if every tile of the path can currently be walked on."""
+        grid, width = self.grid, self.width
+        return all(grid[y * width + x] for x, y in path or ())
+
+    def replan(self, request, position):
+        """
+            Checks a path that is being followed from position and repairs it if it got blocked. 
+            Only the blocked stretch is searched again, from the tile before its first blocked tile 
+            to the tile after its last one, and the rest of the old path is kept on both sides. 
+            Both ends are connected to the follower and the goal by clear tiles, so if there is no 
+            detour there is no path at all.
+            request: the PathRequest being followed
+            position: (x, y) tile the follower is standing on, somewhere along the path
+            Returns request itself if the rest of its path is clear, otherwise a new queued PathRequest 
+            whose path is the repaired path from position.
+        """
+        if not request.done:
+            return request
+        path = request.path
+        if path is None:
+            return self.request(position, request.goal)
+        rest = path[path.index(position) + 1:] if position in path else path
+        grid, width = self.grid, self.width
+        blocked = [i for i, (x, y) in enumerate(rest) if not grid[y * width + x]]
+        if not blocked:
+            return request
+        first, last = blocked[0], blocked[-1]
+        if last == len(rest) - 1:
+            # the goal itself is blocked
+            return self.request(position, request.goal)
+        start = rest[first - 1] if first else position
+        return self.request(start, rest[last + 1], repair=(position, rest[:first], rest[last + 2:]))
+
+    def search(self, start, goal):
+        """
+            A* search as a generator, it yields every expansions_per_step expansions so it can be 
+            spread over several frames and returns the path when it finishes.
+        """
+        width, height, grid = self.width, self.height, self.grid
+        sx, sy = start
+        gx, gy = goal
+        if not (0 <= gx < width and 0 <= gy < height) or not grid[gy * width + gx]:
+            return None
+        if not (0 <= sx < width and 0 <= sy < height):
+            return None
+        source, target = sy * width + sx, gy * width + gx
+        came_from = {source: -1}
+        cost = {source: 0}
+        # ties on f are broken towards the deepest node, which keeps the search from 
+        # fanning out across open areas where many paths are equally short
+        heap = [(abs(gx - sx) + abs(gy - sy), 0, source)]
+        expansions = 0
+        while heap:
+            _, g, current = heapq.heappop(heap)
+            g = -g
+            if current == target:
+                path = []
+                while current != source:
+                    path.append((current % width, current // width))
+                    current = came_from[current]
+                path.reverse()
+                return path
+            if g > cost[current]:
+                continue
+            x, y = current % width, current // width
+            g += 1
+            for nx, ny, neighbour in ((x, y - 1, current - width), (x, y + 1, current + width), 
+                                      (x - 1, y, current - 1), (x + 1, y, current + 1)):
+                if 0 <= nx < width and 0 <= ny < height and grid[neighbour] and g < cost.get(neighbour, g + 1):
+                    cost[neighbour] = g
+                    came_from[neighbour] = current
+                    heapq.heappush(heap, (g + abs(gx - nx) + abs(gy - ny), -g, neighbour))
+            expansions += 1
+            if expansions % self.expansions_per_step == 0:
+                yield
+        return None
+
+def splice(start, path):
+    """Cuts the loops out of path, a list of tiles walked from start, where it comes back to a tile it already visited."""
+    result = []
+    # tile -> its index in result, start is just before the first one
+    seen = {start: -1}
+    for tile in path:
+        index = seen.get(tile)
+        if index is not None:
+            for dropped in result[index + 1:]:
+                del seen[dropped]
+            del result[index + 1:]
+            continue
+        seen[tile] = len(result)
+        result.append(tile)
+    return result
+
+def directions(start, path):
+    """
+        Converts a path into the direction names a walker has to move in, one per tile.
+        start: (x, y) tile the path starts from
+        path: list of tiles as returned by Pathfinder.find_path
+    """
+    result = []
+    x, y = start
+    for nx, ny in path:
+        for name, dx, dy in MOVES:
+            if (nx - x, ny - y) == (dx, dy):
+                result.append(name)
+                break
+        x, y = nx, ny
+    return result
@@ -0,0 +1,155 @@
+import collections
+import json
+import time
+
+# phases timed by the game, in the order they run in a frame. These are the CSV log columns.
+PHASES = ('events', 'network', 'player', 'npcs', 'world', 'save', 'camera', 'draw_ground', 'draw_objects', 
+          'draw_entities', 'draw_foreground', 'minimap', 'present')
+
+class NullPhase:
+    """Context manager that does nothing, returned by FrameProfiler.phase while profiling is off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_PHASE = NullPhase()
+
+class Phase:
+    """Context manager timing one phase of the frame, see FrameProfiler.phase."""
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        current = self.profiler.current
+        # a phase can run several times in a frame, e.g. once per dirty rect, so the times add up
+        current[self.name] = current.get(self.name, 0) + time.perf_counter_ns() - self.start
+        return False
+
+class FrameProfiler:
+    def __init__(self, window=300, budget_ms=1000/30, enabled=False, log_path=None):
+        """
+            Times each phase of every frame and keeps rolling statistics over the last frames.
+            Phases are timed with
+                with profiler.phase('draw_ground'):
+                    ...
+            between begin_frame() and end_frame(). While disabled, phase() returns a shared
+            context manager that does nothing, so the instrumentation costs next to nothing.
+            window: the number of recent frames the percentiles are computed over
+            budget_ms: frames taking longer than this are counted as spikes
+            enabled: whether to start profiling right away
+            log_path: optional .csv or .jsonl file every profiled frame is written to
+        """
+        self.window = window
+        self.budget_ns = int(budget_ms * 1_000_000)
+        self.enabled = enabled
+        self.samples = {}
+        self.phases = {}
+        self.current = {}
+        self.frame_start = None
+        self.frames = 0
+        self.spikes = 0
+        self.overlay = []
+        self.log = None
+        self.log_csv = False
+        if log_path:
+            self.open_log(log_path)
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        self.frame_start = None
+
+    def open_log(self, path):
+        """Starts streaming every profiled frame to path, as CSV if it ends in .csv and JSON lines otherwise."""
+        self.close()
+        self.log = open(path, 'w')
+        self.log_csv = path.endswith('.csv')
+        if self.log_csv:
+            self.log.write(','.join(('frame', 'frame_ms') + tuple(f'{name}_ms' for name in PHASES)) + '\n')
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def phase(self, name):
+        """Returns a context manager timing the named phase of the current frame."""
+        if not self.enabled:
+            return NULL_PHASE
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(self, name)
+        return phase
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self.current = {}
+        self.frame_start = time.perf_counter_ns()
+
+    def end_frame(self):
+        if not self.enabled or self.frame_start is None:
+            return
+        total = time.perf_counter_ns() - self.frame_start
+        self.frame_start = None
+        self.frames += 1
+        if total > self.budget_ns:
+            self.spikes += 1
+        self.add_sample('frame', total)
+        for name, duration in self.current.items():
+            self.add_sample(name, duration)
+        if self.log is not None:
+            self.write_log(total)
+        if self.frames % 10 == 1:
+            self.overlay = self.overlay_lines()
+
+    def add_sample(self, name, duration):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = collections.deque(maxlen=self.window)
+        samples.append(duration)
+
+    def write_log(self, total):
+        if self.log_csv:
+            row = [str(self.frames), f'{total / 1e6:.4f}'] + [f'{self.current.get(name, 0) / 1e6:.4f}' for name in PHASES]
+            self.log.write(','.join(row) + '\n')
+        else:
+            record = {'frame': self.frames, 'frame_ms': total / 1e6}
+            record.update({f'{name}_ms': duration / 1e6 for name, duration in self.current.items()})
+            self.log.write(json.dumps(record) + '\n')
+
+    def percentiles(self, name, percents=(50, 95, 99)):
+        """Returns the given percentiles of the named phase over the window, in milliseconds."""
+        samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return tuple(0.0 for _ in percents)
+        last = len(samples) - 1
+        return tuple(samples[min(last, round(last * p / 100))] / 1e6 for p in percents)
+
+    def stats(self):
+        """Returns a dictionary of {phase: (p50, p95, p99)} in milliseconds, plus the frame and spike counts."""
+        result = {name: self.percentiles(name) for name in self.samples}
+        result['frames'] = self.frames
+        result['spikes'] = self.spikes
+        return result
+
+    def overlay_lines(self):
+        """Returns the lines of text shown in the debug overlay."""
+        p50, p95, p99 = self.percentiles('frame')
+        lines = [f"Frame p50 {p50:.1f} p95 {p95:.1f} p99 {p99:.1f} ms, {self.spikes} spikes"]
+        for name in PHASES:
+            if name in self.samples:
+                p50, p95, p99 = self.percentiles(name)
+                lines.append(f"{name} {p50:.2f} / {p95:.2f} / {p99:.2f}")
+        return lines
@@ -0,0 +1,167 @@
+"""
+Input recording and replay.
+InputRecorder writes the actions of every simulation tick to a compact binary log, one byte per
+tick, plus optionally a record per rendered frame holding the frame's dt and how long it took.
+Feeding the ticks back through InputReplay reproduces the session exactly, and replaying the frame
+dts through Game.play reproduces how the ticks were spread over frames, so a frame that spiked in
+the field can be found again under the profiler. The log also holds the ticks on which streamed
+maps came in and were evicted (see streaming.py), since those depend on how fast the worker thread
+was and not on the input.
+
+File layout, little endian:
+    header: magic, version, flags, tick rate (float64), NPC count (uint32)
+    the map path: its length (uint16) and the path, UTF-8, relative to the log's directory
+    records: a byte below 0x80 is a tick, the direction code plus the action code shifted left by 3.
+        0x80 is a frame, followed by its dt (float64) and duration (float32) in milliseconds, and
+        covers the ticks since the previous frame record. The tick rate and dt are stored exactly,
+        so the replayed frames split the ticks the same way the recorded ones did.
+        0x81 and 0x82 are a map that came in or was evicted on the last tick, followed by the path
+        like the map path in the header.
+"""
+import os
+import struct
+
+MAGIC = b'BINP'
+VERSION = 2
+HEADER = struct.Struct('<4sHHdI')
+FRAME = 0x80
+FRAME_TIMES = struct.Struct('<df')
+STREAMED = 0x81
+EVICTED = 0x82
+PATH_LENGTH = struct.Struct('<H')
+# header flag set when the log has frame records
+TIMINGS = 1
+# the codes are part of the file format, only ever append to these
+DIRECTION_CODES = (None, 'UP', 'DOWN', 'LEFT', 'RIGHT')
+ACTION_CODES = (None, 'SPACE')
+
+def encode(actions):
+    """Returns the tick byte for an actions dictionary."""
+    return DIRECTION_CODES.index(actions['direction']) | ACTION_CODES.index(actions['action']) << 3
+
+def decode(byte):
+    """Returns a new actions dictionary for a tick byte."""
+    return {'direction': DIRECTION_CODES[byte & 7], 'action': ACTION_CODES[byte >> 3]}
+
+def encode_path(path, directory):
+    """Returns the path length and path record of a map path, stored relative to directory."""
+    path_bytes = os.path.relpath(os.path.abspath(path), directory).encode('utf-8')
+    return PATH_LENGTH.pack(len(path_bytes)) + path_bytes
+
+def decode_path(data, position, directory):
+    """Returns the absolute map path of the path record at position, and the position after it."""
+    length, = PATH_LENGTH.unpack_from(data, position)
+    position += PATH_LENGTH.size
+    path = data[position:position + length].decode('utf-8')
+    return os.path.normpath(os.path.join(directory, path)), position + length
+
+class InputRecorder:
+    def __init__(self, path, map_path, tick_rate, npcs, timings=True):
+        """
+            Starts writing a log to path. The map, tick rate and NPC count are stored so the session
+            can be set up the same way again.
+            timings: whether frame records are written
+        """
+        self.timings = timings
+        self.ticks = 0
+        self.frames = 0
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, TIMINGS if timings else 0, tick_rate, npcs))
+        self.file.write(encode_path(map_path, self.directory))
+
+    def tick(self, actions):
+        """Records the actions a simulation tick ran with."""
+        self.file.write(bytes((encode(actions),)))
+        self.ticks += 1
+
+    def streamed(self, loaded, evicted):
+        """Records the maps that came in and were evicted on the last tick, see WorldStreamer.sync."""
+        for kind, paths in ((STREAMED, loaded), (EVICTED, evicted)):
+            for path in paths:
+                self.file.write(bytes((kind,)) + encode_path(path, self.directory))
+
+    def frame(self, dt, frame_ms):
+        """Records a rendered frame, dt being the milliseconds passed to Game.play and frame_ms how long it took."""
+        if self.timings:
+            self.file.write(bytes((FRAME,)) + FRAME_TIMES.pack(dt, frame_ms))
+            self.frames += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            print(f"Recorded {self.ticks} ticks and {self.frames} frames")
+
+class InputLog:
+    def __init__(self, map_path, tick_rate, npcs, ticks, frames, streamed=None):
+        """
+            A recorded session.
+            map_path: absolute path of the map the session started on
+            ticks: bytes, one tick byte per simulation tick
+            frames: list of (dt, frame_ms, number of ticks), empty if the log has no timings
+            streamed: dictionary from tick index to (paths loaded, paths evicted) on that tick
+        """
+        self.map_path = map_path
+        self.tick_rate = tick_rate
+        self.npcs = npcs
+        self.ticks = ticks
+        self.frames = frames
+        self.streamed = streamed or {}
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, flags, tick_rate, npcs = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not an input log this version can read")
+        directory = os.path.dirname(os.path.abspath(path))
+        map_path, position = decode_path(data, HEADER.size, directory)
+        ticks = bytearray()
+        frames = []
+        streamed = {}
+        frame_ticks = 0
+        while position < len(data):
+            byte = data[position]
+            position += 1
+            if byte == FRAME:
+                dt, frame_ms = FRAME_TIMES.unpack_from(data, position)
+                position += FRAME_TIMES.size
+                frames.append((dt, frame_ms, frame_ticks))
+                frame_ticks = 0
+            elif byte in (STREAMED, EVICTED):
+                stream_path, position = decode_path(data, position, directory)
+                streamed.setdefault(len(ticks) - 1, ([], []))[byte == EVICTED].append(stream_path)
+            else:
+                ticks.append(byte)
+                frame_ticks += 1
+        return cls(map_path, tick_rate, npcs, bytes(ticks), frames, streamed)
+
+    def slowest_frames(self, n=5):
+        """Returns the n slowest recorded frames as (frame index, frame_ms), slowest first."""
+        return sorted(((i, frame_ms) for i, (_, frame_ms, _) in enumerate(self.frames)), key=lambda f: -f[1])[:n]
+
+class InputReplay:
+    def __init__(self, log):
+        """Feeds the ticks of an InputLog back to the game, one per simulation tick."""
+        self.log = log
+        self.position = 0
+        # index of the tick next_tick last returned, None once the log is used up
+        self.tick = None
+
+    def next_tick(self):
+        """Returns the actions of the next tick, or no input at all once the log is used up."""
+        if self.position >= len(self.log.ticks):
+            self.tick = None
+            return decode(0)
+        self.tick = self.position
+        byte = self.log.ticks[self.position]
+        self.position += 1
+        return decode(byte)
+
+    def streamed(self):
+        """Returns (paths loaded, paths evicted) on the tick next_tick last returned."""
+        return self.log.streamed.get(self.tick, ((), ()))
+
+    def done(self):
+        return self.position >= len(self.log.ticks)
@@ -0,0 +1,253 @@
+"""
+Saving and restoring.
+A save holds the simulation state of the world the player is in: the player, mid-step included,
+the doors, the animated tiles and when their next frames are due, and the NPCs with their random
+number generator, so a restored game goes on exactly like the saved one would have. The state is
+kept in fixed-size records at fixed offsets, so an autosave only has to write the records that
+changed since the last one. The records are built on the main thread, which takes microseconds,
+and written on a background thread. Restoring reads the file in one go and loads the map from its
+mapcache bundle, so the TMX isn't parsed again.
+Not saved: other maps the streamer has loaded, the game already forgets their state once they are
+evicted, the input held down, the camera, and the real time not simulated yet, under one tick.
+
+File layout, little endian:
+    header: magic, version, tick (uint32), door count, animated tile count (uint16 each), NPC count (uint32)
+    the player, see PLAYER
+    the animator clock and the NPCs' tick and random number generator, see SIMULATION
+    the map path: its length (uint16) and the path, UTF-8, relative to the save's directory
+    door records, sorted by tile, see DOOR
+    animated tile records, sorted by gid, see TILE_ANIMATION
+    NPC records, see NPC_RECORD
+Times are in milliseconds on the world's animator clock, -1 for an animation that isn't running.
+"""
+import concurrent.futures
+import os
+import struct
+import time
+
+import numpy as np
+
+import recording
+
+MAGIC = b'BSAV'
+VERSION = 2
+HEADER = struct.Struct('<4sHIHHI')
+# tile x and y, pixel x and y (int32 each), direction code of recording.py, walking, animation frame
+# (uint8 each), the player's tick (uint32), whose parity decides when a step advances
+PLAYER = struct.Struct('<iiiiBBBI')
+# animator clock (float64), NPC tick (uint32), the PCG64 state and increment (128 bits each) and
+# its buffered 32 bits (a flag and a uint32)
+SIMULATION = struct.Struct('<dI16s16sBI')
+# tile x, tile y (uint16 each), index into Door.STATES of game.py, animation frame (uint8 each), next frame due
+DOOR = struct.Struct('<HHBBd')
+# gid (uint32), frame index (uint16), next frame due
+TILE_ANIMATION = struct.Struct('<IHd')
+NPC_RECORD = np.dtype([('x', '<i4'), ('y', '<i4'), ('px', '<i4'), ('py', '<i4'),
+                       ('direction', 'i1'), ('anim_frame', 'i1'), ('state', 'i1')])
+
+class SaveState:
+    def __init__(self, map_path, tick, player, simulation, doors, tile_animations, npcs):
+        """
+            A read save.
+            map_path: absolute path of the map
+            player: (x, y, px, py, direction, walking, animation frame, tick)
+            simulation: (animator clock, NPC tick, NPC random number generator state)
+            doors: {tile: (index into Door.STATES, animation frame, next frame due)}
+            tile_animations: {gid: (frame index, next frame due)}
+            npcs: NPC_RECORD array
+        """
+        self.map_path = map_path
+        self.tick = tick
+        self.player = player
+        self.simulation = simulation
+        self.doors = doors
+        self.tile_animations = tile_animations
+        self.npcs = npcs
+
+def header(game, door_count, animation_count, npc_count):
+    """Returns the header, player and simulation records, the part of the file rewritten by every save."""
+    player = game.player
+    world = game.world
+    npcs = world.npcs
+    rng = npcs.rng.bit_generator.state if npcs is not None else {'state': {'state': 0, 'inc': 0}, 'has_uint32': 0, 'uinteger': 0}
+    return b''.join([
+        HEADER.pack(MAGIC, VERSION, game.tick % 2 ** 32, door_count, animation_count, npc_count),
+        PLAYER.pack(player.x, player.y, player.rect.x, player.rect.y, recording.DIRECTION_CODES.index(player.direction),
+                    player.state == 'WALK', player.anim_frame, player.tick % 2 ** 32),
+        SIMULATION.pack(world.animator.now, (npcs.tick if npcs is not None else 0) % 2 ** 32, rng['state']['state'].to_bytes(16, 'little'),
+                        rng['state']['inc'].to_bytes(16, 'little'), rng['has_uint32'], rng['uinteger']),
+    ])
+
+def door_records(world, due):
+    """Returns the door records of world, sorted by tile. due: see Animator.due_times"""
+    doors = sorted(world.doors.values(), key=lambda door: door.tile)
+    return [DOOR.pack(*door.tile, door.STATES.index(door.state), door.anim_frame, due.get(door, -1.0)) for door in doors]
+
+def tile_animation_records(world, due):
+    """Returns the animated tile records of world, sorted by gid."""
+    return [TILE_ANIMATION.pack(gid, world.tile_animations[gid].index, due.get(world.tile_animations[gid], -1.0))
+            for gid in sorted(world.tile_animations)]
+
+def npc_records(npcs):
+    n = npcs.count if npcs is not None else 0
+    records = np.empty(n, dtype=NPC_RECORD)
+    if n:
+        for name in NPC_RECORD.names:
+            records[name] = getattr(npcs, name)[:n]
+    return records
+
+def runs(indices):
+    """Splits sorted indices into (first, last) pairs of consecutive runs."""
+    if not indices.size:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    return [(int(run[0]), int(run[-1])) for run in np.split(indices, breaks)]
+
+class Autosaver:
+    def __init__(self, path):
+        """
+            Writes saves of a game to path on a background thread.
+            The first save, and any save after the map or the number of doors or NPCs changed,
+            rewrites the whole file (to a temporary file that then replaces it). The others only
+            overwrite the door and NPC records that changed, and the header.
+        """
+        self.path = path
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='autosave')
+        # what was written last, the next save is compared to it
+        self.layout = None
+        self.doors = None
+        self.npcs = None
+        self.saves = 0
+        self.bytes_written = 0
+        self.last = None
+
+    def save(self, game):
+        """Queues a save of game. Returns the Future of the write."""
+        world = game.world
+        map_record = recording.encode_path(game.map_path, os.path.dirname(os.path.abspath(self.path)))
+        due = world.animator.due_times()
+        # the animated tiles are few and change every frame or so, they are rewritten with the doors
+        doors = door_records(world, due) + tile_animation_records(world, due)
+        npcs = npc_records(world.npcs)
+        head = header(game, len(world.doors), len(world.tile_animations), len(npcs))
+        layout = (map_record, len(world.doors), len(world.tile_animations), len(npcs))
+        if layout != self.layout:
+            data = b''.join([head, map_record] + doors) + npcs.tobytes()
+            self.last = self.executor.submit(self.write_all, data)
+            self.bytes_written += len(data)
+        else:
+            patches = []
+            offset = len(head) + len(map_record)
+            for record, previous in zip(doors, self.doors):
+                if record != previous:
+                    patches.append((offset, record))
+                offset += len(record)
+            for first, last in runs(np.flatnonzero(npcs != self.npcs)):
+                patches.append((offset + first * NPC_RECORD.itemsize, npcs[first:last + 1].tobytes()))
+            # the header goes last, so a save cut short still has the previous tick
+            patches.append((0, head))
+            self.last = self.executor.submit(self.write_patches, patches)
+            self.bytes_written += sum(len(data) for _, data in patches)
+        self.layout, self.doors, self.npcs = layout, doors, npcs
+        self.saves += 1
+        return self.last
+
+    def write_all(self, data):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, self.path)
+
+    def write_patches(self, patches):
+        with open(self.path, 'r+b') as f:
+            for offset, data in patches:
+                f.seek(offset)
+                f.write(data)
+
+    def close(self):
+        """Waits for the queued saves to be written."""
+        self.executor.shutdown(wait=True)
+        if self.last is not None and self.last.exception() is not None:
+            print(f"Unable to save to {self.path}: {self.last.exception()}")
+        print(f"Autosaved {self.saves} times, {self.bytes_written / 1024:.1f} KB written")
+
+def load(path):
+    """Reads the save at path into a SaveState."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, tick, door_count, animation_count, npc_count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a save this version can read")
+    position = HEADER.size
+    x, y, px, py, direction, walking, anim_frame, player_tick = PLAYER.unpack_from(data, position)
+    player = (x, y, px, py, recording.DIRECTION_CODES[direction], bool(walking), anim_frame, player_tick)
+    position += PLAYER.size
+    clock, npc_tick, state, inc, has_uint32, uinteger = SIMULATION.unpack_from(data, position)
+    rng = {'bit_generator': 'PCG64', 'state': {'state': int.from_bytes(state, 'little'), 'inc': int.from_bytes(inc, 'little')},
+           'has_uint32': has_uint32, 'uinteger': uinteger}
+    position += SIMULATION.size
+    map_path, position = recording.decode_path(data, position, os.path.dirname(os.path.abspath(path)))
+    doors = {}
+    for tx, ty, state, door_frame, due in DOOR.iter_unpack(data[position:position + door_count * DOOR.size]):
+        doors[(tx, ty)] = (state, door_frame, due)
+    position += door_count * DOOR.size
+    tile_animations = {}
+    for gid, index, due in TILE_ANIMATION.iter_unpack(data[position:position + animation_count * TILE_ANIMATION.size]):
+        tile_animations[gid] = (index, due)
+    position += animation_count * TILE_ANIMATION.size
+    npcs = np.frombuffer(data, dtype=NPC_RECORD, count=npc_count, offset=position)
+    return SaveState(map_path, tick, player, (clock, npc_tick, rng), doors, tile_animations, npcs)
+
+def restore(game, save):
+    """Puts game, which must have started, in the state of a SaveState."""
+    start = time.perf_counter()
+    path = save.map_path
+    world = game.streamer.load(path)
+    x, y, px, py, direction, walking, anim_frame, player_tick = save.player
+    player = game.player
+    player.direction = direction
+    game.enter_world(path, world, x, y)
+    player.state = 'WALK' if walking else 'IDLE'
+    player.anim_frame = anim_frame
+    player.image = player.sprites[direction][anim_frame]
+    player.rect.topleft = (px, py)
+    player.prev_pos = player.rect.topleft
+    player.tick = player_tick
+    clock, npc_tick, rng = save.simulation
+    animator = world.animator
+    animator.clear()
+    animator.now = clock
+    for tile, (state, door_frame, due) in save.doors.items():
+        door = world.doors.get(tile)
+        if door is None:
+            continue
+        door.anim_frame = door_frame
+        door.set_state(door.STATES[state])
+        world.dirty_rects.append(door.rect.copy())
+        if due >= 0:
+            animator.start_at(door, due)
+    for gid, (index, due) in save.tile_animations.items():
+        tile_animation = world.tile_animations.get(gid)
+        if tile_animation is None:
+            continue
+        tile_animation.index = index
+        world.tile_frames[gid] = tile_animation.frames[index][0]
+        if due >= 0:
+            animator.start_at(tile_animation, due)
+    # the chunks were baked with the animated tiles' first frames
+    world.layer_caches.clear()
+    npcs = world.npcs
+    npcs.tick = npc_tick
+    npcs.rng.bit_generator.state = rng
+    for i in range(npcs.count):
+        world.entities.remove(i, npcs.occupied_tile(i))
+    while len(npcs.x) < len(save.npcs):
+        npcs.grow()
+    npcs.count = len(save.npcs)
+    for name in NPC_RECORD.names:
+        getattr(npcs, name)[:npcs.count] = save.npcs[name]
+    for i in range(npcs.count):
+        world.entities.add(i, npcs.occupied_tile(i))
+    game.tick = save.tick
+    game.camera.full_redraw = True
+    print(f"Restored {save.map_path} with {len(save.doors)} doors and {npcs.count} NPCs in {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,226 @@
+"""
+Authoritative multiplayer server.
+One asyncio event loop owns the World and a Player per connected client, and runs the simulation
+at a fixed tick rate: every tick applies each client's latest input, advances the doors, and sends
+every client the same delta snapshot (see network.py). Players are indexed in world.entities like
+NPCs, so they block each other, and the tile a player walks into is taken as soon as it starts
+walking. Run it with
+    python server.py --map tiled/boolground.tmx --listen 127.0.0.1:7777
+and connect with python game.py --connect 127.0.0.1:7777.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import numpy as np
+
+import game
+import network
+import recording
+import utils
+
+# a client whose unsent snapshots pile up past this many bytes is too slow to keep up and is dropped
+MAX_BUFFERED = 256 * 1024
+# connections waiting to be accepted, hundreds of clients may connect at once
+BACKLOG = 1024
+
+class RemotePlayer:
+    def __init__(self, player_id, player, writer):
+        """
+            A connected client.
+            player: the game.Player it controls
+            writer: asyncio.StreamWriter snapshots are written to
+        """
+        self.id = player_id
+        self.player = player
+        self.writer = writer
+        self.actions = recording.decode(0)
+        # the entity record last sent for this player, it is sent again only when it changes
+        self.sent = None
+        self.bytes_sent = 0
+
+    def entity(self):
+        """Returns this player's entity record, see network.encode_snapshot."""
+        player = self.player
+        flags = network.WALKING if player.state == 'WALK' else 0
+        return (self.id, player.x, player.y, recording.DIRECTION_CODES.index(player.direction) | flags << 3, player.anim_frame)
+
+    def tile(self):
+        """Returns the tile the player is indexed on in world.entities, the one it walks into while walking."""
+        player = self.player
+        if player.state == 'WALK':
+            dx, dy = player.movemap(player.direction)
+            return player.x + dx, player.y + dy
+        return player.x, player.y
+
+    def send(self, data):
+        self.writer.write(data)
+        self.bytes_sent += len(data)
+
+class GameServer:
+    def __init__(self, map_path, tick_rate=30, seed=0):
+        """
+            map_path: the Tiled map the server runs, clients load the same file
+            tick_rate: simulation steps per second
+            seed: seed for picking the tiles players spawn on
+        """
+        self.map_path = os.path.relpath(map_path)
+        self.world = game.Game.load_world(map_path)
+        self.tick_rate = tick_rate
+        self.step_ms = 1000 / tick_rate
+        self.rng = np.random.default_rng(seed)
+        self.sprites = utils.load_player_sprites()
+        self.tick_count = 0
+        # player id -> RemotePlayer
+        self.clients = {}
+        self.next_id = 0
+        # doors whose state changed this tick, and players that left
+        self.changed_doors = set()
+        self.gone = []
+        self.world.tile_listeners.append(self.tile_changed)
+        # milliseconds each tick took, for the load test
+        self.tick_times = []
+        self.overruns = 0
+        self.running = False
+
+    def tile_changed(self, x, y):
+        if (x, y) in self.world.doors:
+            self.changed_doors.add((x, y))
+
+    def spawn_tile(self):
+        """Returns a random free tile to put a new player on."""
+        world = self.world
+        for _ in range(100):
+            y, x = divmod(int(self.rng.integers(world.width * world.height)), world.width)
+            if world.passable[y, x] and not world.entities_at(x, y):
+                return x, y
+        for index in np.flatnonzero(world.passable.ravel()).tolist():
+            y, x = divmod(index, world.width)
+            if not world.entities_at(x, y):
+                return x, y
+        raise RuntimeError("No free tile left to spawn a player on")
+
+    def full_snapshot(self):
+        """Returns a snapshot of the whole state, sent to clients when they join."""
+        doors = [(x, y, door.STATES.index(door.state)) for (x, y), door in self.world.doors.items() if door.state != 'CLOSED']
+        entities = [client.entity() for client in self.clients.values()]
+        return network.encode_snapshot(self.tick_count, doors, entities)
+
+    async def handle(self, reader, writer):
+        """Serves one client from connection to disconnection."""
+        x, y = self.spawn_tile()
+        player = game.Player(x, y, self.world, self.sprites)
+        player.place(self.world, x, y)
+        client = RemotePlayer(self.next_id, player, writer)
+        self.next_id = (self.next_id + 1) % 65536
+        self.world.entities.add(('player', client.id), (x, y))
+        client.send(network.encode_welcome(client.id, self.tick_rate, self.map_path))
+        # client.sent stays None, so the next tick announces the new player to everyone already connected
+        self.clients[client.id] = client
+        client.send(self.full_snapshot())
+        try:
+            while True:
+                data = await reader.read(256)
+                if not data:
+                    break
+                # only the latest input matters, it is held until it changes
+                client.actions = recording.decode(data[-1])
+        except ConnectionError:
+            pass
+        finally:
+            self.disconnect(client)
+
+    def disconnect(self, client):
+        if self.clients.pop(client.id, None) is None:
+            return
+        self.world.entities.remove(('player', client.id), client.tile())
+        self.gone.append(client.id)
+        client.writer.close()
+
+    def tick(self):
+        """Runs one simulation step and sends its snapshot to every client."""
+        start = time.perf_counter()
+        self.tick_count += 1
+        entities = self.world.entities
+        for client in self.clients.values():
+            player = client.player
+            walking = player.state == 'WALK'
+            player.update(client.actions)
+            if not walking and player.state == 'WALK':
+                # take the target tile right away, so players updated later this tick can't walk into it
+                dx, dy = player.movemap(player.direction)
+                entities.move(('player', client.id), (player.x, player.y), (player.x + dx, player.y + dy))
+        self.world.update(self.step_ms)
+        self.world.pop_dirty_rects()
+
+        doors = [(x, y, game.Door.STATES.index(self.world.doors[(x, y)].state)) for x, y in self.changed_doors]
+        self.changed_doors.clear()
+        moved = []
+        for client in self.clients.values():
+            entity = client.entity()
+            if entity != client.sent:
+                moved.append(entity)
+                client.sent = entity
+        moved.extend((player_id, 0, 0, network.GONE << 3, 0) for player_id in self.gone)
+        self.gone.clear()
+        if doors or moved:
+            snapshot = network.encode_snapshot(self.tick_count, doors, moved)
+            for client in list(self.clients.values()):
+                if client.writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+                    print(f"Dropping player {client.id}, it isn't keeping up")
+                    self.disconnect(client)
+                    continue
+                client.send(snapshot)
+        self.tick_times.append((time.perf_counter() - start) * 1000)
+
+    async def run(self):
+        """Ticks at the tick rate until stop is called. A tick that runs late doesn't make the next ones hurry."""
+        loop = asyncio.get_running_loop()
+        step = 1 / self.tick_rate
+        next_tick = loop.time()
+        self.running = True
+        while self.running:
+            self.tick()
+            next_tick += step
+            delay = next_tick - loop.time()
+            if delay < 0:
+                self.overruns += 1
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+
+    def stop(self):
+        self.running = False
+
+    async def listen(self, address):
+        """Starts accepting clients on address, see network.parse_address. Returns the asyncio server."""
+        kind, target = network.parse_address(address)
+        if kind == 'unix':
+            if os.path.exists(target):
+                os.remove(target)
+            return await asyncio.start_unix_server(self.handle, target, backlog=BACKLOG)
+        return await asyncio.start_server(self.handle, *target, backlog=BACKLOG)
+
+    def close(self):
+        for client in list(self.clients.values()):
+            self.disconnect(client)
+
+async def serve(map_path, address, tick_rate):
+    game.init_headless((1, 1))
+    server = GameServer(map_path, tick_rate)
+    listener = await server.listen(address)
+    print(f"Serving {server.map_path} on {address} at {tick_rate} ticks per second")
+    async with listener:
+        await server.run()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bool multiplayer server')
+    parser.add_argument('--map', default='tiled/boolground.tmx', help='Tiled map to serve')
+    parser.add_argument('--listen', default='127.0.0.1:7777', help='host:port, or unix:path for a Unix socket')
+    parser.add_argument('--tick-rate', type=float, default=30, help='simulation steps per second')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.map, args.listen, args.tick_rate))
+    except KeyboardInterrupt:
+        pass
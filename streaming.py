@@ -0,0 +1,198 @@
+"""
+World streaming.
+Maps link to each other through map properties naming the map across each edge ('north', 'south',
+'east', 'west') and through doors with a 'warp' property (plus 'warp_x' and 'warp_y', the tile the
+player arrives on). WorldStreamer loads the maps the player is getting close to on a worker thread,
+so the main loop only ever picks up worlds that are ready, and forgets the least recently used ones
+once the cached worlds take more than the memory budget. Like the asset loader, the worker thread
+never converts anything to the display format, a world is finished on the main thread when it is
+picked up.
+Worlds only come in and get evicted in sync, once per simulation tick. When the worker thread finishes
+depends on the machine, so the game records what each sync did and a replay applies the same changes
+on the same ticks instead of syncing, see recording.py.
+"""
+import concurrent.futures
+import os
+from collections import OrderedDict
+
+# map property naming the map across each edge, by the direction walked to cross it
+EDGE_PROPERTIES = {'UP': 'north', 'DOWN': 'south', 'LEFT': 'west', 'RIGHT': 'east'}
+
+class WorldStreamer:
+    def __init__(self, load_world, preload_distance=8, memory_budget=64 * 1024 * 1024, finish_world=None):
+        """
+            load_world: function building a World from a map path, called on the worker thread
+            finish_world: called on the main thread with every world once it is loaded, before it is used
+            preload_distance: a linked map starts loading once the player is this many tiles from
+                the edge or door leading to it
+            memory_budget: bytes the cached worlds may take, see World.memory_bytes. The current world
+                and the maps the player is close to are never evicted, the other maps it links to only
+                once nothing else is left to evict.
+        """
+        self.load_world = load_world
+        self.finish_world = finish_world
+        self.preload_distance = preload_distance
+        self.memory_budget = memory_budget
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='streaming')
+        # path -> World, least recently used first
+        self.worlds = OrderedDict()
+        # path -> Future of a world being loaded
+        self.pending = {}
+        # maps that failed to load, they aren't retried
+        self.failed = set()
+        # path -> ({direction: path}, [(door, path)])
+        self.link_cache = {}
+        # the linked maps the player was close to on the last update
+        self.wanted = set()
+        # functions called with (path, world) when a world is evicted
+        self.evict_listeners = []
+        # the current world on the last sync, the one before it is evicted once the player leaves it
+        self.current = None
+
+    def load(self, path):
+        """Returns the world for path, loading it on the calling thread if it isn't ready yet."""
+        path = os.path.abspath(path)
+        world = self.worlds.get(path)
+        if world is None:
+            future = self.pending.pop(path, None)
+            world = future.result() if future is not None else self.load_world(path)
+            self.finish(world)
+            self.worlds[path] = world
+        self.worlds.move_to_end(path)
+        return world
+
+    def get(self, path):
+        """Returns the world for path if it has been loaded, otherwise None. Worlds the worker thread
+            finished are only picked up by sync.
+        """
+        world = self.worlds.get(path)
+        if world is not None:
+            self.worlds.move_to_end(path)
+        return world
+
+    def request(self, path):
+        """Starts loading path on the worker thread, unless it is loaded, loading or failed to load.
+            Returns the Future of the load, or None if there is nothing to wait for.
+        """
+        if path in self.pending:
+            return self.pending[path]
+        if path in self.worlds or path in self.failed:
+            return None
+        print(f"Streaming in {path}")
+        future = self.pending[path] = self.executor.submit(self.load_world, path)
+        return future
+
+    def poll(self):
+        """Picks up the worlds the worker thread finished. Returns the paths of the ones that loaded."""
+        done = [path for path, future in self.pending.items() if future.done()]
+        loaded = []
+        for path in done:
+            try:
+                world = self.pending.pop(path).result()
+                self.finish(world)
+                self.worlds[path] = world
+                loaded.append(path)
+            except Exception as e:
+                print(f"Unable to load {path}: {e}")
+                self.failed.add(path)
+        return loaded
+
+    def finish(self, world):
+        if self.finish_world is not None:
+            self.finish_world(world)
+
+    def sync(self, current):
+        """
+            Picks up the worlds the worker thread finished, and evicts worlds over the budget when new
+            ones came in or the player moved to another world. Called once per tick.
+            current: path of the world the player is in
+            Returns (paths loaded, paths evicted).
+        """
+        loaded = self.poll()
+        evicted = []
+        if loaded or current != self.current:
+            evicted = self.evict(current)
+        self.current = current
+        return loaded, evicted
+
+    def apply(self, current, loaded, evicted):
+        """
+            Makes the changes a recorded sync made instead of syncing: loads the worlds that came in,
+            waiting for the worker thread or loading them here if need be, and evicts the same worlds.
+        """
+        for path in loaded:
+            self.load(path)
+        for path in evicted:
+            self.drop(path)
+        self.current = current
+
+    def links(self, path):
+        """Returns ({direction: path}, [(door, path)]), the maps linked from the edges and doors of path."""
+        links = self.link_cache.get(path)
+        if links is None:
+            world = self.worlds[path]
+            directory = os.path.dirname(path)
+            edges = {}
+            for direction, name in EDGE_PROPERTIES.items():
+                target = world.tiled_map.properties.get(name)
+                if target:
+                    edges[direction] = os.path.normpath(os.path.join(directory, target))
+            warps = [(door, os.path.normpath(os.path.join(directory, door.warp))) for door in world.doors.values() if door.warp]
+            links = self.link_cache[path] = (edges, warps)
+        return links
+
+    def neighbour(self, path, direction):
+        """Returns the path of the map across the edge of path in direction, or None."""
+        return self.links(path)[0].get(direction)
+
+    def warp_target(self, path, door):
+        """Returns the path of the map door leads to."""
+        return os.path.normpath(os.path.join(os.path.dirname(path), door.warp))
+
+    def update(self, path, world, x, y):
+        """
+            Starts loading the maps linked to path that the player at tile (x, y) is close to.
+        """
+        edges, warps = self.links(path)
+        d = self.preload_distance
+        near = {'UP': y < d, 'DOWN': y >= world.height - d, 'LEFT': x < d, 'RIGHT': x >= world.width - d}
+        wanted = {target for direction, target in edges.items() if near[direction]}
+        for door, target in warps:
+            tx, ty = door.tile
+            if abs(tx - x) <= d and abs(ty - y) <= d:
+                wanted.add(target)
+        self.wanted = wanted
+        for target in wanted:
+            self.request(target)
+
+    def evict(self, current):
+        """Forgets the least recently used worlds until the cached worlds fit in the memory budget.
+            Returns the paths of the evicted worlds.
+        """
+        sizes = {path: world.memory_bytes() for path, world in self.worlds.items()}
+        total = sum(sizes.values())
+        edges, warps = self.links(current)
+        linked = set(edges.values()) | {target for _, target in warps}
+        evicted = []
+        # far away worlds go first, then the ones linked to the current world
+        for keep_linked in (True, False):
+            for path in list(self.worlds):
+                if total <= self.memory_budget:
+                    return evicted
+                if path == current or path in self.wanted or (keep_linked and path in linked):
+                    continue
+                print(f"Evicting {path}, {sizes[path] / 1024:.0f} KB")
+                self.drop(path)
+                total -= sizes[path]
+                evicted.append(path)
+        return evicted
+
+    def drop(self, path):
+        """Evicts the world for path."""
+        world = self.worlds.pop(path)
+        self.link_cache.pop(path, None)
+        for listener in self.evict_listeners:
+            listener(path, world)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
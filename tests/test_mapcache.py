@@ -0,0 +1,33 @@
+import os
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import pygame
+
+import bench
+import game
+import mapcache
+
+PKMN = os.path.join(REPO, 'tiled', 'pkmn.tsx')
+
+def render(world):
+    surface = pygame.Surface((world.width * world.tilesize, world.height * world.tilesize))
+    world.draw_ground(surface)
+    world.draw_objects(surface)
+    world.draw_foreground(surface)
+    return pygame.image.tobytes(surface, 'RGB')
+
+def test_bundle_draws_like_pytmx_with_tall_tiles(tmp_path, monkeypatch):
+    monkeypatch.chdir(REPO)
+    game.init_headless((1, 1))
+    # pkmn.tsx has 16x32 tiles on a map of 16x16 tiles
+    path = bench.write_synthetic_map(str(tmp_path), 20, 40, tileset=PKMN, gids=([1, 2, 3], [20, 35, 50], [70, 80]))
+    parsed = game.World(mapcache.load_map(path, use_cache=False))
+    mapcache.load_map(path)
+    bundled = game.World(mapcache.load_map(path))
+    assert isinstance(bundled.tiled_map, mapcache.CompiledMap)
+    pixels = render(bundled)
+    assert pixels.count(0) < len(pixels)
+    assert pixels == render(parsed)
@@ -0,0 +1,33 @@
+import os
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import numpy as np
+import pygame
+
+import game
+import minimap
+
+def test_dots_are_scattered_into_the_frame():
+    game.init_headless((1, 1))
+    world = game.Game.load_world(os.path.join(REPO, 'tiled', 'boolground.tmx'))
+    npcs = game.NPCs(world, game.utils.load_player_sprites())
+    npcs.spawn_random(20)
+    # an NPC on the left edge, its dot is cut off by the border
+    npcs.put(0, 0, world.height // 2, 0, 0, 'DOWN', 0, False)
+    player = game.Player(0, 0, world, game.utils.load_player_sprites())
+    mini = minimap.Minimap(world)
+    surface = pygame.Surface((mini.width + 8, mini.height + 8))
+    rect = mini.draw(surface, (4, 4), player)
+    assert rect == pygame.Rect(4, 4, mini.width, mini.height)
+    pixels = pygame.surfarray.array3d(surface)
+    # nothing outside the minimap's rect is drawn on
+    assert not pixels[:4].any() and not pixels[:, :4].any() and not pixels[rect.right:].any() and not pixels[:, rect.bottom:].any()
+    assert tuple(pixels[4, 4]) == minimap.Minimap.PLAYER_COLOR
+    for x, y in zip(npcs.x[:npcs.count].tolist(), npcs.y[:npcs.count].tolist()):
+        cell = (x * mini.width // world.width + 4, y * mini.height // world.height + 4)
+        if cell != (4, 4):
+            assert tuple(pixels[cell]) == minimap.Minimap.NPC_COLOR
+    assert np.array_equal(pygame.surfarray.array3d(mini.frame), pixels[4:rect.right, 4:rect.bottom])
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import game
+import network
+import server
+
+MAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tiled', 'boolground.tmx')
+
+def test_snapshot_messages_round_trip():
+    doors = [(3, 4, game.Door.STATES.index('OPENING')), (65535, 0, game.Door.STATES.index('CLOSED'))]
+    entities = [(1, 10, 20, 2 | network.WALKING << 3, 1), (7, 0, 0, network.GONE << 3, 0)]
+    buffer = bytearray(network.encode_welcome(5, 30.0, 'tiled/boolground.tmx'))
+    buffer += network.encode_snapshot(2 ** 32 - 1, doors, entities) + network.encode_snapshot(0, [], [])
+    # half of a message stays in the buffer until the rest arrives
+    buffer += network.encode_snapshot(1, doors, [])[:5]
+    messages = network.split_messages(buffer)
+    assert [kind for kind, _ in messages] == [network.WELCOME, network.SNAPSHOT, network.SNAPSHOT]
+    assert network.decode_welcome(messages[0][1]) == (5, 30.0, 'tiled/boolground.tmx')
+    assert network.decode_snapshot(messages[1][1]) == (2 ** 32 - 1, doors, entities)
+    assert network.decode_snapshot(messages[2][1]) == (0, [], [])
+    assert len(buffer) == 5
+
+def test_joining_client_sees_open_doors():
+    game.init_headless((1, 1))
+    game_server = server.GameServer(MAP)
+    door = next(iter(game_server.world.doors.values()))
+    door.toggle()
+    message = game_server.full_snapshot()
+    (kind, payload), = network.split_messages(bytearray(message))
+    assert network.decode_snapshot(payload) == (0, [(*door.tile, game.Door.STATES.index('OPENING'))], [])
+
+def test_idle_joiner_is_announced_to_everyone():
+    game.init_headless((1, 1))
+    game_server = server.GameServer(MAP)
+
+    async def connect(port, count):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        while len(game_server.clients) < count:
+            await asyncio.sleep(0.01)
+        return reader, writer
+
+    async def players_seen(reader, tick):
+        """Returns the player ids in the snapshots up to tick."""
+        buffer = bytearray()
+        seen = set()
+        while True:
+            buffer += await asyncio.wait_for(reader.read(65536), 5)
+            for kind, payload in network.split_messages(buffer):
+                if kind == network.SNAPSHOT:
+                    snapshot_tick, _, entities = network.decode_snapshot(payload)
+                    seen.update(entity[0] for entity in entities)
+                    if snapshot_tick == tick:
+                        return seen
+
+    async def scenario():
+        listener = await game_server.listen('127.0.0.1:0')
+        port = listener.sockets[0].getsockname()[1]
+        first = await connect(port, 1)
+        game_server.tick()
+        # the second client joins and never sends any input
+        second = await connect(port, 2)
+        game_server.tick()
+        seen = await players_seen(first[0], 2), await players_seen(second[0], 2)
+        for _, writer in (first, second):
+            writer.close()
+        game_server.close()
+        listener.close()
+        await listener.wait_closed()
+        return seen
+
+    assert asyncio.run(scenario()) == ({0, 1}, {0, 1})
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mapcache
+import pathfinding
+import game
+
+MAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tiled', 'boolground.tmx')
+
+def test_door_opening_updates_pathfinder():
+    game.init_headless((1, 1))
+    # the first load rewrites the bundle if it is stale
+    mapcache.load_map(MAP)
+    world = game.Game.load_world(MAP)
+    assert isinstance(world.tiled_map, mapcache.CompiledMap)
+    pathfinder = pathfinding.Pathfinder(world)
+    door = next(iter(world.doors.values()))
+    x, y = door.tile
+    assert not pathfinder.grid[y * pathfinder.width + x]
+    door.toggle()
+    for _ in range(100):
+        world.update(1000 / 30)
+    assert door.state == 'OPEN'
+    assert pathfinder.grid[y * pathfinder.width + x] == world.passable[y, x] == (world.objects.data[y][x] == 0)
+    assert pathfinder.version == world.collision_version
+
+def test_resumed_search_counts_one_miss():
+    game.init_headless((1, 1))
+    world = game.Game.load_world(MAP)
+    pathfinder = pathfinding.Pathfinder(world, expansions_per_step=1)
+    ys, xs = np.nonzero(world.passable)
+    start, goal = (int(xs[0]), int(ys[0])), (int(xs[-1]), int(ys[-1]))
+    request = pathfinder.request(start, goal)
+    assert pathfinder.misses == 1
+    steps = 0
+    while not request.done:
+        pathfinder.update(budget_ms=0.01)
+        steps += 1
+    assert steps > 1
+    assert pathfinder.misses == 1
+
+def test_replan_only_searches_around_the_blocked_stretch():
+    game.init_headless((1, 1))
+    world = game.Game.load_world(MAP)
+    pathfinder = pathfinding.Pathfinder(world)
+    ys, xs = np.nonzero(world.passable)
+    start, goal = (int(xs[0]), int(ys[0])), (int(xs[-1]), int(ys[-1]))
+    request = pathfinder.request(start, goal)
+    while not request.done:
+        pathfinder.update()
+    path = request.path
+    # the follower walked a few tiles, then something blocks the path further on
+    position = path[2]
+    blocked = path[len(path) // 2]
+    world.set_passable(*blocked, False)
+    repair = pathfinder.replan(request, position)
+    assert repair is not request
+    i = path.index(blocked)
+    assert (repair.start, repair.goal) == (path[i - 1], path[i + 1])
+    while not repair.done:
+        pathfinder.update()
+    repaired = repair.path
+    assert repaired[-1] == goal and blocked not in repaired and pathfinder.is_clear(repaired)
+    assert len(set(repaired)) == len(repaired) and position not in repaired
+    x, y = position
+    for nx, ny in repaired:
+        assert abs(nx - x) + abs(ny - y) == 1
+        x, y = nx, ny
+    # the clear tiles after the block are kept as they were
+    assert repaired[-(len(path) - i - 2):] == path[i + 2:]
+    assert pathfinder.replan(repair, repaired[0]) is repair
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench
+import game
+import recording
+
+MAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tiled', 'boolground.tmx')
+
+def test_input_log_reads_back_what_was_recorded(tmp_path, monkeypatch):
+    path = str(tmp_path / 'session.log')
+    actions = [{'direction': direction, 'action': action} for direction in recording.DIRECTION_CODES for action in recording.ACTION_CODES]
+    recorder = recording.InputRecorder(path, 'tiled/boolground.tmx', 30.0, 12)
+    recorder.tick(actions[0])
+    recorder.frame(16.5, 3.25)
+    for tick_actions in actions[1:]:
+        recorder.tick(tick_actions)
+    recorder.frame(50.0, 40.5)
+    recorder.close()
+
+    map_path = os.path.abspath('tiled/boolground.tmx')
+    # the map path is stored relative to the log, not to the working directory
+    monkeypatch.chdir(tmp_path)
+    log = recording.InputLog.read(path)
+    assert (log.map_path, log.tick_rate, log.npcs) == (map_path, 30.0, 12)
+    assert log.frames == [(16.5, 3.25, 1), (50.0, 40.5, len(actions) - 1)]
+    assert log.slowest_frames(1) == [(1, 40.5)]
+    replay = recording.InputReplay(log)
+    assert [replay.next_tick() for _ in actions] == actions
+    assert replay.done()
+
+def test_timed_replay_of_a_headless_recording_runs_every_tick(tmp_path, capsys):
+    path = str(tmp_path / 'session.log')
+    recorded = game.run_headless(40, {0: 'RIGHT', 12: 'DOWN', 30: None}, map_path=MAP, npcs=4, record_path=path)
+    replayed = game.run_replay(path, game.init_headless(), timed=True)
+    assert 'out of step' not in capsys.readouterr().out
+    assert replayed.replay.done()
+    assert (replayed.player.x, replayed.player.y, replayed.player.direction) == (recorded.player.x, recorded.player.y, recorded.player.direction)
+    count = recorded.npcs.count
+    assert (replayed.npcs.x[:count] == recorded.npcs.x[:count]).all()
+    assert (replayed.npcs.y[:count] == recorded.npcs.y[:count]).all()
+
+def linked_maps(directory):
+    """Writes two 8 x 8 maps, the second one east of the first, and returns their paths."""
+    paths = []
+    for name in ('west', 'east'):
+        os.mkdir(os.path.join(directory, name))
+        paths.append(bench.write_synthetic_map(os.path.join(directory, name), 8, 8, object_density=0, foreground_density=0, door_every=10 ** 6))
+    with open(paths[0]) as f:
+        tmx = f.read()
+    link = f'<properties>\n  <property name="east" value="{os.path.relpath(paths[1], os.path.dirname(paths[0]))}"/>\n </properties>\n <tileset'
+    with open(paths[0], 'w') as f:
+        f.write(tmx.replace('<tileset', link, 1))
+    return paths
+
+def test_replay_crosses_into_a_streamed_map_on_the_recorded_tick(tmp_path, monkeypatch):
+    west, east = linked_maps(str(tmp_path))
+    path = str(tmp_path / 'session.log')
+    recorded = game.Game(game.init_headless(), map_path=west, record_path=path)
+    recorded.actions['direction'] = 'RIGHT'
+    # the player waits at the edge for as many ticks as the worker thread takes
+    deadline = time.perf_counter() + 10
+    while recorded.map_path != east and time.perf_counter() < deadline:
+        recorded.play()
+    for _ in range(10):
+        recorded.play()
+    recorded.close()
+    assert recorded.map_path == east
+    # the replay's worker thread takes much longer to load the map than the recording's did
+    load_world = game.Game.load_world
+    def slow_load(map_path):
+        time.sleep(0.3)
+        return load_world(map_path)
+    monkeypatch.setattr(game.Game, 'load_world', staticmethod(slow_load))
+    replayed = game.run_replay(path, game.init_headless())
+    assert replayed.map_path == east
+    assert (replayed.player.x, replayed.player.y, replayed.player.state) == (recorded.player.x, recorded.player.y, recorded.player.state)
@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import game
+import savegame
+
+MAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tiled', 'boolground.tmx')
+
+def door_states(world):
+    return {tile: (door.state, door.anim_frame) for tile, door in world.doors.items()}
+
+def test_patched_save_restores_the_game(tmp_path):
+    path = str(tmp_path / 'game.sav')
+    saved = game.Game(game.init_headless(), map_path=MAP, npcs=50, save_path=path, autosave_ticks=10)
+    saved.actions['direction'] = 'RIGHT'
+    for _ in range(10):
+        saved.play()
+    saved.saver.last.result()
+    file_size = os.path.getsize(path)
+    # later saves only patch what changed, a door among it
+    next(iter(saved.world.doors.values())).toggle()
+    saved.actions['direction'] = 'DOWN'
+    for _ in range(15):
+        saved.play()
+    saved.close()
+    assert saved.saver.saves == 3
+    assert saved.saver.bytes_written < 2 * file_size
+    assert os.path.getsize(path) == file_size
+
+    restored = game.Game(game.init_headless(), npcs=0, save_path=path)
+    restored.close()
+    assert restored.map_path == saved.map_path
+    assert restored.tick == saved.tick
+    assert (restored.player.x, restored.player.y, restored.player.direction) == (saved.player.x, saved.player.y, saved.player.direction)
+    assert door_states(restored.world) == door_states(saved.world)
+    assert any(state != 'CLOSED' for state, _ in door_states(restored.world).values())
+    assert (savegame.npc_records(restored.npcs) == savegame.npc_records(saved.npcs)).all()
+
+def test_restored_game_goes_on_like_the_saved_one(tmp_path, monkeypatch):
+    path = str(tmp_path / 'game.sav')
+    saved = game.Game(game.init_headless(), map_path=MAP, npcs=50, save_path=path, autosave_ticks=10 ** 6)
+    saved.actions['direction'] = 'RIGHT'
+    for _ in range(5):
+        saved.play()
+    saved.actions['direction'] = 'DOWN'
+    while saved.player.state != 'WALK' or saved.player.anim_frame % 2 == 0:
+        saved.play()
+    door = next(iter(saved.world.doors.values()))
+    door.toggle()
+    # saved halfway through a step, with the door opening
+    assert saved.player.state == 'WALK' and door.state == 'OPENING'
+    saved.saver.save(saved).result()
+    monkeypatch.chdir(tmp_path)
+    assert savegame.load(path).map_path == MAP
+    monkeypatch.undo()
+
+    restored = game.Game(game.init_headless(), npcs=0, save_path=path, autosave_ticks=10 ** 6)
+    # the input held down isn't part of the save
+    restored.actions = dict(saved.actions)
+    for _ in range(60):
+        saved.play()
+        restored.play()
+        assert (restored.player.x, restored.player.y, restored.player.state, restored.player.anim_frame, restored.player.rect.topleft) == \
+            (saved.player.x, saved.player.y, saved.player.state, saved.player.anim_frame, saved.player.rect.topleft)
+        assert door_states(restored.world) == door_states(saved.world)
+        assert (savegame.npc_records(restored.npcs) == savegame.npc_records(saved.npcs)).all()
+    saved.close()
+    restored.close()
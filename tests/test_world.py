@@ -0,0 +1,142 @@
+import os
+import sys
+import threading
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import numpy as np
+import pygame
+
+import bench
+import game
+import mapcache
+import streaming
+
+PKMN = os.path.join(REPO, 'tiled', 'pkmn.tsx')
+# town.tsx with its first ground tile animated between two grass tiles
+ANIMATED_TILESET = '''<?xml version="1.0" encoding="UTF-8"?>
+<tileset version="1.10" tiledversion="1.10.0" name="town" tilewidth="16" tileheight="16" spacing="1" tilecount="1036" columns="37">
+ <image source="{image}" trans="ff00ff" width="628" height="475"/>
+ <tile id="966">
+  <animation>
+   <frame tileid="966" duration="300"/>
+   <frame tileid="891" duration="150"/>
+  </animation>
+ </tile>
+</tileset>
+'''
+
+def tile_by_tile(world, layer):
+    """Draws layer one tile at a time over the whole map, the way the game drew before chunks."""
+    surface = pygame.Surface((world.width * world.tilesize, world.height * world.tilesize))
+    for y in range(world.height):
+        for x in range(world.width):
+            tile = world.tile_image(int(layer.data[y][x]))
+            if tile:
+                surface.blit(tile, (x * world.tilesize, y * world.tilesize))
+    return pygame.image.tobytes(surface, 'RGB')
+
+def chunked(world, layer):
+    surface = pygame.Surface((world.width * world.tilesize, world.height * world.tilesize))
+    world.chunk_caches(1)[layer.name].draw(surface, world.full_view())
+    return pygame.image.tobytes(surface, 'RGB')
+
+def tall_tile_world(tmp_path, monkeypatch):
+    monkeypatch.chdir(REPO)
+    game.init_headless((1, 1))
+    # pkmn.tsx has 16x32 tiles on a map of 16x16 tiles
+    path = bench.write_synthetic_map(str(tmp_path), 20, 40, tileset=PKMN, gids=([1, 2, 3], [20, 35, 50], [70, 80]), object_density=0.3)
+    return game.World(mapcache.load_map(path, use_cache=False), chunk_size=4)
+
+def animated_tile_map(tmp_path, monkeypatch):
+    monkeypatch.chdir(REPO)
+    game.init_headless((1, 1))
+    tileset = os.path.join(str(tmp_path), 'animated.tsx')
+    with open(tileset, 'w') as f:
+        f.write(ANIMATED_TILESET.format(image=os.path.join(REPO, 'town', 'Tilemap', 'tilemap.png')))
+    return bench.write_synthetic_map(str(tmp_path), 20, 12, tileset=tileset, gids=([967, 715], [196], [68]))
+
+def test_tall_tiles_spill_across_chunks(tmp_path, monkeypatch):
+    world = tall_tile_world(tmp_path, monkeypatch)
+    assert world.overflow == (0, 1)
+    for layer in (world.ground, world.objects, world.foreground):
+        assert chunked(world, layer) == tile_by_tile(world, layer)
+
+def test_set_tile_redraws_the_tiles_it_spills_over(tmp_path, monkeypatch):
+    world = tall_tile_world(tmp_path, monkeypatch)
+    chunked(world, world.objects)
+    gids = sorted({int(gid) for row in world.objects.data for gid in row if gid})
+    # the bottom row of a chunk, so the image spills into the chunk below
+    for x, gid in ((1, gids[0]), (2, 0), (5, gids[-1])):
+        world.set_tile('Objects', x, 3, gid)
+    assert chunked(world, world.objects) == tile_by_tile(world, world.objects)
+
+def test_can_move_many_takes_names_indices_and_nothing():
+    game.init_headless((1, 1))
+    world = game.Game.load_world(os.path.join(REPO, 'tiled', 'boolground.tmx'))
+    assert world.can_move_many([], []).shape == (0,)
+    assert world.can_move_many(np.empty((0, 2)), np.array([], dtype=np.uint8)).dtype == bool
+    ys, xs = np.nonzero(world.passable)
+    positions = np.stack([xs, ys], axis=1)[:50]
+    for i, name in enumerate(game.DIRECTIONS):
+        dx, dy = game.DIRECTION_OFFSETS[i]
+        expected = world.passable_many(positions[:, 0] + dx, positions[:, 1] + dy)
+        assert (world.can_move_many(positions, [name] * len(positions)) == expected).all()
+        assert (world.can_move_many(positions, np.full(len(positions), i, dtype=np.uint8)) == expected).all()
+
+def test_doors_are_keyed_by_integer_tiles():
+    game.init_headless((1, 1))
+    world = game.Game.load_world(os.path.join(REPO, 'tiled', 'boolground.tmx'))
+    assert world.doors
+    for tile, door in world.doors.items():
+        assert tile == door.tile
+        assert all(type(c) is int for c in tile)
+
+def test_streamed_worlds_are_converted_on_the_main_thread():
+    game.init_headless((1, 1))
+    threads = []
+    def finish(world):
+        threads.append(threading.current_thread())
+        world.convert()
+    streamer = streaming.WorldStreamer(game.Game.load_world, finish_world=finish)
+    path = os.path.join(REPO, 'tiled', 'boolground.tmx')
+    world = streamer.request(path).result()
+    assert not world.tiles.converted
+    assert streamer.load(path) is world
+    assert world.tiles.converted and threads == [threading.main_thread()]
+    # the tiles are now in the display format, so blitting them needs no conversion
+    display = pygame.display.get_surface()
+    assert all(tile.get_bitsize() == display.get_bitsize() for tile in world.tiles.by_hash.values())
+    streamer.close()
+
+def test_animated_tiles_change_frame_after_their_duration(tmp_path, monkeypatch):
+    path = animated_tile_map(tmp_path, monkeypatch)
+    worlds = [game.World(mapcache.load_map(path, use_cache=False), chunk_size=4)]
+    # the first load writes the bundle, the second one reads it
+    mapcache.load_map(path)
+    worlds.append(game.World(mapcache.load_map(path), chunk_size=4))
+    assert isinstance(worlds[1].tiled_map, mapcache.CompiledMap)
+    frames = []
+    for world in worlds:
+        (gid, tile_animation), = world.tile_animations.items()
+        assert [duration for _, duration in tile_animation.frames] == [300, 150]
+        first = chunked(world, world.ground)
+        world.pop_dirty_rects()
+        world.update(299)
+        assert world.tile_frames[gid] == tile_animation.frames[0][0] and not world.pop_dirty_rects()
+        world.update(1)
+        assert world.tile_frames[gid] == tile_animation.frames[1][0] and world.pop_dirty_rects()
+        second = chunked(world, world.ground)
+        assert second != first and second == tile_by_tile(world, world.ground)
+        # the chunks redrawn in place match chunks baked from scratch
+        world.layer_caches.clear()
+        assert chunked(world, world.ground) == second
+        world.update(149)
+        assert world.tile_frames[gid] == tile_animation.frames[1][0]
+        world.update(1)
+        assert world.tile_frames[gid] == tile_animation.frames[0][0]
+        assert chunked(world, world.ground) == first
+        frames.append((first, second))
+    # the bundle animates exactly like the map loaded with pytmx
+    assert frames[0] == frames[1]
@@ -1,42 +1,365 @@
 import numpy as np 
-import cv2 
 import pygame
-import matplotlib.pyplot as plt
+import pygame.pixelcopy
+import hashlib
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+
+class AssetRegistry:
+    """Process-wide cache of loaded assets.
+    Entries are keyed by a tuple starting with the source path, followed by whatever parameters 
+    were used to build the asset (for example how a sheet was sliced), so the same file sliced 
+    the same way is only ever loaded once and every caller gets the same frames.
+    Cached values are shared, callers must not modify them.
+    Every entry belongs to a memory category (see memory.py), and entries are kept in least 
+    recently used order so a category can be trimmed with evict.
+    The registry is used from the streaming and loader threads as well as the main thread, so the
+    entries are only touched with lock held. Loaders run without it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # key -> memory category
+        self.categories = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader, category='sprites'):
+        """Returns the asset stored under key, calling loader() to create it on a miss.
+            key: tuple whose first item is the path of the source file
+            loader: function taking no arguments that returns the asset
+            category: the memory category the asset counts towards
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return value
+            self.misses += 1
+        value = loader()
+        with self.lock:
+            # another thread may have loaded it meanwhile, everyone shares the first one stored
+            value = self.entries.setdefault(key, value)
+            self.categories[key] = category
+        return value
+
+    def find(self, key):
+        """Returns the asset stored under key, or None if there is none. Nothing is loaded."""
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, value, category='sprites'):
+        """Stores an asset loaded elsewhere, e.g. by loader.AssetLoader, under key."""
+        with self.lock:
+            self.entries[key] = value
+            self.categories[key] = category
+
+    def bytes_by_category(self):
+        """Returns {category: bytes of the surfaces held by its entries}."""
+        with self.lock:
+            entries = [(self.categories[key], value) for key, value in self.entries.items()]
+        totals = {}
+        for category, value in entries:
+            totals[category] = totals.get(category, 0) + asset_bytes(value)
+        return totals
+
+    def evict(self, category, nbytes):
+        """Drops the least recently used entries of category until nbytes are freed, or none are left.
+        Returns the bytes freed. A later get loads them again.
+        """
+        freed = 0
+        with self.lock:
+            for key in [key for key in self.entries if self.categories[key] == category]:
+                if freed >= nbytes:
+                    break
+                freed += asset_bytes(self.entries.pop(key))
+                del self.categories[key]
+        return freed
+
+    def release(self, path):
+        """Drops every entry loaded from path. Returns the number of entries dropped.
+        Frames that callers still hold stay valid, they are just no longer shared with new callers.
+        """
+        with self.lock:
+            keys = [key for key in self.entries if key[0] == path]
+            for key in keys:
+                del self.entries[key]
+                del self.categories[key]
+        return len(keys)
+
+    def clear(self):
+        """Drops every entry and resets the statistics."""
+        with self.lock:
+            self.entries.clear()
+            self.categories.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns a dictionary with the hit and miss counts and the number of cached entries."""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+assets = AssetRegistry()
+
+def image_key(path, alpha=False):
+    """Returns the asset registry key of the image at path, converted with or without per-pixel alpha."""
+    return (path, 'image', alpha)
+
+def surface_bytes(surface):
+    """Returns the bytes of surface's pixels. Subsurfaces share their parent's pixels and count as 0."""
+    if surface.get_parent() is not None:
+        return 0
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+def asset_bytes(value):
+    """Returns the bytes of the surfaces in an asset: a surface, or a sequence or mapping of assets."""
+    if isinstance(value, pygame.Surface):
+        return surface_bytes(value)
+    if isinstance(value, MirroredFrames):
+        return sum(surface_bytes(frame) for frame in value.mirrored if frame is not None)
+    if isinstance(value, (tuple, list)):
+        return sum(asset_bytes(item) for item in value)
+    if isinstance(value, (dict, MappingProxyType)):
+        return sum(asset_bytes(item) for item in value.values())
+    return 0
+
+class ScaledCache:
+    """Scaled copies of surfaces, made once per surface and scale.
+    Copies are grouped by scale and only the most recently used max_scales scales are kept, so 
+    zooming back and forth doesn't keep every zoom level alive. Within a scale the copies are kept
+    in least recently used order, and bytes counts the pixels of every copy.
+    """
+    def __init__(self, max_scales=3):
+        self.max_scales = max_scales
+        self.scales = OrderedDict()
+        self.bytes = 0
+
+    def get(self, surface, scale):
+        """Returns surface scaled by scale with nearest neighbour sampling, keeping its colorkey."""
+        if scale == 1:
+            return surface
+        cache = self.scales.get(scale)
+        if cache is None:
+            cache = self.scales[scale] = OrderedDict()
+            if len(self.scales) > self.max_scales:
+                self.release(next(iter(self.scales)))
+        else:
+            self.scales.move_to_end(scale)
+        scaled = cache.get(surface)
+        if scaled is None:
+            w, h = surface.get_size()
+            scaled = cache[surface] = pygame.transform.scale(surface, (int(w * scale), int(h * scale)))
+            colorkey = surface.get_colorkey()
+            if colorkey is not None:
+                scaled.set_colorkey(colorkey, pygame.RLEACCEL)
+            self.bytes += surface_bytes(scaled)
+        else:
+            cache.move_to_end(surface)
+        return scaled
+
+    def release(self, scale):
+        """Drops every copy made for scale."""
+        cache = self.scales.pop(scale, None)
+        if cache:
+            self.bytes -= sum(surface_bytes(scaled) for scaled in cache.values())
+
+    def discard(self, surfaces):
+        """Drops the copies of surfaces at every scale, e.g. the tiles of a map that was unloaded."""
+        for cache in self.scales.values():
+            for surface in surfaces:
+                scaled = cache.pop(surface, None)
+                if scaled is not None:
+                    self.bytes -= surface_bytes(scaled)
+
+    def evict(self, nbytes):
+        """Drops the least recently used copies, least recently used scales first, until nbytes are freed.
+        Returns the bytes freed, they are scaled again when next drawn.
+        """
+        freed = 0
+        for cache in self.scales.values():
+            while cache and freed < nbytes:
+                freed += surface_bytes(cache.popitem(last=False)[1])
+        self.bytes -= freed
+        return freed
+
+scaled_surfaces = ScaledCache()
+
+class TextCache:
+    """Rendered text surfaces, so text that is the same as in earlier frames isn't rendered again.
+    Only the max_entries most recently used strings are kept.
+    """
+    def __init__(self, font, color=(255, 255, 255), max_entries=128):
+        self.font = font
+        self.color = color
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def render(self, text):
+        surface = self.entries.get(text)
+        if surface is None:
+            surface = self.entries[text] = self.font.render(text, True, self.color)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(text)
+        return surface
+
+def load_font(name='Arial', size=16):
+    """Returns the system font name at size, created once and shared through the asset registry."""
+    return assets.get((name, 'font', size), lambda: pygame.font.SysFont(name, size))
+
+class PreparedTiles:
+    """Tile images of a map, prepared once at load for fast blitting.
+    Every tile is composited on black and colorkeyed on black with RLE acceleration, which is exactly 
+    how the world bakes its layers. Tiles whose pixels come out identical, which happens a lot across 
+    overlapping tilesets, share one surface. Maps load on the streaming thread, so the tiles are only 
+    converted to the display format by convert, on the main thread like every other conversion.
+    """
+    def __init__(self, tiled_map, colorkey=(0, 0, 0)):
+        """
+            tiled_map: pytmx.TiledMap or mapcache.CompiledMap the images come from
+            colorkey: the color treated as transparent
+        """
+        self.tiled_map = tiled_map
+        self.colorkey = colorkey
+        self.by_gid = {}
+        self.by_hash = {}
+        self.source_bytes = 0
+        self.prepared_bytes = 0
+        # set once convert ran, tiles prepared after that are converted right away
+        self.converted = False
+
+    def prepare(self, gids):
+        """Prepares every gid in gids that isn't prepared yet."""
+        for gid in gids:
+            self.get(int(gid))
+
+    def get(self, gid):
+        """Returns the prepared surface for gid, preparing it on first use, or None for empty tiles."""
+        try:
+            return self.by_gid[gid]
+        except KeyError:
+            pass
+        image = self.tiled_map.get_tile_image_by_gid(gid) if gid else None
+        if image is None:
+            self.by_gid[gid] = None
+            return None
+        surface = pygame.Surface(image.get_size())
+        if self.converted:
+            surface = surface.convert()
+        surface.fill(self.colorkey)
+        surface.blit(image, (0, 0))
+        self.source_bytes += image.get_width() * image.get_height() * image.get_bytesize()
+        key = (surface.get_size(), hashlib.blake2b(pygame.image.tobytes(surface, 'RGB'), digest_size=16).digest())
+        shared = self.by_hash.get(key)
+        if shared is None:
+            surface.set_colorkey(self.colorkey, pygame.RLEACCEL)
+            shared = self.by_hash[key] = surface
+            self.prepared_bytes += surface.get_width() * surface.get_height() * surface.get_bytesize()
+        self.by_gid[gid] = shared
+        return shared
+
+    def convert(self):
+        """Converts the prepared tiles to the display format. Call it on the main thread."""
+        converted = {}
+        for key, surface in self.by_hash.items():
+            tile = surface.convert()
+            tile.set_colorkey(self.colorkey, pygame.RLEACCEL)
+            converted[surface] = self.by_hash[key] = tile
+        self.by_gid = {gid: converted[surface] if surface is not None else None for gid, surface in self.by_gid.items()}
+        self.prepared_bytes = sum(tile.get_width() * tile.get_height() * tile.get_bytesize() for tile in self.by_hash.values())
+        self.converted = True
+
+    def stats(self):
+        """Returns a dictionary describing how much deduplication saved."""
+        tiles = sum(1 for surface in self.by_gid.values() if surface is not None)
+        return {
+            'tiles': tiles,
+            'unique': len(self.by_hash),
+            'source_bytes': self.source_bytes,
+            'prepared_bytes': self.prepared_bytes,
+            # what the tiles would take if every gid had its own surface
+            'saved_bytes': sum(surface_bytes(tile) for tile in self.by_gid.values() if tile is not None) - self.prepared_bytes,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"Prepared {stats['tiles']} tiles, {stats['unique']} unique, "
+                f"{stats['prepared_bytes'] / 1024:.1f} KB, {stats['saved_bytes'] / 1024:.1f} KB saved by sharing identical tiles")
+
 class SpriteSheet:
     """Class used to grab images out of a sprite sheet."""
     def __init__(self, filename):
-        """Load the sheet."""
+        """Load the sheet, or reuse it if it was already loaded."""
+        self.filename = filename
+        self.sheet = assets.get(image_key(filename), lambda: self.load(filename))
+
+    @staticmethod
+    def load(filename, alpha=False):
         try:
-            self.sheet = pygame.image.load(filename).convert()
+            image = pygame.image.load(filename)
+            return image.convert_alpha() if alpha else image.convert()
         except pygame.error as e:
             print(f"Unable to load spritesheet image: {filename}")
             raise SystemExit(e)
 
+    def alpha_sheet(self):
+        """Returns the sheet converted with its per-pixel alpha, loaded once and shared."""
+        return assets.get(image_key(self.filename, True), lambda: self.load(self.filename, alpha=True))
+
+    def keyed_sheet(self, colorkey):
+        """Returns a copy of the sheet with colorkey set, made once per colorkey and shared.
+        Subsurfaces inherit the colorkey of the surface they are cut from, so the frames of one 
+        sheet all share this single copy.
+        """
+        def load():
+            sheet = self.sheet.copy()
+            if colorkey is not None:
+                sheet.set_colorkey(colorkey)
+            return sheet
+        return assets.get((self.filename, 'sheet', colorkey), load)
+
     def grid_split(self, nrows, ncols, colorkey=(0,128,255)):
         """
         Split the sheet into a grid of nrows x ncols tiles.
-        Returns a list of lists of surfaces, one for each row.
+        Returns a tuple of tuples of surfaces, one for each row. The frames are subsurface views 
+        of one colorkeyed copy of the sheet, so no pixels are copied per frame.
+        The result is cached in the asset registry and shared between callers.
         """
-        imgheight = self.sheet.get_height()
-        imgwidth = self.sheet.get_width()
-        y1 = 0
-        M = imgheight//nrows
-        N = imgwidth//ncols
-        tiles=[]
-        for y in range(0,imgheight,M):
-            rowtiles = []
-            for x in range(0, imgwidth, N):
-                y1 = y + M
-                x1 = x + N
-                img = self.image_at((x,y,x1-x,y1-y), colorkey)
-                # v = pygame.surfarray.array3d(img).swapaxes(0,1)
-                # plt.imshow(v)
-                # plt.show()
-                # img = pygame.transform.scale(img, (50, 100))
-                img.set_colorkey(colorkey, pygame.RLEACCEL)
-                rowtiles.append(img)
-            tiles.append(rowtiles)
-        return tiles
+        key = (self.filename, 'grid', nrows, ncols, colorkey)
+        return assets.get(key, lambda: self._grid_split(nrows, ncols, colorkey))
+
+    def _grid_split(self, nrows, ncols, colorkey):
+        sheet = self.keyed_sheet(colorkey)
+        h = sheet.get_height() // nrows
+        w = sheet.get_width() // ncols
+        return tuple(tuple(sheet.subsurface((x * w, y * h, w, h)) for x in range(ncols)) for y in range(nrows))
+
+    def grid_array(self, nrows, ncols, colorkey=(0,128,255)):
+        """
+        Split the sheet into a grid of nrows x ncols tiles in one pass over a surfarray view.
+        Returns a uint8 array of shape (nrows, ncols, w, h, 4) holding every frame as RGBA, indexed 
+        [x, y] like surfarray. The alpha is the image's own per-pixel alpha, and pixels of the 
+        colorkey get an alpha of 0.
+        """
+        sheet = self.alpha_sheet()
+        width, height = sheet.get_size()
+        w, h = width // ncols, height // nrows
+        rgb = pygame.surfarray.pixels3d(sheet)
+        alpha = pygame.surfarray.pixels_alpha(sheet)
+        try:
+            # splitting the x and y axes into (frame, pixel) is a reshape of the view, not a copy
+            frames = np.empty((nrows, ncols, w, h, 4), dtype=np.uint8)
+            frames[..., :3] = rgb[:ncols * w, :nrows * h].reshape(ncols, w, nrows, h, 3).transpose(2, 0, 1, 3, 4)
+            frames[..., 3] = alpha[:ncols * w, :nrows * h].reshape(ncols, w, nrows, h).transpose(2, 0, 1, 3)
+        finally:
+            # the views lock the sheet until they are released
+            del rgb, alpha
+        if colorkey is not None:
+            frames[..., 3][(frames[..., :3] == colorkey[:3]).all(axis=-1)] = 0
+        return frames
     
     def image_at(self, rectangle, colorkey = None):
         """Load a specific image from a specific rectangle."""
@@ -45,11 +368,78 @@ class SpriteSheet:
         image = pygame.Surface(rect.size).convert()
         image.blit(self.sheet, (0, 0), rect)
         if colorkey is not None:
-            if colorkey is -1:
+            if colorkey == -1:
                 colorkey = image.get_at((0,0))
             image.set_colorkey(colorkey, pygame.RLEACCEL)
         return image
 
+class MirroredFrames:
+    """Horizontally mirrored copies of a sequence of frames, each made the first time it is used 
+    and kept from then on.
+    """
+    __slots__ = ('frames', 'mirrored')
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.mirrored = [None] * len(frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i):
+        frame = self.mirrored[i]
+        if frame is None:
+            frame = self.mirrored[i] = pygame.transform.flip(self.frames[i], True, False)
+        return frame
+
+    def __iter__(self):
+        for i in range(len(self.frames)):
+            yield self[i]
+
+
+class SpatialHash:
+    """Index of entities by the tile they are on.
+    Each tile maps to the set of entity ids on it, so looking up a tile is O(1) no matter how 
+    many entities there are.
+    """
+    __slots__ = ('cells',)
+    EMPTY = frozenset()
+
+    def __init__(self):
+        self.cells = {}
+
+    def add(self, key, tile):
+        self.cells.setdefault(tile, set()).add(key)
+
+    def remove(self, key, tile):
+        cell = self.cells.get(tile)
+        if cell is not None:
+            cell.discard(key)
+            if not cell:
+                del self.cells[tile]
+
+    def move(self, key, old, new):
+        self.remove(key, old)
+        self.add(key, new)
+
+    def at(self, tile):
+        """Returns the set of ids on tile, callers must not modify it."""
+        return self.cells.get(tile, self.EMPTY)
+
+    def near(self, tile, radius=1):
+        """Returns a list of the ids on the tiles at most radius tiles away in x and y."""
+        x, y = tile
+        result = []
+        for ty in range(y - radius, y + radius + 1):
+            for tx in range(x - radius, x + radius + 1):
+                cell = self.cells.get((tx, ty))
+                if cell:
+                    result.extend(cell)
+        return result
+
+    def __len__(self):
+        return sum(len(cell) for cell in self.cells.values())
+
 
 def clamp(n, a, b): 
     """Clamp a number between a and b (inclusive)
@@ -63,6 +453,10 @@ def clamp(n, a, b):
     return max(min(b, n), a)
 
 def load_door_sprites(path="tiled/door_anims.png"): 
+    """Load the door animation frames from a spritesheet
+    Returns a tuple of surfaces shared by every door through the asset registry.
+    path: path to the spritesheet
+    """
     ss = SpriteSheet(path)
     rows = ss.grid_split(7, 4)
 
@@ -76,43 +470,32 @@ def load_door_sprites(path="tiled/door_anims.png"):
 
 def load_player_sprites(path="tiled/man.png"): 
     """Load the player sprites from a spritesheet
-    Returns a dictionary of lists of surfaces, one for each direction.
+    Returns a read-only dictionary of sequences of surfaces, one for each direction. 
+    LEFT mirrors the RIGHT frames as they are first used. The sprites are shared through the asset registry.
     path: path to the spritesheet
-    tilesize: size of each tile in pixels
     """
-    ss = SpriteSheet(path)
-    rows = ss.grid_split(3,4)
-    return {
-        'DOWN': rows[0],
-        'RIGHT': rows[1],
-        'UP': rows[2],
-        'LEFT': [pygame.transform.flip(surf, True, False) for surf in rows[1]],
-    }
+    def load():
+        rows = SpriteSheet(path).grid_split(3,4)
+        return MappingProxyType({
+            'DOWN': rows[0],
+            'RIGHT': rows[1],
+            'UP': rows[2],
+            'LEFT': MirroredFrames(rows[1]),
+        })
+    return assets.get((path, 'player'), load)
 
 def read_spritesheet(path, nrows, ncols, tilesize=50): 
-    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-    img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
-    rows = split_image(img, nrows, ncols)
-    surfaces = []
-    for i, row in enumerate(rows): 
-        surfs = []
-        for j, tilearray in enumerate(row): 
-            tilearray = (255*tilearray/tilearray.max()).astype(np.uint8)
-            # use custom function to make surface with per-pixel alpha
-            surf = make_surface_rgba(tilearray)
-            pygame.transform.scale(surf, (tilesize*2, tilesize))
-            surfs.append(surf)
-        surfaces.append(surfs)
-    return surfaces 
-
-import numpy
-import pygame.pixelcopy
+    """Reads a spritesheet into rows of surfaces with per-pixel alpha, scaled to tilesize*2 x tilesize.
+    The frames are cut from the sheet with SpriteSheet.grid_array.
+    """
+    frames = SpriteSheet(path).grid_array(nrows, ncols)
+    return [[pygame.transform.scale(make_surface_rgba(frame), (tilesize*2, tilesize)) for frame in row] for row in frames]
 
 def make_surface_rgba(array):
     """Returns a surface made from a [w, h, 4] numpy array with per-pixel alpha
     """
     shape = array.shape
-    if len(shape) != 3 and shape[2] != 4:
+    if len(shape) != 3 or shape[2] != 4:
         raise ValueError("Array not RGBA")
 
     # Create a surface the same width and height as array and with
@@ -124,7 +507,7 @@ def make_surface_rgba(array):
 
     # Copy the alpha part of array to the surface using a pixels-alpha
     # view of the surface.
-    surface_alpha = numpy.array(surface.get_view('A'), copy=False)
+    surface_alpha = np.array(surface.get_view('A'), copy=False)
     surface_alpha[:,:] = array[:,:,3]
 
     return surface